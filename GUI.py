@@ -2,13 +2,20 @@ from PyQt6.QtWidgets import QApplication, QWidget, QMainWindow, QGraphicsView, Q
      QPushButton, QHBoxLayout, QVBoxLayout, QTableView, QDialog, QLabel, QLineEdit, QGraphicsScene, QGraphicsSimpleTextItem, QGraphicsTextItem, \
      QTabWidget, QFormLayout, QGraphicsLineItem, QGraphicsRectItem, QGraphicsPixmapItem, QGraphicsSceneDragDropEvent
 from PyQt6.QtGui import QPen, QColor, QBrush, QPixmap, QPolygon
-from PyQt6.QtCore import Qt, QRectF, QEventLoop, QEvent, QObject, QThread, pyqtSignal
+from PyQt6.QtCore import Qt, QRectF, QEventLoop, QEvent, QObject, QThread, QTimer, pyqtSignal
 import sys
 from controller import Controller
 import time
 from datetime import datetime
-from tabs import FrequencySwipe, AmplitudeSwipe, ChannelSwipe, VoltageSwipe
+from tabs import FrequencySwipe, AmplitudeSwipe, ChannelSwipe, VoltageSwipe, ThresholdTab, StimulationWorker
 from handmap import HandMap
+from refresh import StateRefresher
+from connection import ConnectionSupervisor
+from shadow_state import ShadowState
+from results_store import ResultsStore
+import profiling
+
+STATUS_FPS = 10
 
 # device on top
 channel_layout = [15,12,9,6,16,13,8,5,17,14,7,4,18,11,10,3]
@@ -113,6 +120,11 @@ class ChannelView(QGraphicsView):
         return self.active_cathodes, self.active_anodes
 
 
+class ConnectionStatus(QObject):
+    """Brings connection state changes from the supervisor thread to the GUI thread"""
+    changed = pyqtSignal(str, str)
+
+
 class MainWindow(QWidget): 
     def __init__(self, device=None):
         super().__init__()
@@ -147,14 +159,18 @@ class MainWindow(QWidget):
         
     def create_tabs(self):
         self.tabs = QTabWidget()
-        self.tab1 = ChannelSwipe(self.channels, self.device, self.handmap) 
-        self.tab2 = AmplitudeSwipe(self.channels, self.device, self.handmap)
-        self.tab3 = FrequencySwipe(self.channels, self.device, self.handmap)
-        self.tab4 = VoltageSwipe(self.channels, self.device, self.handmap)
+        # one worker thread for the whole session, shared by every tab
+        self.worker = StimulationWorker(self.device)
+        self.tab1 = ChannelSwipe(self.channels, self.device, self.handmap, self.worker)
+        self.tab2 = AmplitudeSwipe(self.channels, self.device, self.handmap, self.worker)
+        self.tab3 = FrequencySwipe(self.channels, self.device, self.handmap, self.worker)
+        self.tab4 = VoltageSwipe(self.channels, self.device, self.handmap, self.worker)
+        self.tab5 = ThresholdTab(self.channels, self.device, self.handmap, self.worker)
         self.tabs.addTab(self.tab1,"Swipe channels")
         self.tabs.addTab(self.tab2,"Swipe amplitudes")
         self.tabs.addTab(self.tab3,"Swipe frequencies")
         self.tabs.addTab(self.tab4,"Swipe voltages")
+        self.tabs.addTab(self.tab5,"Find thresholds")
         
     def create_menu(self):
         self.menubar = QVBoxLayout()
@@ -166,28 +182,56 @@ class MainWindow(QWidget):
         self.devicebtn.clicked.connect(self.get_current_settings)
         self.menubar.addWidget(self.devicebtn)
 
+        self.heatmapbtn = QPushButton("Show stored responses")
+        self.heatmapbtn.clicked.connect(self.load_heatmap)
+        self.menubar.addWidget(self.heatmapbtn)
+
+        self.connection = QLabel("")
+        self.menubar.addWidget(self.connection)
+
         self.statistics = QLabel("")
         self.menubar.addWidget(self.statistics)
-        # refaktorointi tulee olemaan 5/5 kokemus XD osaispa koodaa
-        self.tab1.apply.clicked.connect(self.get_current_settings)
-        self.tab2.apply.clicked.connect(self.get_current_settings)
-        self.tab3.apply.clicked.connect(self.get_current_settings)
-        self.tab4.apply.clicked.connect(self.get_current_settings)
+
+        # device settings are redrawn at most STATUS_FPS times a second, only when the device state changed
+        if self.device:
+            self.refresher = StateRefresher(self.device, lambda fields: self.get_current_settings(),
+                                            max_fps=STATUS_FPS)
+            self.refresh_timer = QTimer(self)
+            self.refresh_timer.timeout.connect(self.refresher.flush)
+            self.refresh_timer.start(int(1000 / STATUS_FPS))
+
+            # the port is reopened in the background when the link drops, the GUI only shows the state
+            self.connection_status = ConnectionStatus()
+            self.connection_status.changed.connect(self.show_connection)
+            # base settings are sent on the first connect if the port wasn't there at start
+            self.supervisor = ConnectionSupervisor(self.device, ShadowState(self.device),
+                                                   on_status=self.connection_status.changed.emit,
+                                                   startup=set_base_settings)
+            self.show_connection(self.supervisor.state, self.supervisor.text)
+        self.get_current_settings()
+
+    def show_connection(self, state, text):
+        self.connection.setText(text)
+
+    def load_heatmap(self):
+        """Paints how often each zone was reported over every stored session, for all pairs together"""
+        store = ResultsStore()
+        results = store.query()
+        store.close()
+        self.handmap.heatmap.clear()
+        self.handmap.heatmap.add_responses(((result.cathode, result.anode), result.zones) for result in results)
+        self.handmap.heatmap.show()
 
     def close_and_exit(self):
         sys.exit()
 
     def get_current_settings(self):
-        if device:
-            self.statistics.setText(device.__str__())
+        if self.device:
+            with profiling.span('ui_update', category='gui'):
+                self.statistics.setText(self.device.__str__())
         else:
             self.statistics.setText("No device")
 
-def abort_serial(device):
-    # TODO joku parempi ratkasu, nyt vaan hätäjarru
-    device.serial_.close()         
-    
-
 def set_base_settings(device):
     """
     dont set current_range to high
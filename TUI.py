@@ -1,13 +1,21 @@
-import logging
+import queue
+import threading
 from typing import Callable
 
 import py_cui
 
-from controller import Controller
+import profiling
+from adjust import AdjustmentPipeline
+from commands import ramp_result, run_command
+from connection import ConnectionSupervisor
+from history import CommandHistory, HistoryEntry
+from ramp import Ramp
+from controller import Controller, STATE_FIELDS
+from refresh import StateRefresher
 
 
 class TUI:
-    def __init__(self, device: Controller, config_file=""):
+    def __init__(self, device: Controller, config_file="", supervisor: ConnectionSupervisor = None):
         self.labels = [
             "Current range: {}, Voltage: {}, Mode: {}",
             "DC/DC Converter: {}",
@@ -25,46 +33,77 @@ class TUI:
             "Pulse generation parameters possible: {}"
         ]
         self.device = device
+        self.supervisor = supervisor
+        # ramp running in the background, see start_ramp
+        self.ramp = None
+        # (command, ok, result) of finished ramps, added to the history by render
+        self.finished_ramps = queue.Queue()
         self.master = py_cui.PyCUI(30, 10)
 
-        self.master.set_title("Bimatrix controller (Battery: {}%)".format(device.read_battery()))
+        device.read_battery()
 
         span = 5
 
-        self.stats = self.master.add_block_label(self.labels[0].format(
-            device.current_range, device.voltage, device.mode),
-            0, 0, column_span=span, center=False)
-        self.converter = self.master.add_block_label(self.labels[1].format(self._bool_to_string(
-            device.pulse_generator_dc_converter_status)),
-            1, 0, column_span=span, center=False)
-        self.pulse_generation = self.master.add_block_label(self.labels[2].format(self._bool_to_string(
-            device.pulse_generator_triggered)),
-            2, 0, column_span=span, center=False)
-        self.num_nplet = self.master.add_block_label(self.labels[3].format(
-            device.num_nplets if device.num_nplets != 0 else "0 (Infinite)"),
-            3, 0, column_span=span, center=False)
-        self.electrode = self.master.add_block_label(self.labels[12].format(device.common_electrode),
-                                                     0, 5, column_span=span, center=False)
-        self.time_between = self.master.add_block_label(self.labels[4].format(device.time_between),
-                                                        1, 5, column_span=span, center=False)
-        self.repetition_rate = self.master.add_block_label(self.labels[5].format(device.repetition_rate),
-                                                           2, 5, column_span=span, center=False)
-        self.delay = self.master.add_block_label(self.labels[6].format(device.delay),
-                                                 3, 5, column_span=span, center=False)
-        self.valid = self.master.add_block_label(self.labels[13].format(False),
-                                                 4, 0, column_span=5, center=False)
-        self.widths = self.master.add_block_label(self.labels[7].format(device.pulse_widths),
-                                                  5, 0, column_span=10, center=False)
-        self.amplitudes = self.master.add_block_label(self.labels[8].format(
-            self._calculate_amplitudes(device.pulse_amplitudes, device.mode)),
-            6, 0, column_span=10, center=False)
-        self.outputs = self.master.add_block_label(self.labels[9].format(device.output_channels),
-                                                   7, 0, column_span=10, center=False)
-        self.pairs = self.master.add_block_label(self.labels[10].format(device.channel_pairs),
-                                                 8, 0, column_span=10, center=False)
+        self.stats = self.master.add_block_label("", 0, 0, column_span=span, center=False)
+        self.converter = self.master.add_block_label("", 1, 0, column_span=span, center=False)
+        self.pulse_generation = self.master.add_block_label("", 2, 0, column_span=span, center=False)
+        self.num_nplet = self.master.add_block_label("", 3, 0, column_span=span, center=False)
+        self.electrode = self.master.add_block_label("", 0, 5, column_span=span, center=False)
+        self.time_between = self.master.add_block_label("", 1, 5, column_span=span, center=False)
+        self.repetition_rate = self.master.add_block_label("", 2, 5, column_span=span, center=False)
+        self.delay = self.master.add_block_label("", 3, 5, column_span=span, center=False)
+        self.valid = self.master.add_block_label("", 4, 0, column_span=5, center=False)
+        self.widths = self.master.add_block_label("", 5, 0, column_span=10, center=False)
+        self.amplitudes = self.master.add_block_label("", 6, 0, column_span=10, center=False)
+        self.outputs = self.master.add_block_label("", 7, 0, column_span=10, center=False)
+        self.pairs = self.master.add_block_label("", 8, 0, column_span=10, center=False)
+
+        # (set_title, device state fields shown, title) for every label, re-rendered when one of the fields changes
+        self.views = [
+            (self.master.set_title, ["battery_state", "link"],
+             lambda: "Bimatrix controller (Battery: {}%){}".format(device.battery_state, self._link_status())),
+            (self.stats.set_title, ["current_range", "voltage", "mode"],
+             lambda: self.labels[0].format(device.current_range, device.voltage, device.mode)),
+            (self.converter.set_title, ["pulse_generator_dc_converter_status"],
+             lambda: self.labels[1].format(self._bool_to_string(device.pulse_generator_dc_converter_status))),
+            (self.pulse_generation.set_title, ["pulse_generator_triggered"],
+             lambda: self.labels[2].format(self._bool_to_string(device.pulse_generator_triggered))),
+            (self.num_nplet.set_title, ["num_nplets"],
+             lambda: self.labels[3].format(device.num_nplets if device.num_nplets != 0 else "0 (Infinite)")),
+            (self.electrode.set_title, ["common_electrode"],
+             lambda: self.labels[12].format(device.common_electrode)),
+            (self.time_between.set_title, ["time_between"],
+             lambda: self._with_pending(self.labels[4].format(device.time_between), "time_between")),
+            (self.repetition_rate.set_title, ["repetition_rate"],
+             lambda: self._with_pending(self.labels[5].format(device.repetition_rate), "repetition_rate")),
+            (self.delay.set_title, ["delay"],
+             lambda: self.labels[6].format(device.delay)),
+            (self.valid.set_title, ["pulse_widths", "time_between", "repetition_rate"],
+             lambda: self.labels[13].format(device.check_nplet_parameter_validity())),
+            (self.widths.set_title, ["pulse_widths"],
+             lambda: self._with_pending(self.labels[7].format(device.pulse_widths), "pulse_widths")),
+            (self.amplitudes.set_title, ["pulse_amplitudes", "current_range"],
+             lambda: self._with_pending(self.labels[8].format(self._calculate_amplitudes(
+                 device.pulse_amplitudes, device.current_range)), "pulse_amplitudes",
+                 lambda a: self._calculate_amplitudes(a, device.current_range))),
+            (self.outputs.set_title, ["output_channels"],
+             lambda: self.labels[9].format(device.output_channels)),
+            (self.pairs.set_title, ["channel_pairs"],
+             lambda: self.labels[10].format(device.channel_pairs)),
+        ]
+        self.refresher = StateRefresher(device, self.render)
+        # key nudges only move a pending target, the newest target is sent whenever the link is free
+        self.adjustments = AdjustmentPipeline(device, on_change=self.refresher.mark_dirty)
+        if supervisor is not None:
+            supervisor.on_status = lambda state, text: self.refresher.mark_dirty("link")
+        self.render(set(STATE_FIELDS))
 
         self.command_prompt = self.master.add_text_box("Command: ", 29, 0, column_span=10)
         self.command_history = self.master.add_scroll_menu("Command history", 17, 0, row_span=11, column_span=10)
+        # only the newest entries are kept in the menu, the full history is in the session file
+        self.history = CommandHistory()
+        self.history_items = 0
+        self.showing_history = True
         self.command_list = self.master.add_scroll_menu("Commands", 9, 0, row_span=8, column_span=10)
 
         commands = [
@@ -84,6 +123,10 @@ class TUI:
             "output [channels]: list of channels in format x,y,z;i,j,k",
             "pairs [channels]: list of channels pairs in format x;y x;y",
             "common_electrode: set common electrode to cathode or anode",
+            "ramp <amplitude|frequency|voltage> <start> <target> <seconds> [linear|exponential]: ramp smoothly",
+            "ramp stop: abort the running ramp",
+            "history [text]: search the whole command history, history #<n>: jump to entry n, history: newest",
+            "export <file>: save the successful commands of this session as a command file",
         ]
         self.command_list.add_item_list(commands)
 
@@ -104,18 +147,29 @@ class TUI:
         if config_file:
             f = open(config_file, "r")
             for line in f:
-                out = self._parse_input(line)
-                self.command_history.add_item(out)
+                # same format as headless command files, exported histories start with a comment
+                if not line.strip() or line.strip().startswith('#'):
+                    continue
+                self._parse_input(line, background=False)
 
+        self.refresher.start()
         self.master.start()
+        self.stop_ramp()
+        self.adjustments.stop()
+        self.refresher.stop()
+        self.history.close()
+
+    def render(self, fields: set):
+        """Update the labels showing any of the changed device state fields and add finished ramps to the history"""
+        with profiling.span('ui_update', category='tui'):
+            for set_title, shown, title in self.views:
+                if fields.intersection(shown):
+                    set_title(title())
+            while not self.finished_ramps.empty():
+                self.add_history(self.history.add(*self.finished_ramps.get_nowait()))
 
     def change_amplitudes(self, step=1):
-        new_amplitudes = [[a + step for a in self.device.pulse_amplitudes]]
-        self._input_func("change amplitude by step of {}".format(step), new_amplitudes,
-                         self.device.set_amplitude, self.amplitudes.set_title,
-                         self.labels[8], self.device, ["pulse_amplitudes"])
-        self.amplitudes.set_title(self.labels[8].format(self._calculate_amplitudes(
-            self.device.pulse_amplitudes, self.device.current_range)))
+        self.adjustments.nudge("pulse_amplitudes", step)
 
     def increase_amplitudes(self):
         self.change_amplitudes(step=1)
@@ -124,10 +178,7 @@ class TUI:
         self.change_amplitudes(step=-1)
 
     def change_pulse_widths(self, step=1):
-        new_widths = [[w + step for w in self.device.pulse_widths]]
-        self._input_func("change amplitude by step of {}".format(step), new_widths,
-                         self.device.set_pulse_width, self.widths.set_title,
-                         self.labels[7], self.device, ["pulse_widths"]),
+        self.adjustments.nudge("pulse_widths", step)
 
     def increase_widths(self):
         self.change_pulse_widths(step=1)
@@ -136,10 +187,7 @@ class TUI:
         self.change_pulse_widths(step=-1)
 
     def change_repetition_rate(self, step=1):
-        new_params = [self.device.repetition_rate + step]
-        self._input_func("Change repetion rate by step of {}".format(step), new_params,
-                         self.device.set_repetition_rate, self.repetition_rate.set_title,
-                         self.labels[5], self.device, ["repetition_rate"])
+        self.adjustments.nudge("repetition_rate", step)
 
     def increase_repetition_rate(self):
         self.change_repetition_rate(step=1)
@@ -148,10 +196,7 @@ class TUI:
         self.change_repetition_rate(step=-1)
 
     def change_time_between(self, step=1):
-        new_params = [self.device.time_between + step]
-        self._input_func("Change time between by step of {}".format(step), new_params,
-                         self.device.set_time_between, self.time_between.set_title,
-                         self.labels[4], self.device, ["time_between"])
+        self.adjustments.nudge("time_between", step)
 
     def increase_time_between(self):
         self.change_time_between(step=1)
@@ -159,6 +204,18 @@ class TUI:
     def decrease_time_between(self):
         self.change_time_between(step=-1)
 
+    def _with_pending(self, title: str, field: str, convert: Callable = lambda value: value) -> str:
+        """Label title with the value still waiting to be sent to the device"""
+        pending = self.adjustments.pending(field)
+        if pending is None:
+            return title
+        return "{} -> pending: {}".format(title, convert(pending))
+
+    def _link_status(self) -> str:
+        if self.supervisor is None or (self.device.connected and not self.supervisor.resync_failed):
+            return ""
+        return " - {}".format(self.supervisor.text)
+
     @staticmethod
     def _bool_to_string(status: bool) -> str:
         return "On" if status else "Off"
@@ -177,177 +234,82 @@ class TUI:
             new.append(i / div)
         return new
 
+    def _parse_input(self, text: str, background: bool = True):
+        parts = text.split()
+        if parts and parts[0] == 'history':
+            self.show_history(" ".join(parts[1:]))
+            return
+        if parts and parts[0] == 'export':
+            self.export_history(parts[1:])
+            return
+        if parts == ['ramp', 'stop']:
+            self.stop_ramp()
+            return
+        # ramps in the command file finish before the next line, like in headless mode
+        ok, out = run_command(self.device, text, start_ramp=self.start_ramp if background else None)
+        self.add_history(self.history.add(text.strip(), ok, out))
+
+    def start_ramp(self, ramp: Ramp, command: str):
+        """Runs the ramp on a worker thread so the interface stays responsive, a running ramp is aborted first"""
+        self.stop_ramp()
+        self.ramp = ramp
+
+        def run():
+            self.finished_ramps.put((command, *ramp_result(command, ramp.run())))
+            self.refresher.mark_dirty("history")
+
+        threading.Thread(target=run, name="ramp", daemon=True).start()
+
+    def stop_ramp(self):
+        if self.ramp is not None:
+            self.ramp.abort()
+            self.ramp = None
+
     @staticmethod
-    def _input_func(command: str, params: list, device_func: Callable,
-                    set_title: Callable, title_base: str, device: Controller, format_params: list):
-        try:
-            succ = device_func(*params)
-            if succ:
-                new_list = [getattr(device, i) for i in format_params]
-                formatted_list = []
-                for i in new_list:
-                    if type(i) is bool:
-                        formatted_list.append("On" if i else "Off")
-                    else:
-                        formatted_list.append(i)
-                set_title(title_base.format(*formatted_list))
-                out = command
-            else:
-                out = "Command: {}, failed for unknown reason".format(command)
-        except ValueError as e:
-            logging.debug(e)
-            out = "Error: {}".format(e)
-
-        return out
-
-    def _parse_input(self, text: str) -> str:
+    def _history_item(entry: HistoryEntry) -> str:
+        return "#{} {}".format(entry.index, entry.result)
+
+    def add_history(self, entry: HistoryEntry):
+        if not self.showing_history:
+            self.show_history("")
+            return
+        # the menu is refilled from the newest entries once it has grown to twice the kept size
+        if self.history_items >= 2 * self.history.max_visible:
+            self.show_history("")
+            return
+        self.command_history.add_item(self._history_item(entry))
+        self.history_items += 1
+
+    def show_history(self, query: str):
+        """Newest entries without a query, entries from #n onwards for '#n' and search results otherwise"""
+        if not query:
+            entries = self.history.recent()
+            title = "Command history"
+        elif query.startswith('#') and query[1:].isdigit():
+            entries = self.history.around(int(query[1:]))
+            title = "Command history from {}".format(query)
+        else:
+            entries = self.history.search(query)
+            title = "Command history matching '{}' ({} found)".format(query, len(entries))
+        self.showing_history = not query
+        self.command_history.clear()
+        self.command_history.add_item_list([self._history_item(entry) for entry in entries])
+        self.command_history.set_title(title)
+        self.history_items = len(entries)
+
+    def export_history(self, params: list):
+        if len(params) != 1:
+            self.command_history.add_item("Export command requires a file name")
+            return
         try:
-            out = text.lower()
-            parts = text.split()
-            cmd = parts[0]
-            params = parts[1:]
-            if cmd == 'battery':
-                self.device.read_battery()
-                self.master.set_title("Bimatrix controller (Battery: {}%)".format(self.device.battery_state))
-            elif cmd == 'mode':
-                if len(params) == 1:
-                    out = self._input_func(out, params, self.device.set_mode,
-                                           self.stats.set_title, self.labels[0], self.device,
-                                           ["current_range", "voltage", "mode"])
-                else:
-                    out = "Mode command requires one parameter"
-            elif cmd == 'range':
-                if len(params) == 1:
-                    out = self._input_func(out, params, self.device.set_current_range,
-                                           self.stats.set_title, self.labels[0], self.device,
-                                           ["current_range", "voltage", "mode"])
-                else:
-                    out = "Current range command requires one parameter"
-            elif cmd == 'voltage':
-                if len(params) == 1:
-                    new_params = [int(params[0])]
-                    out = self._input_func(out, new_params, self.device.set_voltage,
-                                           self.stats.set_title, self.labels[0], self.device,
-                                           ["current_range", "voltage", "mode"])
-                else:
-                    out = "Voltage command requires one parameter"
-            elif cmd == 'dc':
-                if len(params) == 0:
-                    out = self._input_func(out, params, self.device.toggle_pulse_generator,
-                                           self.converter.set_title, self.labels[1], self.device,
-                                           ["pulse_generator_dc_converter_status"])
-                elif len(params) == 1:
-                    params = [params[0].lower() == 'on']
-                    out = self._input_func(out, params, self.device.set_pulse_generator,
-                                           self.converter.set_title, self.labels[1], self.device,
-                                           ["pulse_generator_dc_converter_status"])
-                else:
-                    out = "Dc: too many parameters, expected 0 or 1"
-            elif cmd == 'trigger':
-                if len(params) == 0:
-                    out = self._input_func(out, params, self.device.trigger_pulse_generator,
-                                           self.pulse_generation.set_title, self.labels[2], self.device,
-                                           ["pulse_generator_triggered"])
-                else:
-                    out = "Trigger: Too many parameters, expected 0"
-            elif cmd == 'nplets':
-                if len(params) == 1:
-                    new_params = [int(params[0])]
-                    out = self._input_func(out, new_params, self.device.set_num_nplets,
-                                           self.num_nplet.set_title, self.labels[3], self.device,
-                                           ["num_nplets"])
-                else:
-                    out = "Number of n-plets: incorrent number of parameters, expected one"
-            elif cmd == 'time_between':
-                if len(params) == 1:
-                    new_params = [int(params[0])]
-                    out = self._input_func(out, new_params, self.device.set_time_between,
-                                           self.time_between.set_title, self.labels[4], self.device,
-                                           ["time_between"])
-                else:
-                    out = "Time between: incorrent number of parameters, expected one"
-            elif cmd == 'repetition_rate':
-                if len(params) == 1:
-                    new_params = [int(params[0])]
-                    out = self._input_func(out, new_params, self.device.set_repetition_rate,
-                                           self.repetition_rate.set_title, self.labels[5], self.device,
-                                           ["repetition_rate"])
-                else:
-                    out = "Repetition rate: incorrent number of parameters, expected one"
-            elif cmd == 'delay':
-                if len(params) == 1:
-                    new_params = [int(params[0])]
-                    out = self._input_func(out, new_params, self.device.set_delay,
-                                           self.delay.set_title, self.labels[6], self.device,
-                                           ["delay"])
-                else:
-                    out = "Delay: incorrent number of parameters, expected one"
-            elif cmd == 'widths':
-                if 0 <= len(params) <= 24:
-                    new_params = [[int(i) for i in params]]
-                    out = self._input_func(out, new_params, self.device.set_pulse_width,
-                                           self.widths.set_title, self.labels[7], self.device,
-                                           ["pulse_widths"])
-                else:
-                    out = "widths: incorrect number of parameters"
-            elif cmd == 'amplitudes':
-                if 0 <= len(params) <= 24:
-                    new_params = [[int(i) for i in params]]
-                    out = self._input_func(out, new_params, self.device.set_amplitude,
-                                           self.amplitudes.set_title, self.labels[8], self.device,
-                                           ["pulse_amplitudes"])
-                    self.amplitudes.set_title(self.labels[8].format(self._calculate_amplitudes(
-                        self.device.pulse_amplitudes, self.device.current_range)))
-                else:
-                    out = "amplitudes: incorrect number of parameters"
-            elif cmd == 'output':
-                if 0 <= len(params) <= 24:
-                    new_params = []
-                    for pulse in params:
-                        channels = pulse.split(',')
-                        new_channels = [int(i) for i in channels]
-                        new_params.append(new_channels)
-                    out = self._input_func(out, [new_params], self.device.set_pulses_unipolar,
-                                           self.outputs.set_title, self.labels[9], self.device,
-                                           ["output_channels"])
-                else:
-                    out = "outputs: incorrect number of parameters"
-            elif cmd == 'pairs':
-                if 0 <= len(params) <= 24:
-                    new_params = []
-                    for pulse in params:
-                        pair = pulse.split(';')
-
-                        p1 = [int(i) for i in pair[0].split(',')]
-                        p2 = [int(i) for i in pair[1].split(',')]
-                        new_params.append((p1, p2))
-                    logging.debug(new_params)
-                    out = self._input_func(out, [new_params], self.device.set_pulses_bipolar,
-                                           self.pairs.set_title, self.labels[10], self.device,
-                                           ["channel_pairs"])
-                else:
-                    out = "pairs: incorrect number of parameters"
-            elif cmd == 'electrode':
-                if len(params) == 1:
-                    out = self._input_func(out, params, self.device.set_common_electrode,
-                                           self.electrode.set_title, self.labels[12], self.device,
-                                           ["common_electrode"])
-                else:
-                    out = "Electrode: incorrent number of parameters, expected one"
-            else:
-                out = "Command not found: {}".format(out)
-
-            res = self.device.check_nplet_parameter_validity(self.device.pulse_widths,
-                                                             self.device.time_between, self.device.repetition_rate)
-            self.valid.set_title(self.labels[13].format(res))
-
-            return out
-        except Exception as e:
-            logging.error(e)
-            return "Something went wrong, please try again. Command used: {}".format(text)
+            written = self.history.export(params[0])
+            self.command_history.add_item("Exported {} commands to {}".format(written, params[0]))
+        except OSError as e:
+            self.command_history.add_item("Error: {}".format(e))
+        self.history_items += 1
 
     def send_command(self):
         text = self.command_prompt.get()
-        out = self._parse_input(text)
+        self._parse_input(text)
         self.command_prompt.clear()
-        self.command_history.add_item(out)
+        self.refresher.flush()
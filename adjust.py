@@ -0,0 +1,95 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+from controller import Controller
+
+# Adjustable device state field -> (controller setter, minimum, maximum)
+ADJUSTABLE = {
+    'pulse_amplitudes': ('set_amplitude', 0, 1000),
+    'pulse_widths': ('set_pulse_width', 50, 1000),
+    'repetition_rate': ('set_repetition_rate', 1, 400),
+    'time_between': ('set_time_between', 1, 255),
+}
+
+
+class AdjustmentPipeline:
+    """Latest-value-wins pipeline for stepping parameters from key presses
+
+    Nudges only move a pending target, a worker thread sends the newest target of each parameter whenever
+    the link is free. Targets overwritten before they were sent are never sent.
+
+    :param on_change: called with the field name when its pending target is set, applied or dropped
+    """
+
+    def __init__(self, device: Controller, on_change: Optional[Callable[[str], None]] = None):
+        self.device = device
+        self.on_change = on_change
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="adjustment-pipeline", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _step(value, step: int, minimum: int, maximum: int):
+        if isinstance(value, list):
+            # unused pulses (0) are left as they are
+            return [min(max(v + step, minimum), maximum) if v != 0 else 0 for v in value]
+        return min(max(value + step, minimum), maximum)
+
+    def nudge(self, field: str, step: int):
+        """Move the pending target of field by step, returns the new target"""
+        if field not in ADJUSTABLE:
+            raise ValueError("Parameter {} can't be adjusted, use one of {}".format(field, list(ADJUSTABLE)))
+        _, minimum, maximum = ADJUSTABLE[field]
+        with self._lock:
+            current = self._pending.get(field, getattr(self.device, field))
+            target = self._step(current, step, minimum, maximum)
+            self._pending[field] = target
+        self._changed(field)
+        self._wake.set()
+        return target
+
+    def pending(self, field: str):
+        """Target waiting to be sent for field, None if the device is up to date"""
+        with self._lock:
+            return self._pending.get(field)
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+
+    def _changed(self, field: str):
+        if self.on_change is not None:
+            self.on_change(field)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stopped:
+                break
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    field = next(iter(self._pending))
+                    target = self._pending[field]
+                setter = getattr(self.device, ADJUSTABLE[field][0])
+                try:
+                    ok = setter(target)
+                except ValueError as e:
+                    logging.warning(e)
+                    ok = False
+                if not ok:
+                    logging.warning("Adjusting {} to {} failed".format(field, target))
+                with self._lock:
+                    # Drop the target unless a newer one came in while sending, then let the other fields go first
+                    if self._pending.get(field) == target:
+                        del self._pending[field]
+                    elif field in self._pending:
+                        self._pending[field] = self._pending.pop(field)
+                self._changed(field)
@@ -0,0 +1,147 @@
+import os
+from collections import namedtuple
+from typing import Optional
+
+import numpy as np
+
+from results_store import RESULTS_DATABASE, ZONES, ResultsStore
+
+NUM_ZONES = len(ZONES)
+NO_BIT = 1 << ZONES.index("NO")
+# Every zone on the hand, a stimulus marked with any of these was felt
+FELT_BITS = (1 << NUM_ZONES) - 1 - NO_BIT
+
+# One entry per stimulus, zones as a bitmask with bit i set for ZONES[i]
+Responses = namedtuple('Responses', ['session', 'amplitude', 'cathode', 'anode', 'zones'])
+PairTable = namedtuple('PairTable', ['pairs', 'counts', 'probabilities'])
+
+
+def load(store: Optional[ResultsStore] = None, path: str = RESULTS_DATABASE) -> Responses:
+    """Every stimulus of every session in the results database as arrays, the bitmasks are built by SQLite
+
+    A store opened from path is closed again, a given store is left open.
+    """
+    opened = store is None
+    if opened:
+        store = ResultsStore(path)
+    try:
+        data = np.array(store.zone_masks(), dtype=np.int64).reshape(-1, 5)
+    finally:
+        if opened:
+            store.close()
+    return Responses(data[:, 0].astype(np.int32), data[:, 1].astype(np.int32), data[:, 2].astype(np.int8),
+                     data[:, 3].astype(np.int8), data[:, 4].astype(np.uint16))
+
+
+def zone_bits(zones: np.ndarray) -> np.ndarray:
+    """(N, NUM_ZONES) 0/1 matrix of the zones in each bitmask"""
+    return ((zones[:, None].astype(np.int64) >> np.arange(NUM_ZONES)) & 1).astype(np.int64)
+
+
+def _group(*keys: np.ndarray):
+    """Unique key combinations and the group of every row"""
+    stacked = np.stack([key.astype(np.int64) for key in keys], axis=1)
+    unique, inverse = np.unique(stacked, axis=0, return_inverse=True)
+    return unique, inverse.reshape(-1)
+
+
+def pair_probabilities(responses: Responses) -> PairTable:
+    """Per electrode pair the number of stimuli and the probability of each zone being marked
+
+    :return: pairs (P, 2) cathode and anode, counts (P,), probabilities (P, NUM_ZONES) in ZONES order
+    """
+    pairs, inverse = _group(responses.cathode, responses.anode)
+    counts = np.bincount(inverse, minlength=len(pairs))
+    index = inverse[:, None] * NUM_ZONES + np.arange(NUM_ZONES)
+    sums = np.bincount(index.ravel(), weights=zone_bits(responses.zones).ravel(), minlength=len(pairs) * NUM_ZONES)
+    return PairTable(pairs, counts, sums.reshape(-1, NUM_ZONES) / counts[:, None])
+
+
+def thresholds(responses: Responses, zone: Optional[str] = None, rate: float = 0.5) -> tuple:
+    """Per electrode pair the lowest amplitude at which at least rate of the stimuli were felt
+
+    :param zone: only count stimuli felt in this zone, any zone on the hand by default
+    :return: pairs (P, 2) and thresholds (P,) in device units, NaN where no amplitude reached the rate
+    """
+    mask = FELT_BITS if zone is None else 1 << ZONES.index(zone)
+    felt = (responses.zones & mask) != 0
+    pairs, pair_inverse = _group(responses.cathode, responses.anode)
+    levels, level_inverse = _group(pair_inverse, responses.amplitude)
+    counts = np.bincount(level_inverse, minlength=len(levels))
+    felt_rate = np.bincount(level_inverse, weights=felt, minlength=len(levels)) / counts
+    result = np.full(len(pairs), np.inf)
+    reached = felt_rate >= rate
+    np.minimum.at(result, levels[reached, 0], levels[reached, 1].astype(float))
+    result[np.isinf(result)] = np.nan
+    return pairs, result
+
+
+def consistency(responses: Responses) -> tuple:
+    """How similar the zones marked for each electrode pair are between sessions
+
+    The zone probabilities of every session are compared to the pooled ones with cosine similarity, 1 means every
+    session gave the same map. Pairs stimulated in a single session get NaN.
+    :return: pairs (P, 2), consistency (P,) and the number of sessions per pair (P,)
+    """
+    pairs, pair_inverse = _group(responses.cathode, responses.anode)
+    groups, group_inverse = _group(pair_inverse, responses.session)
+    bits = zone_bits(responses.zones)
+
+    def probabilities(inverse, size):
+        counts = np.bincount(inverse, minlength=size)
+        index = inverse[:, None] * NUM_ZONES + np.arange(NUM_ZONES)
+        sums = np.bincount(index.ravel(), weights=bits.ravel(), minlength=size * NUM_ZONES)
+        return sums.reshape(-1, NUM_ZONES) / counts[:, None]
+
+    pooled = probabilities(pair_inverse, len(pairs))
+    per_session = probabilities(group_inverse, len(groups))
+    reference = pooled[groups[:, 0]]
+    norms = np.linalg.norm(per_session, axis=1) * np.linalg.norm(reference, axis=1)
+    similarity = np.divide((per_session * reference).sum(axis=1), norms, out=np.zeros(len(groups)), where=norms > 0)
+    sessions = np.bincount(groups[:, 0], minlength=len(pairs))
+    mean = np.bincount(groups[:, 0], weights=similarity, minlength=len(pairs)) / sessions
+    mean[sessions < 2] = np.nan
+    return pairs, mean, sessions
+
+
+def zone_adjacency(directory: str = "./hand_zones", distance: float = 10.0) -> np.ndarray:
+    """(NUM_ZONES, NUM_ZONES) boolean matrix of hand zones whose outlines come within distance pixels"""
+    outlines = {}
+    for fname in os.listdir(directory):
+        outlines[fname[0:-4]] = np.loadtxt(os.path.join(directory, fname), delimiter=",", ndmin=2)
+    adjacency = np.zeros((NUM_ZONES, NUM_ZONES), dtype=bool)
+    for i, a in enumerate(ZONES):
+        for j in range(i + 1, NUM_ZONES):
+            b = ZONES[j]
+            if a not in outlines or b not in outlines:
+                continue
+            gaps = np.linalg.norm(outlines[a][:, None, :] - outlines[b][None, :, :], axis=2)
+            adjacency[i, j] = adjacency[j, i] = gaps.min() <= distance
+    return adjacency
+
+
+def confusion(responses: Responses) -> np.ndarray:
+    """(NUM_ZONES, NUM_ZONES) matrix, row a column b is the share of stimuli marked in b for electrode pairs
+    whose most likely zone is a
+
+    Rows of zones that are no pair's most likely zone are zero. Mask with zone_adjacency for the confusion
+    between neighbouring zones.
+    """
+    table = pair_probabilities(responses)
+    _, inverse = _group(responses.cathode, responses.anode)
+    dominant = np.argmax(table.probabilities, axis=1)[inverse]
+    index = dominant[:, None] * NUM_ZONES + np.arange(NUM_ZONES)
+    marked = np.bincount(index.ravel(), weights=zone_bits(responses.zones).ravel(), minlength=NUM_ZONES * NUM_ZONES)
+    stimuli = np.bincount(dominant, minlength=NUM_ZONES)
+    return np.divide(marked.reshape(NUM_ZONES, NUM_ZONES), stimuli[:, None],
+                     out=np.zeros((NUM_ZONES, NUM_ZONES)), where=stimuli[:, None] > 0)
+
+
+def neighbour_confusion(responses: Responses, adjacency: Optional[np.ndarray] = None) -> list:
+    """(zone, neighbouring zone, share) for every pair of adjacent zones confused at least once, largest first"""
+    if adjacency is None:
+        adjacency = zone_adjacency()
+    matrix = confusion(responses)
+    rows, cols = np.nonzero(adjacency & (matrix > 0))
+    order = np.argsort(-matrix[rows, cols])
+    return [(ZONES[rows[k]], ZONES[cols[k]], float(matrix[rows[k], cols[k]])) for k in order]
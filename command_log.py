@@ -0,0 +1,95 @@
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Optional, TextIO
+
+
+class CommandLog:
+    """Structured log of every frame sent to the device, formatted and written off the command path
+
+    The command path only puts a tuple of raw values into a bounded queue, a background thread turns them into
+    JSON lines. When the writer falls behind the queue fills up and records are dropped instead of blocking
+    the serial link, the number of dropped records is written to the log as a 'dropped' record.
+
+    :param output: file to write JSON lines to, or None to forward the records to the logging module at debug level
+    :param max_queued: maximum number of records waiting for the writer
+    :param flush_interval: seconds between flushes of the output file
+    """
+
+    def __init__(self, output: Optional[TextIO] = None, max_queued: int = 10000, flush_interval: float = 0.5):
+        self.output = output
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._records = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, name="command-log", daemon=True)
+        self._thread.start()
+
+    def record(self, event: str, frame: bytes = b'', response: str = '', seconds: Optional[float] = None):
+        """Queue a record without blocking, called on the thread that talks to the device"""
+        try:
+            self._records.put_nowait((time.time(), event, frame, response, seconds))
+        except queue.Full:
+            self.dropped += 1
+
+    def command(self, cmd: bytes, response: str, seconds: float):
+        """Command listener for Controller.add_command_listener"""
+        self.record('command', cmd, response, seconds)
+
+    def close(self):
+        """Write the queued records and stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        # Blocking put so the sentinel is not lost when the queue is full
+        self._records.put(None)
+        self._thread.join()
+
+    def _format(self, t: float, event: str, frame: bytes, response: str, seconds: Optional[float]) -> str:
+        record = {'event': event, 't': round(t, 6)}
+        if frame:
+            record['frame'] = frame.hex()
+        if event == 'command':
+            record['response'] = response
+            record['ok'] = response == ">OK<"
+        elif response:
+            record['response'] = response
+        if seconds is not None:
+            record['ms'] = round(seconds * 1000, 3)
+        return json.dumps(record)
+
+    def _write(self, line: str):
+        if self.output is None:
+            logging.debug(line)
+        else:
+            self.output.write(line + "\n")
+        self.written += 1
+
+    def _report_dropped(self):
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            count = dropped - self._reported_dropped
+            self._reported_dropped = dropped
+            logging.warning("Command log fell behind, dropped {} records".format(count))
+            self._write(json.dumps({'event': 'dropped', 't': round(time.time(), 6), 'count': count}))
+
+    def _run(self):
+        last_flush = time.perf_counter()
+        while True:
+            try:
+                item = self._records.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self._write(self._format(*item))
+            self._report_dropped()
+            if self.output is not None and time.perf_counter() - last_flush >= self.flush_interval:
+                self.output.flush()
+                last_flush = time.perf_counter()
+        self._report_dropped()
+        if self.output is not None:
+            self.output.flush()
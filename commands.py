@@ -0,0 +1,164 @@
+import logging
+from typing import Callable, Optional, Tuple
+
+from controller import Controller
+from ramp import Ramp, RampResult
+
+
+def _input_func(command: str, params: list, device_func: Callable) -> Tuple[bool, str]:
+    try:
+        succ = device_func(*params)
+        if succ:
+            out = command
+        else:
+            # setters are bound to the controller, which knows why the last command failed
+            device = getattr(device_func, '__self__', None)
+            reason = getattr(device, 'last_failure', None) or "unknown reason"
+            out = "Command: {}, failed: {}".format(command, reason)
+    except ValueError as e:
+        logging.debug(e)
+        succ = False
+        out = "Error: {}".format(e)
+
+    return succ, out
+
+
+def ramp_result(command: str, result: RampResult) -> Tuple[bool, str]:
+    """Whether every ramp value was acknowledged and a message describing the ramp"""
+    return result.failed == 0, "{}: sent {} values, dropped {}, {:.1f}ms late".format(
+        command, result.sent, result.dropped, result.late * 1000)
+
+
+def run_command(device: Controller, text: str,
+                start_ramp: Optional[Callable[[Ramp, str], None]] = None) -> Tuple[bool, str]:
+    """Run one text command (same syntax as the TUI prompt and command files)
+
+    Ramps run on the calling thread unless start_ramp is given, it is then called with the ramp and the command
+    to run the ramp in the background and the command returns right away.
+
+    :return: whether the device acknowledged the command and a message describing the result
+    """
+    ok = False
+    try:
+        out = text.lower()
+        parts = text.split()
+        cmd = parts[0]
+        params = parts[1:]
+        if cmd == 'battery':
+            ok = device.read_battery() != -1
+        elif cmd == 'mode':
+            if len(params) == 1:
+                ok, out = _input_func(out, params, device.set_mode)
+            else:
+                out = "Mode command requires one parameter"
+        elif cmd == 'range':
+            if len(params) == 1:
+                ok, out = _input_func(out, params, device.set_current_range)
+            else:
+                out = "Current range command requires one parameter"
+        elif cmd == 'voltage':
+            if len(params) == 1:
+                new_params = [int(params[0])]
+                ok, out = _input_func(out, new_params, device.set_voltage)
+            else:
+                out = "Voltage command requires one parameter"
+        elif cmd == 'dc':
+            if len(params) == 0:
+                ok, out = _input_func(out, params, device.toggle_pulse_generator)
+            elif len(params) == 1:
+                params = [params[0].lower() == 'on']
+                ok, out = _input_func(out, params, device.set_pulse_generator)
+            else:
+                out = "Dc: too many parameters, expected 0 or 1"
+        elif cmd == 'trigger':
+            if len(params) == 0:
+                ok, out = _input_func(out, params, device.trigger_pulse_generator)
+            else:
+                out = "Trigger: Too many parameters, expected 0"
+        elif cmd == 'nplets':
+            if len(params) == 1:
+                new_params = [int(params[0])]
+                ok, out = _input_func(out, new_params, device.set_num_nplets)
+            else:
+                out = "Number of n-plets: incorrent number of parameters, expected one"
+        elif cmd == 'time_between':
+            if len(params) == 1:
+                new_params = [int(params[0])]
+                ok, out = _input_func(out, new_params, device.set_time_between)
+            else:
+                out = "Time between: incorrent number of parameters, expected one"
+        elif cmd == 'repetition_rate':
+            if len(params) == 1:
+                new_params = [int(params[0])]
+                ok, out = _input_func(out, new_params, device.set_repetition_rate)
+            else:
+                out = "Repetition rate: incorrent number of parameters, expected one"
+        elif cmd == 'delay':
+            if len(params) == 1:
+                new_params = [int(params[0])]
+                ok, out = _input_func(out, new_params, device.set_delay)
+            else:
+                out = "Delay: incorrent number of parameters, expected one"
+        elif cmd == 'widths':
+            if 0 <= len(params) <= 24:
+                new_params = [[int(i) for i in params]]
+                ok, out = _input_func(out, new_params, device.set_pulse_width)
+            else:
+                out = "widths: incorrect number of parameters"
+        elif cmd == 'amplitudes':
+            if 0 <= len(params) <= 24:
+                new_params = [[int(i) for i in params]]
+                ok, out = _input_func(out, new_params, device.set_amplitude)
+            else:
+                out = "amplitudes: incorrect number of parameters"
+        elif cmd == 'output':
+            if 0 <= len(params) <= 24:
+                new_params = []
+                for pulse in params:
+                    channels = pulse.split(',')
+                    new_channels = [int(i) for i in channels]
+                    new_params.append(new_channels)
+                ok, out = _input_func(out, [new_params], device.set_pulses_unipolar)
+            else:
+                out = "outputs: incorrect number of parameters"
+        elif cmd == 'pairs':
+            if 0 <= len(params) <= 24:
+                new_params = []
+                for pulse in params:
+                    pair = pulse.split(';')
+
+                    p1 = [int(i) for i in pair[0].split(',')]
+                    p2 = [int(i) for i in pair[1].split(',')]
+                    new_params.append((p1, p2))
+                logging.debug(new_params)
+                ok, out = _input_func(out, [new_params], device.set_pulses_bipolar)
+            else:
+                out = "pairs: incorrect number of parameters"
+        elif cmd == 'ramp':
+            if len(params) in (4, 5):
+                try:
+                    ramp = Ramp(device, params[0], int(params[1]), int(params[2]), float(params[3]),
+                                params[4] if len(params) == 5 else 'linear')
+                    if start_ramp is not None:
+                        start_ramp(ramp, out)
+                        ok = True
+                        out = "{}: started".format(out)
+                    else:
+                        ok, out = ramp_result(out, ramp.run())
+                except ValueError as e:
+                    logging.debug(e)
+                    out = "Error: {}".format(e)
+            else:
+                out = "Ramp: incorrect number of parameters, expected 4 or 5"
+        elif cmd == 'electrode':
+            if len(params) == 1:
+                ok, out = _input_func(out, params, device.set_common_electrode)
+            else:
+                out = "Electrode: incorrent number of parameters, expected one"
+        else:
+            out = "Command not found: {}".format(out)
+
+        return ok, out
+    except Exception as e:
+        logging.error(e)
+        return False, "Something went wrong, please try again. Command used: {}".format(text)
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from controller import Controller
+from shadow_state import ShadowState
+
+# Connection states reported to on_status
+CONNECTED = 'connected'
+LOST = 'lost'
+RECONNECTING = 'reconnecting'
+
+
+class ConnectionSupervisor:
+    """Reconnects the controller in the background when the serial or rfcomm link drops
+
+    The controller reports a lost link on any I/O error, the supervisor then reopens the port with exponential
+    backoff. Once it is back the state-critical parameters are sent again from the shadow state before any
+    waiting command goes out.
+
+    :param hold: seconds commands wait for the link to come back before they fail, 0 fails them right away
+    :param startup: called with the device on the first connect if the port could not be opened at start, so the
+        settings the program starts with are sent once the device is there. Until the device has acknowledged
+        something there is nothing to resync.
+    :param on_status: called with (state, text) whenever the connection state changes, from the supervisor
+        thread or the thread that hit the I/O error
+    """
+
+    def __init__(self, device: Controller, shadow: Optional[ShadowState] = None, hold: float = 0.0,
+                 initial_delay: float = 0.5, max_delay: float = 30.0,
+                 on_status: Optional[Callable[[str, str], None]] = None,
+                 startup: Optional[Callable[[Controller], None]] = None):
+        self.device = device
+        self.startup = startup
+        # the caller sends its startup settings itself when the port is already open
+        self._started = device.connected
+        self.shadow = shadow
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.on_status = on_status
+        self.state = CONNECTED if device.connected else LOST
+        self.attempts = 0
+        self.reconnects = 0
+        self.resync_failed = []
+        self.text = self._describe()
+        device.hold_timeout = hold
+        self._lost = threading.Event()
+        self._stopped = threading.Event()
+        device.add_link_listener(self._link_changed)
+        if not device.connected:
+            self._lost.set()
+        self._thread = threading.Thread(target=self._run, name="connection-supervisor", daemon=True)
+        self._thread.start()
+
+    def _describe(self, delay: float = 0.0) -> str:
+        if self.state == CONNECTED:
+            if self.resync_failed:
+                return "Connected, resync failed for {}".format(", ".join(self.resync_failed))
+            return "Connected"
+        if self.state == RECONNECTING:
+            return "Link lost, reconnecting (attempt {}, next in {:.1f}s)".format(self.attempts, delay)
+        return "Link lost"
+
+    def _set_state(self, state: str, delay: float = 0.0):
+        self.state = state
+        self.text = self._describe(delay)
+        if self.on_status is not None:
+            self.on_status(state, self.text)
+
+    def _link_changed(self, connected: bool):
+        if connected:
+            return
+        self._set_state(LOST)
+        self._lost.set()
+
+    def _resync(self):
+        if not self._started:
+            self._started = True
+            if self.startup is not None:
+                self.startup(self.device)
+                return
+        if not self.device.acknowledged:
+            logging.info("Nothing acknowledged by {} yet, nothing to resync".format(self.device.port))
+            return
+        if self.shadow is not None:
+            self.resync_failed = self.shadow.resync()
+
+    def stop(self):
+        self._stopped.set()
+        self._lost.set()
+        self.device.remove_link_listener(self._link_changed)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._lost.wait()
+            if self._stopped.is_set():
+                break
+            self._lost.clear()
+            delay = self.initial_delay
+            self.attempts = 0
+            start = time.perf_counter()
+            while not self._stopped.is_set():
+                self.attempts += 1
+                if self.device.connect(on_connected=self._resync) and self.device.connected:
+                    self.reconnects += 1
+                    logging.warning("Reconnected to {} after {} attempts in {:.2f}s".format(
+                        self.device.port, self.attempts, time.perf_counter() - start))
+                    self._set_state(CONNECTED)
+                    break
+                self._set_state(RECONNECTING, delay)
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_delay)
@@ -1,17 +1,52 @@
 import logging
+import threading
 import time
-from typing import List, Tuple
+from collections import deque, namedtuple
+from typing import Callable, List, Tuple
 
 import serial
 
+from command_log import CommandLog
+from flow import FlowController
+from profiling import profiled, span
+
+StopReport = namedtuple('StopReport', ['acknowledged', 'latency', 'commands'])
+RecoveryReport = namedtuple('RecoveryReport', ['command', 'failures', 'recovered', 'seconds'])
+
+# Why a command was not acknowledged, see Controller.classify_response
+NO_REPLY = 'no reply'
+GARBLED = 'garbled reply'
+NACK = 'rejected by the device'
+
+# Commands whose effect depends on the device state, sending them twice is not the same as sending them once
+NON_IDEMPOTENT = (b'>T<',)
+
+# Attributes mirroring the device state, listeners are notified when any of these is assigned
+STATE_FIELDS = ('current_range', 'voltage', 'pulse_generator_dc_converter_status', 'num_nplets', 'time_between',
+                'delay', 'pulse_generator_triggered', 'battery_state', 'repetition_rate', 'pulse_widths',
+                'pulse_amplitudes', 'mode', 'common_electrode', 'output_channels', 'channel_pairs',
+                'is_short_protocol')
+
 
 class Controller:
 
     def __init__(self, device, baud_rate=921600, data_bits=serial.EIGHTBITS, parity=serial.PARITY_NONE,
-                 stop_bits=serial.STOPBITS_ONE, rtscts=True, logging_level=logging.WARNING, log_file=""):
-        """ Initialize the controller"""
+                 stop_bits=serial.STOPBITS_ONE, rtscts=True, logging_level=logging.WARNING, log_file="",
+                 max_window=4, command_log: CommandLog = None, max_retries=2, retry_budget=2.0):
+        """ Initialize the controller
+
+        Frames and responses go to command_log, when it is not given they are only logged at debug level.
+        Commands that get no reply or a garbled one are resent up to max_retries times if they are idempotent
+        and retry_budget seconds have not passed since the first attempt.
+        """
         logging.basicConfig(filename=log_file, level=logging_level)
 
+        self.port = device
+        self._state_listeners = []
+        self._command_listeners = []
+        self._link_listeners = []
+        self._recovery_listeners = []
+
         self.current_range = 'high'  # high or low
         self.voltage = 150  # range 70V - 150V
         self.pulse_generator_dc_converter_status = False
@@ -28,27 +63,113 @@ class Controller:
         self.output_channels = []
         self.channel_pairs = []
         self.is_short_protocol = False
+        # State fields assigned since the defaults above, setters only assign what the device acknowledged
+        self.acknowledged = set()
+
+        # Serializes write + response read pairs between threads (GUI, sweep worker, stop button)
+        self._io_lock = threading.RLock()
+        # Set while an emergency stop is waiting for the link, regular commands are dropped meanwhile
+        self._stop_requested = threading.Event()
+        # Tunes how many commands send_pipelined keeps in flight from the observed ACK latency
+        self.flow = FlowController(max_window=max_window)
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        # Reason the last failed command failed, None if it succeeded
+        self.last_failure = None
+        self.recoveries = deque(maxlen=1000)
+        # Formatting frames on the command path costs more than the frame takes on USB, so it is done in the background
+        if command_log is None and logging.getLogger().isEnabledFor(logging.DEBUG):
+            command_log = CommandLog()
+        self.command_log = command_log
+        if command_log is not None:
+            self._command_listeners.append(command_log.command)
+
+        self._serial_options = dict(baudrate=baud_rate, timeout=5, parity=parity, rtscts=rtscts, stopbits=stop_bits,
+                                    bytesize=data_bits)
+        self.serial_ = None
+        self.connected = False
+        # Set while the link is up, commands wait up to hold_timeout seconds for it before failing
+        self._link_up = threading.Event()
+        self.hold_timeout = 0.0
+
+        if not self.connect():
+            print("Error connecting to serial port")
 
-        try:
-            self.serial_ = serial.Serial(device, baud_rate, timeout=5, parity=parity, rtscts=rtscts, stopbits=stop_bits,
-                                         bytesize=data_bits)
+    def connect(self, on_connected: Callable[[], None] = None) -> bool:
+        """Open the serial port, returns False if it can't be opened
+
+        :param on_connected: called once the port is open, before commands waiting for the link are let through
+        """
+        with self._io_lock:
+            try:
+                ser = serial.Serial(self.port, **self._serial_options)
+            except serial.SerialException as e:
+                logging.error(e)
+                return False
+            self.serial_ = ser
 
             # The device seems to establish the connection little slowly,
             # so just some test read before starting actual commands.
             # The device when using Bluetooth connection sends random 'g' on new connections
             try:
                 res = self.serial_.read(10)
-                logging.debug("{}, {}, {}".format(res, len(res), int.from_bytes(res, byteorder="big")))
+                logging.debug("Initial read %s, %d bytes", res, len(res))
             except serial.SerialException as e:
                 print("Initial test read failed")
                 logging.error(e)
 
-        except serial.SerialException as e:
-            print("Error connecting to serial port")
-            logging.error(e)
-            exit(0)
+            self.connected = True
+            self._link_up.set()
+            # Waiting commands need the io lock, so they only go out after on_connected
+            if on_connected is not None:
+                on_connected()
+        for listener in self._link_listeners:
+            listener(True)
+        return True
+
+    def _link_lost(self, error: Exception):
+        """Mark the link down after an I/O error, caller must hold the io lock"""
+        if not self.connected:
+            return
+        logging.error("Lost connection to {}: {}".format(self.port, error))
+        self.connected = False
+        self._link_up.clear()
+        try:
+            self.serial_.close()
+        except (serial.SerialException, OSError):
+            pass
+        for listener in self._link_listeners:
+            listener(False)
+
+    def _wait_for_link(self, cmd) -> bool:
+        if self._link_up.is_set():
+            return True
+        if self.hold_timeout and self._link_up.wait(self.hold_timeout):
+            return True
+        logging.warning("Link to {} is down, dropped command {}".format(self.port, cmd))
+        self.last_failure = "link to the device is down"
+        return False
+
+    def add_link_listener(self, listener: Callable[[bool], None]):
+        """Call listener(connected) when the link to the device is lost or (re)established
+
+        Listeners may be called with the io lock held, they should only record the change.
+        """
+        self._link_listeners.append(listener)
+
+    def remove_link_listener(self, listener: Callable[[bool], None]):
+        self._link_listeners.remove(listener)
+
+    def add_recovery_listener(self, listener: Callable[[RecoveryReport], None]):
+        """Call listener(report) after every command that failed at first, whether it was recovered or not"""
+        self._recovery_listeners.append(listener)
+
+    def remove_recovery_listener(self, listener: Callable[[RecoveryReport], None]):
+        self._recovery_listeners.remove(listener)
 
     def __del__(self):
+        if self.__dict__.get('serial_') is None:
+            return
         try:
             self.serial_.close()
         except serial.SerialException as e:
@@ -57,6 +178,14 @@ class Controller:
             exit(0)
 
     def close_serial(self):
+        if self.command_log is not None:
+            self.command_log.close()
+        # A closed port is not a lost link, nothing should try to reconnect it
+        self._link_listeners.clear()
+        self.connected = False
+        self._link_up.clear()
+        if self.serial_ is None:
+            return
         try:
             self.serial_.close()
         except serial.SerialException as e:
@@ -64,6 +193,33 @@ class Controller:
             logging.error(e)
             exit(0)
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in STATE_FIELDS:
+            acknowledged = self.__dict__.get('acknowledged')
+            if acknowledged is not None:
+                acknowledged.add(name)
+            for listener in self.__dict__.get('_state_listeners', ()):
+                listener(name, value)
+
+    def add_state_listener(self, listener: Callable[[str, object], None]):
+        """Call listener(field, value) whenever a state field changes
+
+        Listeners are called on the thread that talks to the device, so they should only record the change
+        and leave any rendering to the UI thread.
+        """
+        self._state_listeners.append(listener)
+
+    def remove_state_listener(self, listener: Callable[[str, object], None]):
+        self._state_listeners.remove(listener)
+
+    def add_command_listener(self, listener: Callable[[bytes, str, float], None]):
+        """Call listener(command, response, round-trip seconds) after every command sent to the device"""
+        self._command_listeners.append(listener)
+
+    def remove_command_listener(self, listener: Callable[[bytes, str, float], None]):
+        self._command_listeners.remove(listener)
+
     @staticmethod
     def _res_to_bool(res):
         return res == ">OK<"
@@ -81,6 +237,11 @@ class Controller:
 
         return cmd
 
+    @staticmethod
+    def nplet_duration(pulse_widths: List[int], time_between: int) -> float:
+        """Duration of one n-plet in seconds"""
+        return sum(pulse_widths) * 10 ** -6 + (len(pulse_widths) - 1) * time_between * 10 ** -3
+
     def check_nplet_parameter_validity(self, pulse_widths=None, time_between=None, repetition_rate=None) -> bool:
         if pulse_widths is None:
             pulse_widths = self.pulse_widths
@@ -88,7 +249,7 @@ class Controller:
             time_between = self.time_between
         if repetition_rate is None:
             repetition_rate = self.repetition_rate
-        t1 = sum(pulse_widths) * 10 ** -6 + (len(pulse_widths) - 1) * time_between * 10 ** -3
+        t1 = self.nplet_duration(pulse_widths, time_between)
         t2 = 1 / repetition_rate
         return t1 <= t2
 
@@ -115,14 +276,192 @@ Device state (Battery: {}%):
                    self.pulse_widths, self.pulse_amplitudes, self.is_short_protocol)
 
     def send_command(self, cmd: bytes) -> bool:
-        logging.debug(cmd)
+        if self._stop_requested.is_set():
+            logging.warning("Emergency stop in progress, dropped command {}".format(cmd))
+            return False
+        if not self._wait_for_link(cmd):
+            return False
+        with self._io_lock:
+            # The stop may have been requested while waiting for the previous command
+            if self._stop_requested.is_set():
+                logging.warning("Emergency stop in progress, dropped command {}".format(cmd))
+                return False
+            res = self._transact(cmd)
+            if not self._res_to_bool(res):
+                res = self._recover(cmd, res)
+
+        return self._res_to_bool(res)
+
+    @staticmethod
+    def classify_response(res: str) -> str:
+        """Failure class of a response that is not >OK<
+
+        Only a single well formed frame is a rejection, a partial reply run into the next one (e.g. >O>OK<) is
+        garbled and recovered like any other corruption.
+        """
+        if not res:
+            return NO_REPLY
+        if res.startswith('>') and res.endswith('<') and res.count('>') == 1 and res.count('<') == 1:
+            return NACK
+        return GARBLED
+
+    def _resync_input(self):
+        """Drop stray bytes until the link has been quiet for a moment, so late replies to a failed command
+        are not taken as the reply to the next one. Caller must hold the io lock"""
+        quiet = min(max(self.flow.srtt or 0.01, 0.001), 0.05)
+        try:
+            for _ in range(3):
+                self.serial_.reset_input_buffer()
+                time.sleep(quiet)
+                if not self.serial_.in_waiting:
+                    break
+        except (serial.SerialException, OSError) as e:
+            self._link_lost(e)
+
+    def _recover(self, cmd: bytes, res: str, resync: bool = True) -> str:
+        """Resynchronize the input after a failed command and resend it if that is safe
+
+        Caller must hold the io lock. Rejected commands are not resent, they would be rejected again.
+        :return: response of the last attempt
+        """
+        start = time.perf_counter()
+        failures = [self.classify_response(res)]
+        if resync and self.connected:
+            self._resync_input()
+        if failures[0] != NACK and cmd not in NON_IDEMPOTENT:
+            timeout = self.serial_.timeout
+            # retries wait as long as an ACK is expected to take, not the full port timeout
+            self.serial_.timeout = self.flow.timeout()
+            try:
+                while (len(failures) <= self.max_retries and self.connected and not self._stop_requested.is_set()
+                       and time.perf_counter() - start < self.retry_budget):
+                    res = self._transact(cmd)
+                    if self._res_to_bool(res):
+                        break
+                    failures.append(self.classify_response(res))
+                    self._resync_input()
+            finally:
+                if self.serial_ is not None:
+                    self.serial_.timeout = timeout
+
+        recovered = self._res_to_bool(res)
+        report = RecoveryReport(cmd, failures, recovered, time.perf_counter() - start)
+        self.recoveries.append(report)
+        if recovered:
+            self.last_failure = None
+            logging.warning("Command {} recovered after {} in {:.1f}ms".format(
+                cmd, ", ".join(failures), report.seconds * 1000))
+        else:
+            self.last_failure = failures[-1]
+            if cmd in NON_IDEMPOTENT and failures[-1] == NO_REPLY:
+                # the command may have reached the device with only the ACK lost
+                self.last_failure = "no reply, the device may or may not have executed it"
+            logging.warning("Command {} failed: {}".format(cmd, ", ".join(failures)))
+        for listener in self._recovery_listeners:
+            listener(report)
+        return res
+
+    def recovery_stats(self) -> dict:
+        """Number of failed commands, how many were recovered and the time recovery took"""
+        recovered = [report for report in self.recoveries if report.recovered]
+        return {'failed': len(self.recoveries), 'recovered': len(recovered),
+                'retries': sum(len(report.failures) for report in recovered),
+                'seconds': sum(report.seconds for report in self.recoveries)}
+
+    def _transact(self, cmd: bytes) -> str:
+        """Write a command and read its response, caller must hold the io lock"""
+        if not self.connected:
+            return ""
         start = time.time()
-        self.serial_.write(cmd)
-        res = self.read_response_()
+        try:
+            with span('write'):
+                self.serial_.write(cmd)
+            self.flow.on_write(len(cmd))
+            with span('wait'):
+                res = self.read_response_()
+        except (serial.SerialException, OSError) as e:
+            self._link_lost(e)
+            res = ""
         end = time.time()
-        logging.info(end - start)
+        with span('parse'):
+            self._record_response(cmd, res, end - start)
+        return res
 
-        return self._res_to_bool(res)
+    def _record_response(self, cmd: bytes, res: str, latency: float):
+        if res.startswith('>') and res.endswith('<'):
+            self.flow.on_ack(latency, len(cmd))
+        else:
+            self.flow.on_failure(len(cmd), garbled=bool(res))
+        for listener in self._command_listeners:
+            listener(cmd, res, latency)
+
+    def send_pipelined(self, frames: List[bytes]) -> List[bool]:
+        """Send frames keeping up to flow.window of them in flight, responses are matched in sending order
+
+        When a reply is missing or garbled it can't be told which frame lost its reply, so every frame whose
+        reply was read while the failed frame was in flight is treated as unknown. Frames that were not
+        acknowledged are recovered one at a time once the batch is done.
+        :return: for each frame whether the device acknowledged it
+        """
+        # response to each frame, empty when it was lost or its outcome is unknown
+        responses = []
+        if self._stop_requested.is_set() or not self._wait_for_link(frames):
+            return [False] * len(frames)
+        with self._io_lock:
+            if not self.connected:
+                return [False] * len(frames)
+            timeout = self.serial_.timeout
+            self.serial_.timeout = self.flow.timeout()
+            pending = deque(frames)
+            in_flight = deque()
+            # number of frames written when the reply of each frame was read
+            written_at_read = []
+            try:
+                while pending or in_flight:
+                    if self._stop_requested.is_set():
+                        break
+                    if pending and len(in_flight) < self.flow.window:
+                        if in_flight and self.flow.pacing:
+                            time.sleep(self.flow.pacing)
+                        cmd = pending.popleft()
+                        with span('write'):
+                            self.serial_.write(cmd)
+                        self.flow.on_write(len(cmd))
+                        in_flight.append((cmd, time.perf_counter()))
+                        continue
+
+                    cmd, sent = in_flight.popleft()
+                    with span('wait'):
+                        res = self.read_response_()
+                    with span('parse'):
+                        self._record_response(cmd, res, time.perf_counter() - sent)
+                        failed = len(responses)
+                        responses.append(res)
+                        written_at_read.append(len(frames) - len(pending))
+                    if not self._res_to_bool(res) and self.classify_response(res) != NACK:
+                        # The lost reply may belong to any frame in flight with this one, so the replies read
+                        # since this frame was written and the frames still in flight have an unknown outcome
+                        self._resync_input()
+                        first_unknown = next(i for i, written in enumerate(written_at_read) if written > failed)
+                        for i in range(first_unknown, len(responses)):
+                            responses[i] = ""
+                        for lost, _ in in_flight:
+                            self.flow.on_failure(len(lost), garbled=False)
+                        responses.extend([""] * len(in_flight))
+                        written_at_read.extend([0] * len(in_flight))
+                        in_flight.clear()
+            except (serial.SerialException, OSError) as e:
+                self._link_lost(e)
+            finally:
+                if self.serial_ is not None:
+                    self.serial_.timeout = timeout
+            responses.extend([""] * (len(frames) - len(responses)))
+
+            for i, res in enumerate(responses):
+                if self._res_to_bool(res) or not self.connected or self._stop_requested.is_set():
+                    continue
+                responses[i] = self._recover(frames[i], res, resync=False)
+        return [self._res_to_bool(res) for res in responses]
 
     def read_response_(self):
         ser = self.serial_
@@ -135,23 +474,24 @@ Device state (Battery: {}%):
                     break
             else:
                 break
-        logging.debug(res)
         return res
 
     # Common commands
 
-    def set_current_range(self, current_range: str) -> bool:
-        """Sets the current range H for high (up to 100mA) and L for Low (up to 10mA)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_current_range(current_range: str) -> bytes:
         if current_range.lower() == 'high':
             c = 'H'
         elif current_range.lower() == 'low':
             c = 'L'
         else:
             raise ValueError("Current range must be set to 'high' or 'low'. Was set to: {}".format(current_range))
-        cmd = ">SR;{}<".format(c)
-        cmd = self._to_bytes(cmd)
+        return Controller._to_bytes(">SR;{}<".format(c))
 
-        res = self.send_command(cmd)
+    def set_current_range(self, current_range: str) -> bool:
+        """Sets the current range H for high (up to 100mA) and L for Low (up to 10mA)"""
+        res = self.send_command(self.encode_current_range(current_range))
 
         if res:
             self.current_range = current_range.lower()
@@ -160,11 +500,16 @@ Device state (Battery: {}%):
 
         return res
 
-    def set_voltage(self, voltage: int) -> bool:
-        """Sets voltage in volts (value between 70-150)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_voltage(voltage: int) -> bytes:
         if voltage < 70 or voltage > 150:
             raise ValueError("Given voltage is out of range. Voltage must be between 70-150")
-        res = self.send_command(self.command_builder("SV", voltage, 1))
+        return Controller.command_builder("SV", voltage, 1)
+
+    def set_voltage(self, voltage: int) -> bool:
+        """Sets voltage in volts (value between 70-150)"""
+        res = self.send_command(self.encode_voltage(voltage))
         if res:
             self.voltage = voltage
 
@@ -201,34 +546,46 @@ Device state (Battery: {}%):
 
         return res
 
-    def set_num_nplets(self, num: int) -> bool:
-        """Set the number of n-plets to be generated (0 - 16777215)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_num_nplets(num: int) -> bytes:
         if num < 0 or num > 16777215:
             raise ValueError("Number of n-plets (num) must be between 0 and 16777215, was {}".format(num))
+        return Controller.command_builder('SN', num, 4)
 
-        res = self.send_command(self.command_builder('SN', num, 4))
+    def set_num_nplets(self, num: int) -> bool:
+        """Set the number of n-plets to be generated (0 - 16777215)"""
+        res = self.send_command(self.encode_num_nplets(num))
         if res:
             self.num_nplets = num
 
         return res
 
-    def set_time_between(self, time_between: int) -> bool:
-        """Set time between pulses in n-plet (1-255ms)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_time_between(time_between: int) -> bytes:
         if time_between < 1 or time_between > 255:
             raise ValueError("Time between must be between 1 and 255, was {}".format(time_between))
+        return Controller.command_builder('ST', time_between, 1)
 
-        res = self.send_command(self.command_builder('ST', time_between, 1))
+    def set_time_between(self, time_between: int) -> bool:
+        """Set time between pulses in n-plet (1-255ms)"""
+        res = self.send_command(self.encode_time_between(time_between))
         if res:
             self.time_between = time_between
 
         return res
 
-    def set_delay(self, delay: int) -> bool:
-        """Set delay after trigger (0ms - 16777215ms)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_delay(delay: int) -> bytes:
         if delay < 0 or delay > 16777215:
             raise ValueError("Delay must be between 0 and 16777215, was {}".format(delay))
+        return Controller.command_builder('SD', delay, 4)
 
-        res = self.send_command(self.command_builder('SD', delay, 4))
+    def set_delay(self, delay: int) -> bool:
+        """Set delay after trigger (0ms - 16777215ms)"""
+        res = self.send_command(self.encode_delay(delay))
         if res:
             self.delay = delay
 
@@ -242,14 +599,43 @@ Device state (Battery: {}%):
 
         return res
 
+    def send_encoded(self, frames: List[Tuple[str, object, bytes]]) -> List[bool]:
+        """Send frames encoded ahead of time with the encode_* methods
+
+        :param frames: (state field, value, frame) for each command, the field is set once the frame is acknowledged
+        :return: for each frame whether the device acknowledged it
+        """
+        results = self.send_pipelined([frame for _, _, frame in frames])
+        for (field, value, _), res in zip(frames, results):
+            if res:
+                setattr(self, field, value)
+        return results
+
+    def send_timed(self, cmd: bytes) -> Tuple[bool, float, float]:
+        """Send an already encoded command and time it, for latency critical paths
+
+        :return: whether the device acknowledged, time.perf_counter() when the write returned and when the
+            response was read
+        """
+        if self._stop_requested.is_set() or not self._link_up.is_set():
+            return False, time.perf_counter(), time.perf_counter()
+        with self._io_lock:
+            try:
+                self.serial_.write(cmd)
+                written = time.perf_counter()
+                res = self.read_response_()
+            except (serial.SerialException, OSError) as e:
+                self._link_lost(e)
+                written = time.perf_counter()
+                res = ""
+            answered = time.perf_counter()
+        return self._res_to_bool(res), written, answered
+
     def read_battery(self) -> int:
         """Read remaining battery capacity"""
         cmd = ">SOC<"
-        self.serial_.write(self._to_bytes(cmd))
-
-        logging.debug(cmd)
-
-        res = self.read_response_()
+        with self._io_lock:
+            res = self._transact(self._to_bytes(cmd))
         if res.startswith('>SOC;'):
             battery_level = int.from_bytes(self._to_bytes(res[-2]), byteorder="big")
             self.battery_state = battery_level
@@ -257,95 +643,176 @@ Device state (Battery: {}%):
         else:
             return -1
 
+    def emergency_stop(self, settle: Callable[[], None] = None) -> StopReport:
+        """Stop stimulation ahead of any other command
+
+        Commands issued by other threads are dropped until the stop is done, the only thing waited for is the
+        command already on the wire. The DC/DC converter is turned off (>OFF<) and the pulse amplitudes are set to
+        zero. Both work whatever state the device is in, unlike the >T< toggle whose effect depends on the pulse
+        generation state we can't read back. The link is flushed so the controller stays usable afterwards.
+
+        :param settle: called after the stop commands while other commands are still dropped, e.g. to wait for
+            aborted sweep workers so none of their commands go out after the stop
+        :return: StopReport with whether the device acknowledged the stop, the time from the call to the
+            acknowledgement of the first stop command in seconds and the frames sent, decoded as latin-1
+        """
+        start = time.perf_counter()
+        latency = None
+        commands = []
+        self._stop_requested.set()
+        try:
+            with self._io_lock:
+                if not self.connected:
+                    raise serial.SerialException("Link to {} is down".format(self.port))
+                # drop frames not yet transmitted and responses of preempted commands
+                self.serial_.reset_output_buffer()
+                self.serial_.reset_input_buffer()
+
+                # Converter off first, it stops the output regardless of the pulse generator state
+                acknowledged = self._res_to_bool(self._transact(self._to_bytes(">OFF<")))
+                commands.append(">OFF<")
+                if acknowledged:
+                    latency = time.perf_counter() - start
+                    self.pulse_generator_dc_converter_status = False
+
+                zero = self.encode_amplitudes([0])
+                res = self._res_to_bool(self._transact(zero))
+                commands.append(zero.decode('latin-1'))
+                if res:
+                    self.pulse_amplitudes = [0]
+                    if latency is None:
+                        latency = time.perf_counter() - start
+                acknowledged = acknowledged or res
+
+                self.serial_.reset_input_buffer()
+        except serial.SerialException as e:
+            with self._io_lock:
+                self._link_lost(e)
+            logging.error(e)
+            acknowledged = False
+        finally:
+            try:
+                if settle is not None:
+                    settle()
+            finally:
+                self._stop_requested.clear()
+
+        if acknowledged:
+            logging.warning("Emergency stop acknowledged in {:.1f}ms".format(latency * 1000))
+        else:
+            logging.error("Emergency stop was not acknowledged by the device")
+
+        return StopReport(acknowledged, latency, commands)
+
     # long protocol
 
-    def set_repetition_rate(self, num: int = 50) -> bool:
-        """Set n-plet repetition rate (1-400)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_repetition_rate(num: int) -> bytes:
         if num < 1 or num > 400:
             raise ValueError("Repetition rate (num) must be between 1-400, was {}".format(num))
+        return Controller.command_builder('SF', num, 2)
 
-        res = self.send_command(self.command_builder('SF', num, 2))
+    def set_repetition_rate(self, num: int = 50) -> bool:
+        """Set n-plet repetition rate (1-400)"""
+        res = self.send_command(self.encode_repetition_rate(num))
         if res:
             self.repetition_rate = num
         return res
 
-    def set_pulse_width(self, widths: List[int]):
-        """Set pulse width for every pulse in n-plet (50 - 1000 microseconds)"""
+    @staticmethod
+    @profiled('encode')
+    def encode_pulse_widths(widths: List[int]) -> bytes:
         if not all(50 <= i <= 1000 or i == 0 for i in widths):
             raise ValueError("Pulse widths must be between 50 and 1000")
 
         w_pad = widths + (24 - len(widths)) * [0]
-        cmd = self._to_bytes('>PW;')
+        cmd = Controller._to_bytes('>PW;')
 
         for idx, num in enumerate(w_pad):
             cmd += num.to_bytes(2, byteorder='big')
 
-        cmd += self._to_bytes('<')
+        cmd += Controller._to_bytes('<')
+        return cmd
 
-        res = self.send_command(cmd)
+    def set_pulse_width(self, widths: List[int]):
+        """Set pulse width for every pulse in n-plet (50 - 1000 microseconds)"""
+        res = self.send_command(self.encode_pulse_widths(widths))
         if res:
             self.pulse_widths = widths
 
         return res
 
-    def set_amplitude(self, amplitudes: List[int]) -> bool:
-        """Set amplitude of the pulses in n-plet (0 - 1000) unit: w/10 or w/100"""
+    @staticmethod
+    @profiled('encode')
+    def encode_amplitudes(amplitudes: List[int]) -> bytes:
         if not all(0 <= i <= 1000 for i in amplitudes):
             raise ValueError("Pulse amplitudes must be between 0 and 1000")
 
         a_pad = amplitudes + (24 - len(amplitudes)) * [0]
-        cmd = self._to_bytes('>SC;')
+        cmd = Controller._to_bytes('>SC;')
 
         for idx, num in enumerate(a_pad):
             cmd += num.to_bytes(2, byteorder='big')
 
-        cmd += self._to_bytes('<')
+        cmd += Controller._to_bytes('<')
+        return cmd
 
-        res = self.send_command(cmd)
+    def set_amplitude(self, amplitudes: List[int]) -> bool:
+        """Set amplitude of the pulses in n-plet (0 - 1000) unit: w/10 or w/100"""
+        res = self.send_command(self.encode_amplitudes(amplitudes))
         if res:
             self.pulse_amplitudes = amplitudes
 
         return res
 
-    def set_mode(self, mode: str) -> bool:
-        """Set mode to either unipolar or bipolar"""
+    @staticmethod
+    @profiled('encode')
+    def encode_mode(mode: str) -> bytes:
         if mode == 'unipolar':
             cmd = '>MUX;OFF<'
         elif mode == 'bipolar':
             cmd = '>MUX;ON<'
         else:
             raise ValueError('No mode named: {}, use value unipolar or bipolar'.format(mode))
+        return Controller._to_bytes(cmd)
 
-        res = self.send_command(self._to_bytes(cmd))
+    def set_mode(self, mode: str) -> bool:
+        """Set mode to either unipolar or bipolar"""
+        res = self.send_command(self.encode_mode(mode))
         if res:
             self.mode = mode
 
         return res
 
-    def set_common_electrode(self, electrode: str) -> bool:
-        """Set common electrode to anode or cathode, unipolar only"""
+    @staticmethod
+    @profiled('encode')
+    def encode_common_electrode(electrode: str) -> bytes:
         if electrode.lower() == 'anode':
             e = 'A'
         elif electrode.lower() == 'cathode':
             e = 'C'
         else:
             raise ValueError('No option: {}, use value "anode" or "cathode" for cathode'.format(electrode))
-        cmd = '>ASYNC;{}<'.format(e)
+        return Controller._to_bytes('>ASYNC;{}<'.format(e))
 
-        res = self.send_command(self._to_bytes(cmd))
+    def set_common_electrode(self, electrode: str) -> bool:
+        """Set common electrode to anode or cathode, unipolar only"""
+        res = self.send_command(self.encode_common_electrode(electrode))
         if res:
             self.common_electrode = electrode
             self.is_short_protocol = False
 
         return res
 
-    def set_pulses_unipolar(self, output_channels: List, value_type: str = 'list') -> bool:
-        """Set n-plet pulses and output channels for each pulse, unipolar only"""
+    @staticmethod
+    @profiled('encode')
+    def encode_pulses_unipolar(output_channels: List, value_type: str = 'list') -> bytes:
         if len(output_channels) > 24:
             raise ValueError('Too many pulses defined. Maximum length for the output channels is 24, was {}'
                              .format(len(output_channels)))
 
-        cmd = self._to_bytes('>SA;')
+        cmd = Controller._to_bytes('>SA;')
         if value_type == "hex":
             padded_output = output_channels + (24 - len(output_channels)) * ['000000']
             for idx, channels in enumerate(padded_output):
@@ -361,7 +828,12 @@ Device state (Battery: {}%):
                     value += pow(2, c - 1)
                 cmd += value.to_bytes(3, byteorder='big')
 
-        cmd += self._to_bytes('<')
+        cmd += Controller._to_bytes('<')
+        return cmd
+
+    def set_pulses_unipolar(self, output_channels: List, value_type: str = 'list') -> bool:
+        """Set n-plet pulses and output channels for each pulse, unipolar only"""
+        cmd = self.encode_pulses_unipolar(output_channels, value_type)
 
         res = self.send_command(cmd)
         if res:
@@ -369,13 +841,14 @@ Device state (Battery: {}%):
 
         return res
 
-    def set_pulses_bipolar(self, channel_pairs: List[Tuple], value_type: str = 'list') -> bool:
-        """Set n-plet pulses and output channels cathode/anode pairs for each pulse, bipolar only"""
+    @staticmethod
+    @profiled('encode')
+    def encode_pulses_bipolar(channel_pairs: List[Tuple], value_type: str = 'list') -> bytes:
         if len(channel_pairs) > 24:
             raise ValueError('Too many pulses defined. Maximum length for the channels pairs is 24, was {}'
                              .format(len(channel_pairs)))
 
-        cmd = self._to_bytes(">CA;")
+        cmd = Controller._to_bytes(">CA;")
         if value_type == 'hex':
             padded_pairs = channel_pairs + (24 - len(channel_pairs)) * [('000000', '000000')]
             for x, y in padded_pairs:
@@ -399,7 +872,12 @@ Device state (Battery: {}%):
                 cmd += cathode.to_bytes(3, byteorder='big')
                 cmd += anode.to_bytes(3, byteorder='big')
 
-        cmd += self._to_bytes('<')
+        cmd += Controller._to_bytes('<')
+        return cmd
+
+    def set_pulses_bipolar(self, channel_pairs: List[Tuple], value_type: str = 'list') -> bool:
+        """Set n-plet pulses and output channels cathode/anode pairs for each pulse, bipolar only"""
+        cmd = self.encode_pulses_bipolar(channel_pairs, value_type)
 
         res = self.send_command(cmd)
         if res:
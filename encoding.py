@@ -0,0 +1,87 @@
+"""Vectorized encoding of channel patterns into device frames
+
+Patterns are boolean masks of shape (N, 24, 24): pattern, pulse in the n-plet, output channel (channel c at
+index c - 1). The result is one contiguous uint8 array with one frame per row, row i is the exact frame
+set_pulses_unipolar / set_pulses_bipolar would send for pattern i.
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+MAX_PULSES = 24
+NUM_CHANNELS = 24
+
+# weight of every channel bit in the 3 byte channel field
+_CHANNEL_WEIGHTS = (1 << np.arange(NUM_CHANNELS, dtype=np.uint32))
+
+
+def channels_to_masks(patterns: Sequence[Sequence[Sequence[int]]]) -> np.ndarray:
+    """Convert patterns given as channel lists per pulse (as for set_pulses_unipolar) to a (N, 24, 24) mask"""
+    masks = np.zeros((len(patterns), MAX_PULSES, NUM_CHANNELS), dtype=bool)
+    index = [(n, p, c - 1) for n, pattern in enumerate(patterns) for p, channels in enumerate(pattern)
+             for c in channels if c != 0]
+    if index:
+        n, p, c = np.array(index).T
+        if (p >= MAX_PULSES).any() or (c < 0).any() or (c >= NUM_CHANNELS).any():
+            raise ValueError("Patterns can have at most 24 pulses on channels 1-24")
+        masks[n, p, c] = True
+    return masks
+
+
+def pairs_to_masks(patterns: Sequence[Sequence[Tuple[Sequence[int], Sequence[int]]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert patterns given as (cathodes, anodes) per pulse (as for set_pulses_bipolar) to cathode and anode masks"""
+    cathodes = channels_to_masks([[pair[0] for pair in pattern] for pattern in patterns])
+    anodes = channels_to_masks([[pair[1] for pair in pattern] for pattern in patterns])
+    return cathodes, anodes
+
+
+def _check_masks(masks: np.ndarray) -> np.ndarray:
+    masks = np.asarray(masks, dtype=bool)
+    if masks.ndim == 2:
+        masks = masks[np.newaxis]
+    if masks.ndim != 3 or masks.shape[2] != NUM_CHANNELS or masks.shape[1] > MAX_PULSES:
+        raise ValueError("Masks must have shape (N, <=24, 24), was {}".format(masks.shape))
+    if masks.shape[1] < MAX_PULSES:
+        padding = np.zeros((masks.shape[0], MAX_PULSES - masks.shape[1], NUM_CHANNELS), dtype=bool)
+        masks = np.concatenate([masks, padding], axis=1)
+    return masks
+
+
+def _channel_bytes(masks: np.ndarray) -> np.ndarray:
+    """(N, 24, 24) masks to (N, 24, 3) big-endian channel fields"""
+    values = masks.astype(np.uint32) @ _CHANNEL_WEIGHTS
+    return np.stack([(values >> 16) & 0xFF, (values >> 8) & 0xFF, values & 0xFF], axis=-1).astype(np.uint8)
+
+
+def _frames(command: bytes, body: np.ndarray) -> np.ndarray:
+    n = body.shape[0]
+    prefix = np.frombuffer(command, dtype=np.uint8)
+    frames = np.empty((n, len(prefix) + body.shape[1] + 1), dtype=np.uint8)
+    frames[:, :len(prefix)] = prefix
+    frames[:, len(prefix):-1] = body
+    frames[:, -1] = ord('<')
+    return frames
+
+
+def encode_unipolar(masks: np.ndarray) -> np.ndarray:
+    """>SA; frames for every pattern, returns uint8 array of shape (N, 77)"""
+    body = _channel_bytes(_check_masks(masks))
+    return _frames(b'>SA;', body.reshape(body.shape[0], MAX_PULSES * 3))
+
+
+def encode_bipolar(cathodes: np.ndarray, anodes: np.ndarray) -> np.ndarray:
+    """>CA; frames for every pattern, returns uint8 array of shape (N, 149)"""
+    cathodes = _check_masks(cathodes)
+    anodes = _check_masks(anodes)
+    if cathodes.shape != anodes.shape:
+        raise ValueError("Cathode and anode masks must have the same shape, were {} and {}"
+                         .format(cathodes.shape, anodes.shape))
+    body = np.concatenate([_channel_bytes(cathodes), _channel_bytes(anodes)], axis=-1)
+    return _frames(b'>CA;', body.reshape(body.shape[0], MAX_PULSES * 6))
+
+
+def frame_list(frames: np.ndarray) -> List[bytes]:
+    """Split an encoded frame array into frames ready for Controller.send_command"""
+    frame_length = frames.shape[1]
+    buffer = frames.tobytes()
+    return [buffer[i:i + frame_length] for i in range(0, len(buffer), frame_length)]
@@ -0,0 +1,86 @@
+import threading
+import time
+from typing import Dict
+
+
+class FlowController:
+    """Adaptive in-flight window and write pacing for the serial link
+
+    ACK latencies feed a smoothed round-trip estimate (as in TCP), the window grows by one after a window's
+    worth of clean acknowledgements and falls back to a single command in flight with slower pacing after a
+    timeout or a garbled reply. USB links end up with a deep window and no pacing, rfcomm links with
+    a shallow one.
+    """
+
+    MIN_TIMEOUT = 0.2
+    MAX_TIMEOUT = 5.0
+    MAX_PACING = 0.05
+
+    def __init__(self, max_window: int = 4):
+        self.max_window = max_window
+        self.window = 1
+        self.pacing = 0.0
+        self.srtt = None
+        self.rttvar = 0.0
+        self.outstanding_bytes = 0
+        self.acked_commands = 0
+        self.acked_bytes = 0
+        self.timeouts = 0
+        self.garbled = 0
+        self._clean_acks = 0
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def timeout(self) -> float:
+        """Time to wait for an ACK before treating the command as lost"""
+        if self.srtt is None:
+            return self.MAX_TIMEOUT
+        return min(max(self.srtt + 4 * self.rttvar, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+
+    def on_write(self, num_bytes: int):
+        with self._lock:
+            self.outstanding_bytes += num_bytes
+
+    def on_ack(self, latency: float, num_bytes: int):
+        with self._lock:
+            self.outstanding_bytes = max(self.outstanding_bytes - num_bytes, 0)
+            self.acked_commands += 1
+            self.acked_bytes += num_bytes
+            if self.srtt is None:
+                self.srtt = latency
+                self.rttvar = latency / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - latency)
+                self.srtt = 0.875 * self.srtt + 0.125 * latency
+            self._clean_acks += 1
+            if self._clean_acks >= self.window:
+                self._clean_acks = 0
+                self.window = min(self.window + 1, self.max_window)
+                self.pacing = self.pacing / 2 if self.pacing > 0.0005 else 0.0
+
+    def on_failure(self, num_bytes: int, garbled: bool):
+        """No reply in time (garbled False) or an unparseable reply (garbled True)"""
+        with self._lock:
+            self.outstanding_bytes = max(self.outstanding_bytes - num_bytes, 0)
+            if garbled:
+                self.garbled += 1
+            else:
+                self.timeouts += 1
+            self._clean_acks = 0
+            self.window = 1
+            self.pacing = min(max(self.pacing * 2, 0.001), self.MAX_PACING)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                'window': self.window,
+                'pacing_ms': self.pacing * 1000,
+                'srtt_ms': self.srtt * 1000 if self.srtt is not None else None,
+                'timeout_ms': self.timeout() * 1000,
+                'outstanding_bytes': self.outstanding_bytes,
+                'commands_per_second': self.acked_commands / elapsed if elapsed else 0.0,
+                'bytes_per_second': self.acked_bytes / elapsed if elapsed else 0.0,
+                'timeouts': self.timeouts,
+                'garbled': self.garbled,
+            }
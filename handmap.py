@@ -1,9 +1,12 @@
 from PyQt6.QtWidgets import QGraphicsView, QWidget, QGraphicsPixmapItem, QGraphicsScene, \
                             QGraphicsPathItem, QGraphicsRectItem
-from PyQt6.QtGui import QImage, QPen, QColor, QBrush, QPixmap, QPolygon, QPainterPath, QPolygonF
+from PyQt6.QtGui import QImage, QPen, QColor, QBrush, QPixmap, QPolygon, QPainterPath, QPolygonF, QPainter, QRegion
+import math
 import os
 from PyQt6.QtCore import QPointF, Qt, QRectF, pyqtSignal
 
+import profiling
+
 class GraphicsScene(QGraphicsScene):
     stims = pyqtSignal(list)
     def __init__(self):
@@ -58,11 +61,12 @@ class GraphicsScene(QGraphicsScene):
         
     def mouseReleaseEvent(self, event):
         zones = []
-        for pos in self.vector:
-            for key, value in self.hand_zones.items():
-                if value.containsPoint(pos, Qt.FillRule.OddEvenFill):
-                    if key not in zones:
-                        zones.append(key)
+        with profiling.span('zone_hit_test', category='handmap'):
+            for pos in self.vector:
+                for key, value in self.hand_zones.items():
+                    if value.containsPoint(pos, Qt.FillRule.OddEvenFill):
+                        if key not in zones:
+                            zones.append(key)
 
         self.polygon.clear()
         self.vector = []
@@ -81,6 +85,114 @@ class GraphicsScene(QGraphicsScene):
         
         
 
+class ZoneHeatmap:
+    """Overlay on the hand map showing how often each zone was reported, per electrode pair or for all pairs
+
+    Each zone fill is rendered once per color level into a cached QPixmap. An update only repaints the zones whose
+    level changed onto one overlay pixmap, so the map stays smooth while responses stream in.
+
+    :param levels: number of color steps between a zone reported once and a zone reported for every stimulus
+    """
+
+    def __init__(self, scene, levels=10):
+        self.scene = scene
+        self.levels = levels
+        self.pair = None
+        self.stimuli = {}
+        self.counts = {}
+        self.shown = {}
+        self._fills = {}
+        self._bounds = {zone: poly.boundingRect().toAlignedRect() for zone, poly in scene.hand_zones.items()}
+        rect = scene.sceneRect().toAlignedRect()
+        self.pixmap = QPixmap(rect.size())
+        self.pixmap.fill(Qt.GlobalColor.transparent)
+        self.item = QGraphicsPixmapItem(self.pixmap)
+        self.item.setZValue(5)
+        scene.addItem(self.item)
+
+    def color(self, level):
+        # blue for rarely reported zones to red for zones reported every time
+        hue = int(240 * (1 - level / self.levels))
+        return QColor.fromHsv(hue, 255, 255, 60 + int(120 * level / self.levels))
+
+    def fill(self, zone, level):
+        """Zone fill at level, rendered on first use"""
+        key = (zone, level)
+        if key not in self._fills:
+            bounds = self._bounds[zone]
+            pixmap = QPixmap(bounds.size())
+            pixmap.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(pixmap)
+            painter.translate(-bounds.left(), -bounds.top())
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(self.color(level))
+            painter.drawPolygon(self.scene.hand_zones[zone])
+            painter.end()
+            self._fills[key] = pixmap
+        return self._fills[key]
+
+    def add_response(self, pair, zones):
+        """Count one stimulus of pair (cathode, anode) and the zones reported for it"""
+        self.add_responses([(pair, zones)])
+
+    def add_responses(self, responses):
+        """Count (pair, zones) of many stimuli, the overlay is repainted once"""
+        shown = False
+        for pair, zones in responses:
+            self.stimuli[pair] = self.stimuli.get(pair, 0) + 1
+            counts = self.counts.setdefault(pair, {})
+            for zone in set(zones):
+                if zone in self._bounds:
+                    counts[zone] = counts.get(zone, 0) + 1
+            shown = shown or self.pair is None or self.pair == pair
+        if shown:
+            self.update()
+
+    def show(self, pair=None):
+        """Show the zones of one (cathode, anode) pair, None for all pairs together"""
+        self.pair = pair
+        self.update()
+
+    def clear(self):
+        self.stimuli = {}
+        self.counts = {}
+        self.update()
+
+    def probabilities(self):
+        if self.pair is not None:
+            pairs = [self.pair] if self.pair in self.stimuli else []
+        else:
+            pairs = list(self.stimuli)
+        stimuli = sum(self.stimuli[pair] for pair in pairs)
+        totals = {}
+        for pair in pairs:
+            for zone, count in self.counts[pair].items():
+                totals[zone] = totals.get(zone, 0) + count
+        return {zone: count / stimuli for zone, count in totals.items()}
+
+    def update(self):
+        levels = {zone: math.ceil(p * self.levels) for zone, p in self.probabilities().items()}
+        changed = [zone for zone in self._bounds if levels.get(zone, 0) != self.shown.get(zone, 0)]
+        if not changed:
+            return
+        with profiling.span('heatmap_update', category='handmap'):
+            dirty = QRegion()
+            for zone in changed:
+                dirty = dirty.united(QRegion(self._bounds[zone]))
+            self.shown = {zone: level for zone, level in levels.items() if level}
+            painter = QPainter(self.pixmap)
+            painter.setClipRegion(dirty)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
+            painter.fillRect(dirty.boundingRect(), Qt.GlobalColor.transparent)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_SourceOver)
+            # zones next to a changed one are redrawn inside the cleared area only
+            for zone, level in self.shown.items():
+                if dirty.intersects(self._bounds[zone]):
+                    painter.drawPixmap(self._bounds[zone].topLeft(), self.fill(zone, level))
+            painter.end()
+            self.item.setPixmap(self.pixmap)
+
+
 class HandMap(QGraphicsView):
     def __init__(self, channelview):
         super(QWidget, self).__init__()
@@ -91,4 +203,5 @@ class HandMap(QGraphicsView):
         hand_graphics_diagram = QGraphicsPixmapItem(hand_diagram)
         hand_graphics_diagram.setZValue(0)
         self.scene.addItem(hand_graphics_diagram)
+        self.heatmap = ZoneHeatmap(self.scene)
         #hand_graphics_diagram.setPos(0,-500)
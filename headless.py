@@ -0,0 +1,108 @@
+import json
+import time
+from typing import List, TextIO
+
+from commands import run_command
+from controller import Controller, RecoveryReport
+from ordering import CommandCosts, order_sweep
+from sweep import SweepEngine, load_sweep
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+
+
+class EventWriter:
+    """Writes one JSON object per line for every command, step and file run"""
+
+    def __init__(self, output: TextIO):
+        self.output = output
+        self.start = time.perf_counter()
+
+    def write(self, event: str, **fields):
+        record = {'event': event, 't': round(time.perf_counter() - self.start, 6)}
+        record.update(fields)
+        self.output.write(json.dumps(record) + "\n")
+        self.output.flush()
+
+    def command(self, cmd: bytes, response: str, seconds: float):
+        self.write('command', frame=cmd.hex(), response=response, ok=Controller._res_to_bool(response),
+                   ms=round(seconds * 1000, 3))
+
+    def recovery(self, report: RecoveryReport):
+        self.write('recovery', frame=report.command.hex(), failures=report.failures, recovered=report.recovered,
+                   ms=round(report.seconds * 1000, 3))
+
+
+def run_command_file(device: Controller, path: str, events: EventWriter) -> bool:
+    ok = True
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            succ, out = run_command(device, line)
+            events.write('line', file=path, line=line, ok=succ, result=out)
+            ok = ok and succ
+    return ok
+
+
+def run_sweep_file(device: Controller, path: str, events: EventWriter, costs: CommandCosts) -> bool:
+    sweep = load_sweep(path)
+    report = None
+    if sweep.optimize_order is not None:
+        # the order is planned before the device state is known, so it starts from an unknown state
+        sweep, report = order_sweep(sweep, costs.costs(), blocks=sweep.optimize_order.get('blocks'),
+                                    fixed=sweep.optimize_order.get('fixed', ()))
+        events.write('order', file=path, commands_before=report.commands_before,
+                     commands_after=report.commands_after, seconds_before=round(report.cost_before, 6),
+                     seconds_after=round(report.cost_after, 6))
+    commands, seconds = costs.commands, costs.seconds
+    engine = SweepEngine(device, sweep, on_progress=lambda progress: events.write(
+        'step', file=path, index=progress.index, total=progress.total, step=progress.step,
+        changed=progress.changed, failed=progress.failed))
+    ok = engine.run()
+    if report is not None:
+        events.write('order_achieved', file=path, commands=costs.commands - commands,
+                     predicted_commands=report.commands_after, seconds=round(costs.seconds - seconds, 6))
+    return ok
+
+
+def run_headless(device: Controller, command_files: List[str], sweep_files: List[str], output: TextIO) -> int:
+    """Run command files and then sweep definitions without the TUI
+
+    :return: process exit status, EXIT_OK if every command was acknowledged
+    """
+    return EXIT_OK if run_protocol(device, command_files, sweep_files, EventWriter(output)) else EXIT_FAILED
+
+
+def run_protocol(device: Controller, command_files: List[str], sweep_files: List[str], events: EventWriter) -> bool:
+    """Run command files and then sweep definitions, reporting every command, step and file to events
+
+    :return: True if every command was acknowledged
+    """
+    device.add_command_listener(events.command)
+    device.add_recovery_listener(events.recovery)
+    # Measured per-command latency, used to order sweeps that allow it
+    costs = CommandCosts(device)
+    ok = True
+    try:
+        for path in command_files:
+            start = time.perf_counter()
+            succ = run_command_file(device, path, events)
+            events.write('commands_done', file=path, ok=succ, seconds=round(time.perf_counter() - start, 6))
+            ok = ok and succ
+        for path in sweep_files:
+            start = time.perf_counter()
+            succ = run_sweep_file(device, path, events, costs)
+            events.write('sweep_done', file=path, ok=succ, seconds=round(time.perf_counter() - start, 6))
+            ok = ok and succ
+    except (OSError, ValueError) as e:
+        events.write('error', message=str(e))
+        ok = False
+    finally:
+        device.remove_command_listener(events.command)
+        device.remove_command_listener(costs.command)
+        device.remove_recovery_listener(events.recovery)
+
+    events.write('done', ok=ok, recoveries=device.recovery_stats())
+    return ok
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+from array import array
+from collections import deque, namedtuple
+from datetime import datetime
+from typing import List, Optional
+
+HISTORY_DIRECTORY = "./history"
+
+HistoryEntry = namedtuple('HistoryEntry', ['index', 't', 'command', 'ok', 'result'])
+
+
+class CommandHistory:
+    """Command history of a session, the newest entries in memory and every entry in an append-only file
+
+    Entries are numbered from 0 in the order they were added. The file has one JSON object per line and the
+    byte offset of every line is kept, so any entry can be read back without scanning the file. Entries can be
+    added from any thread, the file is shared by every method and only used under a lock.
+
+    :param path: session file, by default a new timestamped file in HISTORY_DIRECTORY, an existing file is continued
+    :param max_visible: number of newest entries kept in memory
+    """
+
+    def __init__(self, path: Optional[str] = None, max_visible: int = 200):
+        if path is None:
+            os.makedirs(HISTORY_DIRECTORY, exist_ok=True)
+            fname = datetime.now().isoformat()[0:-7].replace(":", "")
+            path = os.path.join(HISTORY_DIRECTORY, "session_{}.jsonl".format(fname))
+        self.path = path
+        self.max_visible = max_visible
+        self._recent = deque(maxlen=max_visible)
+        self._offsets = array('Q')
+        self._lock = threading.Lock()
+        self._file = open(path, "ab+")
+        self._index()
+
+    def _index(self):
+        """Offsets of the entries already in the file, when continuing the history of an earlier session"""
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            if not line.endswith(b"\n"):
+                # partly written last entry of a session that crashed
+                self._file.truncate(offset)
+                break
+            self._offsets.append(offset)
+            offset += len(line)
+        for index in range(max(len(self._offsets) - self.max_visible, 0), len(self._offsets)):
+            self._file.seek(self._offsets[index])
+            self._recent.append(HistoryEntry(**json.loads(self._file.readline())))
+        self._file.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def add(self, command: str, ok: bool, result: str) -> HistoryEntry:
+        with self._lock:
+            entry = HistoryEntry(len(self._offsets), time.time(), command, ok, result)
+            line = json.dumps(entry._asdict()) + "\n"
+            self._file.seek(0, os.SEEK_END)
+            self._offsets.append(self._file.tell())
+            self._file.write(line.encode('utf-8'))
+            self._file.flush()
+            self._recent.append(entry)
+        return entry
+
+    def recent(self) -> List[HistoryEntry]:
+        """Newest entries, oldest first"""
+        with self._lock:
+            return list(self._recent)
+
+    def get(self, index: int) -> HistoryEntry:
+        with self._lock:
+            if index < 0 or index >= len(self._offsets):
+                raise IndexError("No history entry {}, history has {} entries".format(index, len(self._offsets)))
+            first_recent = len(self._offsets) - len(self._recent)
+            if index >= first_recent:
+                return self._recent[index - first_recent]
+            self._file.seek(self._offsets[index])
+            return HistoryEntry(**json.loads(self._file.readline()))
+
+    def around(self, index: int, count: Optional[int] = None) -> List[HistoryEntry]:
+        """count entries starting at index, for jumping to an old part of the history"""
+        count = count or self.max_visible
+        index = min(max(index, 0), max(len(self._offsets) - 1, 0))
+        return [self.get(i) for i in range(index, min(index + count, len(self._offsets)))]
+
+    def search(self, text: str, limit: int = 100) -> List[HistoryEntry]:
+        """Entries whose command or result contains text (case insensitive), newest first"""
+        text = text.lower()
+        found = []
+        with self._lock:
+            for entry in reversed(self._recent):
+                if text in entry.command.lower() or text in entry.result.lower():
+                    found.append(entry)
+                    if len(found) >= limit:
+                        return found
+            # older entries only exist in the file, the raw line is checked before decoding it
+            spilled = len(self._offsets) - len(self._recent)
+            if not spilled:
+                return found
+            self._file.seek(0)
+            older = []
+            for _ in range(spilled):
+                line = self._file.readline()
+                if text in line.decode('utf-8').lower():
+                    entry = HistoryEntry(**json.loads(line))
+                    if text in entry.command.lower() or text in entry.result.lower():
+                        older.append(entry)
+        found.extend(reversed(older[-(limit - len(found)):]))
+        return found
+
+    def export(self, path: str, successful_only: bool = True) -> int:
+        """Write the commands as a command file that can be replayed with -c
+
+        :return: number of commands written
+        """
+        written = 0
+        with self._lock, open(path, "w") as f:
+            self._file.seek(0)
+            f.write("# Exported from {}\n".format(self.path))
+            for line in self._file:
+                entry = json.loads(line)
+                if successful_only and not entry['ok']:
+                    continue
+                f.write(entry['command'].strip() + "\n")
+                written += 1
+            self._file.seek(0, os.SEEK_END)
+        return written
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -1,10 +1,19 @@
 import argparse
+import atexit
 import logging
+import sys
 
 import serial
 
-from TUI import TUI
+import profiling
+from command_log import CommandLog
 from controller import Controller
+from headless import run_headless
+from parallel import run_parallel
+from protocol_analysis import analyze_files, format_analysis
+from connection import ConnectionSupervisor
+from server import ControllerServer
+from shadow_state import ShadowState
 
 BAUD_RATE = 921600
 DATA_BITS = serial.EIGHTBITS
@@ -23,13 +32,74 @@ def log_level(x: str):
     }.get(x.lower(), logging.error)
 
 
+def write_profile(path: str):
+    profiling.export_chrome_trace(path)
+    print(profiling.format_report(), file=sys.stderr)
+
+
 def main(args):
-    print("Starting...")
-    device = Controller(args.device, logging_level=log_level(args.logging_level), log_file=args.log_file)
+    if args.profile:
+        profiling.enable()
+        atexit.register(write_profile, args.profile)
+    if args.analyze:
+        # nothing is sent, the device doesn't need to be connected
+        analysis = analyze_files(([args.commands] if args.commands else []) + args.sweep)
+        print(format_analysis(analysis))
+        return 1 if analysis.problems or analysis.infeasible else 0
+    if args.parallel:
+        # the -d port runs the protocol too, every port only once so no serial device is opened twice
+        ports = list(dict.fromkeys(([args.device] if args.device else []) + args.parallel))
+        command_files = [args.commands] if args.commands else []
+        options = dict(logging_level=log_level(args.logging_level), log_file=args.log_file)
+        if args.output:
+            with open(args.output, "w") as output:
+                return run_parallel(ports, command_files, args.sweep, output, **options)
+        return run_parallel(ports, command_files, args.sweep, sys.stdout, **options)
+
+    if not args.headless:
+        print("Starting...")
+    command_log = None
+    if args.command_log:
+        command_log = CommandLog(open(args.command_log, "a"))
+        atexit.register(command_log.close)
+    device = Controller(args.device, logging_level=log_level(args.logging_level), log_file=args.log_file,
+                        command_log=command_log)
+    # last acknowledged state of the port is kept on disk so it survives restarts and link drops
+    shadow = ShadowState(device)
+    atexit.register(shadow.close)
+    # reopens the port in the background if it can't be opened now or the link drops later
+    supervisor = ConnectionSupervisor(device, shadow, hold=args.hold)
+    if args.resync:
+        if shadow.restore():
+            failed = shadow.resync()
+            if failed:
+                print("Resync failed for {}".format(", ".join(failed)))
+        else:
+            print("No saved state for {}, nothing to resync".format(args.device))
+
+    if args.serve:
+        server = ControllerServer(device, args.serve)
+        print("Serving controller on {}".format(args.serve))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    if args.headless:
+        command_files = [args.commands] if args.commands else []
+        if args.output:
+            with open(args.output, "w") as output:
+                return run_headless(device, command_files, args.sweep, output)
+        return run_headless(device, command_files, args.sweep, sys.stdout)
+
     print(device)
     print("Started")
 
-    TUI(device, config_file=args.commands)
+    # py_cui is only needed for the interactive interface
+    from TUI import TUI
+    TUI(device, config_file=args.commands, supervisor=supervisor)
+    return 0
 
 
 if __name__ == '__main__':
@@ -37,6 +107,24 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--device', help='Device serial port')
     parser.add_argument('-l', '--logging_level', default="warning", help='Logging level')
     parser.add_argument('-f', '--log_file', default="", help='Log file')
+    parser.add_argument('--command_log', default="",
+                        help='Append every frame, response and round-trip time to this file as JSON lines')
+    parser.add_argument('--hold', type=float, default=0.0,
+                        help='Seconds commands wait for a lost link to come back before failing, default 0')
+    parser.add_argument('--resync', action='store_true',
+                        help='Restore the last acknowledged state of the device and send its critical parameters again')
     parser.add_argument('-c', '--commands', default="", help='Commands to be executed on the controller')
+    parser.add_argument('--headless', action='store_true', help='Run commands and sweeps without the TUI and exit')
+    parser.add_argument('-s', '--sweep', action='append', default=[], help='Sweep definition (JSON) for headless mode')
+    parser.add_argument('-P', '--parallel', action='append', default=[],
+                        help='Run the headless protocol on this serial port too, one process per port')
+    parser.add_argument('--analyze', action='store_true',
+                        help='Print the pulses, charge per channel and length of the command file and sweeps '
+                             'without connecting to the device')
+    parser.add_argument('-o', '--output', default="", help='File for headless progress and timings, default stdout')
+    parser.add_argument('-p', '--profile', default="",
+                        help='Profile the session and write a Chrome trace (JSON) to this file on exit')
+    parser.add_argument('--serve', default="",
+                        help='Serve the controller to other processes on a Unix socket path or host:port')
     arguments = parser.parse_args()
-    main(arguments)
+    sys.exit(main(arguments))
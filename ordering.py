@@ -0,0 +1,178 @@
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from controller import Controller
+from sweep import Sweep, changed_parameters
+
+# Frame header of the command each sweep parameter is sent with
+HEADERS = {
+    'voltage': b'>SV;',
+    'frequency': b'>SF;',
+    'width': b'>PW;',
+    'amplitude': b'>SC;',
+    'channel_pairs': b'>CA;',
+}
+
+_SWEPT_HEADERS = frozenset(HEADERS.values())
+
+OrderReport = namedtuple('OrderReport', ['commands_before', 'commands_after', 'cost_before', 'cost_after'])
+
+
+class CommandCosts:
+    """Round-trip time of each sweep parameter's command as measured on the link
+
+    :param default: cost in seconds of parameters whose command has not been seen yet
+    :param alpha: weight of the newest measurement in the moving average
+
+    commands and seconds count the sweep parameter commands sent so far and their total round-trip time.
+    """
+
+    def __init__(self, device: Optional[Controller] = None, default: float = 0.005, alpha: float = 0.125):
+        self.default = default
+        self.alpha = alpha
+        self.latency = {}
+        self.commands = 0
+        self.seconds = 0.0
+        if device is not None:
+            device.add_command_listener(self.command)
+
+    def command(self, cmd: bytes, response: str, seconds: float):
+        """Command listener for Controller.add_command_listener"""
+        header = cmd[:4]
+        if header in self.latency:
+            self.latency[header] += self.alpha * (seconds - self.latency[header])
+        else:
+            self.latency[header] = seconds
+        if header in _SWEPT_HEADERS:
+            self.commands += 1
+            self.seconds += seconds
+
+    def costs(self) -> Dict[str, float]:
+        return {name: self.latency.get(header, self.default) for name, header in HEADERS.items()}
+
+
+def transition_cost(step: Dict, previous: Optional[Dict], costs: Optional[Dict[str, float]] = None) -> float:
+    """Cost of the commands needed to go from previous to step, one per command if costs are not given"""
+    if costs is None:
+        return float(len(changed_parameters(step, previous)))
+    return sum(costs.get(name, 0.0) for name in changed_parameters(step, previous))
+
+
+def sequence_cost(steps: List[Dict], costs: Optional[Dict[str, float]] = None,
+                  start: Optional[Dict] = None) -> Tuple[int, float]:
+    """Number of commands and their total cost to run the steps in order, starting from the start state
+
+    Parameters missing from a step keep their previous value, as in SweepEngine.
+    """
+    state = dict(start or {})
+    commands = 0
+    cost = 0.0
+    for step in steps:
+        changed = changed_parameters(step, state)
+        commands += len(changed)
+        cost += transition_cost(step, state, costs)
+        state.update(step)
+    return commands, cost
+
+
+def _order_block(steps: List[Dict], costs: Optional[Dict[str, float]], start: Dict) -> List[int]:
+    """Greedy nearest neighbour tour improved with 2-opt, ties keep the given order"""
+    n = len(steps)
+    if n < 2:
+        return list(range(n))
+    matrix = [[transition_cost(b, a, costs) for b in steps] for a in steps]
+    from_start = [transition_cost(step, start, costs) for step in steps]
+
+    remaining = list(range(n))
+    order = []
+    row = from_start
+    while remaining:
+        best = min(remaining, key=lambda j: row[j])
+        remaining.remove(best)
+        order.append(best)
+        row = matrix[best]
+
+    def edge(a: Optional[int], b: int) -> float:
+        return from_start[b] if a is None else matrix[a][b]
+
+    # Reversing order[i..j] replaces the edges into order[i] and out of order[j] and reverses the edges
+    # in between, these only cost differently backwards when some steps leave parameters out
+    improved = True
+    passes = 0
+    while improved and passes < 20:
+        improved = False
+        passes += 1
+        for i in range(n - 1):
+            before = order[i - 1] if i > 0 else None
+            forward = 0.0
+            backward = 0.0
+            for j in range(i + 1, n):
+                forward += matrix[order[j - 1]][order[j]]
+                backward += matrix[order[j]][order[j - 1]]
+                after = order[j + 1] if j + 1 < n else None
+                old = edge(before, order[i]) + forward
+                new = edge(before, order[j]) + backward
+                if after is not None:
+                    old += matrix[order[j]][after]
+                    new += matrix[order[i]][after]
+                if new < old - 1e-12:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+                    # the running edge sums no longer match the order, continue from the next i
+                    break
+    return order
+
+
+def order_steps(steps: List[Dict], costs: Optional[Dict[str, float]] = None, start: Optional[Dict] = None,
+                blocks: Optional[Sequence[int]] = None, fixed: Sequence[int] = ()) -> List[Dict]:
+    """Reorder steps to minimize the cost of the commands between consecutive steps
+
+    :param costs: seconds per command of each sweep parameter, see CommandCosts, None counts commands
+    :param start: device state before the first step, see sweep.current_step
+    :param blocks: lengths of consecutive blocks of steps (e.g. randomization blocks), steps are only reordered
+        within their block and the blocks keep their order. By default all steps are one block
+    :param fixed: indices of blocks whose steps must run in the given order
+    """
+    if blocks is None:
+        blocks = [len(steps)]
+    if sum(blocks) != len(steps):
+        raise ValueError("Block lengths {} do not add up to the {} steps".format(list(blocks), len(steps)))
+    state = dict(start or {})
+    ordered = []
+    offset = 0
+    for index, length in enumerate(blocks):
+        block = steps[offset:offset + length]
+        offset += length
+        if index not in fixed:
+            block = [block[i] for i in _order_block(block, costs, state)]
+        for step in block:
+            state.update(step)
+        ordered.extend(block)
+    return ordered
+
+
+def order_sweep(sweep: Sweep, costs: Optional[Dict[str, float]] = None, start: Optional[Dict] = None,
+                blocks: Optional[Sequence[int]] = None, fixed: Sequence[int] = ()) -> Tuple[Sweep, OrderReport]:
+    """Sweep with its steps reordered by order_steps and the predicted commands and cost before and after"""
+    steps = order_steps(sweep.steps, costs, start, blocks, fixed)
+    commands_before, cost_before = sequence_cost(sweep.steps, costs, start)
+    commands_after, cost_after = sequence_cost(steps, costs, start)
+    # Costs between steps that leave parameters out depend on the steps before them, keep the given order
+    # if the optimized one turns out worse
+    if cost_after > cost_before:
+        steps, commands_after, cost_after = sweep.steps, commands_before, cost_before
+    ordered = Sweep(steps, between=sweep.between, trigger=sweep.trigger)
+    return ordered, OrderReport(commands_before, commands_after, cost_before, cost_after)
+
+
+def format_order_report(report: OrderReport, commands_sent: Optional[int] = None,
+                        seconds_measured: Optional[float] = None) -> str:
+    """Predicted savings and, once the sweep has run, what it actually took"""
+    text = "Reordering saves {} of {} commands, {:.1f} ms of {:.1f} ms predicted".format(
+        report.commands_before - report.commands_after, report.commands_before,
+        (report.cost_before - report.cost_after) * 1000, report.cost_before * 1000)
+    if commands_sent is not None:
+        text += ", sent {} commands".format(commands_sent)
+    if seconds_measured is not None:
+        text += " in {:.1f} ms".format(seconds_measured * 1000)
+    return text
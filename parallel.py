@@ -0,0 +1,129 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Dict, List, TextIO
+
+from controller import Controller
+from headless import EXIT_FAILED, EXIT_OK, EventWriter, run_protocol
+from sweep import load_sweep
+
+# Seconds without any record from a worker, on top of the longest wait between sweep steps,
+# before the device is considered hung and its worker is terminated
+HANG_MARGIN = 30.0
+# Seconds to wait for the last records of a worker that has exited
+EXIT_GRACE = 1.0
+
+
+class QueueEventWriter(EventWriter):
+    """Sends the records of one worker to the coordinator, timed from the coordinator's start"""
+
+    def __init__(self, port: str, results: multiprocessing.Queue, start: float):
+        super().__init__(None)
+        self.port = port
+        self.results = results
+        self.start = start
+
+    def write(self, event: str, **fields):
+        record = {'event': event, 't': round(time.time() - self.start, 6), 'device': self.port}
+        record.update(fields)
+        self.results.put(record)
+
+
+def _worker(port: str, command_files: List[str], sweep_files: List[str], results: multiprocessing.Queue,
+            start: float, controller_options: Dict):
+    events = QueueEventWriter(port, results, start)
+    events.write('started', pid=os.getpid())
+    device = Controller(port, **controller_options)
+    try:
+        run_protocol(device, command_files, sweep_files, events)
+    except Exception as e:
+        events.write('error', message=str(e))
+        events.write('done', ok=False)
+    finally:
+        device.close_serial()
+
+
+def hang_timeout(sweep_files: List[str]) -> float:
+    """Longest silence expected from a healthy worker running the given sweeps"""
+    between = 0.0
+    for path in sweep_files:
+        try:
+            between = max(between, load_sweep(path).between)
+        except (OSError, ValueError):
+            # The worker reports the broken file itself
+            pass
+    return between + HANG_MARGIN
+
+
+def run_parallel(ports: List[str], command_files: List[str], sweep_files: List[str], output: TextIO,
+                 timeout: float = None, **controller_options) -> int:
+    """Run the same command files and sweeps on every device at once, one worker process per device
+
+    Records of all workers are merged into output as JSON lines in the order they arrive, each tagged with
+    the device port and timed from the start of the run. A worker that stays silent for longer than timeout
+    is terminated without stalling the other devices.
+
+    :param timeout: seconds of silence before a device is considered hung, by default 30s plus the longest
+        wait between sweep steps
+    :param controller_options: keyword arguments for each Controller
+    :return: process exit status, EXIT_OK if every device acknowledged every command
+    """
+    if timeout is None:
+        timeout = hang_timeout(sweep_files)
+    results = multiprocessing.Queue()
+    start = time.time()
+    workers = {}
+    for port in ports:
+        workers[port] = multiprocessing.Process(
+            target=_worker, name="bimatrix-{}".format(port), daemon=True,
+            args=(port, command_files, sweep_files, results, start, controller_options))
+        workers[port].start()
+
+    def write(record: Dict):
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+
+    last_seen = {port: time.time() for port in ports}
+    exited = {}
+    finished = {}
+    while len(finished) < len(workers):
+        try:
+            record = results.get(timeout=0.2)
+        except queue.Empty:
+            record = None
+        if record is not None:
+            port = record['device']
+            last_seen[port] = time.time()
+            if port not in finished:
+                write(record)
+                if record['event'] == 'done':
+                    finished[port] = record['ok']
+
+        now = time.time()
+        for port, process in workers.items():
+            if port in finished:
+                continue
+            if not process.is_alive():
+                # Give the records the worker sent just before exiting time to arrive
+                exited.setdefault(port, now)
+                if now - exited[port] > EXIT_GRACE:
+                    finished[port] = False
+                    write({'event': 'exited', 't': round(now - start, 6), 'device': port,
+                           'exitcode': process.exitcode})
+            elif now - last_seen[port] > timeout:
+                logging.error("Device {} did not respond for {}s, terminating its worker".format(port, timeout))
+                process.terminate()
+                finished[port] = False
+                write({'event': 'hung', 't': round(now - start, 6), 'device': port,
+                       'silent': round(now - last_seen[port], 3)})
+
+    for process in workers.values():
+        process.join(EXIT_GRACE)
+        if process.is_alive():
+            process.kill()
+    ok = all(finished.values())
+    write({'event': 'parallel_done', 't': round(time.time() - start, 6), 'ok': ok, 'devices': finished})
+    return EXIT_OK if ok else EXIT_FAILED
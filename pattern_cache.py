@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Dict, List, Optional
+
+from controller import Controller
+
+# Pulse train parameters a pattern can hold -> encoder of the parameter
+ENCODERS = {
+    'repetition_rate': Controller.encode_repetition_rate,
+    'time_between': Controller.encode_time_between,
+    'pulse_widths': Controller.encode_pulse_widths,
+    'pulse_amplitudes': Controller.encode_amplitudes,
+    'output_channels': Controller.encode_pulses_unipolar,
+    'channel_pairs': Controller.encode_pulses_bipolar,
+}
+
+# frames: [(state field, value, frame)] ready for Controller.send_encoded
+# nplet_duration: seconds, None if the pattern has no pulse widths
+# feasible: whether the n-plet fits in the repetition period, None if it can't be decided from the pattern
+CompiledPattern = namedtuple('CompiledPattern', ['key', 'frames', 'nplet_duration', 'feasible'])
+
+
+def _channels(channels) -> List[int]:
+    """Sorted channel numbers of a pulse given as a list of channels or a hex mask ('hex' value_type)"""
+    if isinstance(channels, str):
+        mask = bytes.fromhex(channels)
+        if len(mask) != 3:
+            raise ValueError("Channel masks are 3 bytes (6 hex digits), was {}".format(channels))
+        value = int.from_bytes(mask, byteorder='big')
+        return [c for c in range(1, 25) if value >> (c - 1) & 1]
+    return sorted(int(c) for c in channels if int(c))
+
+
+def normalize(params: Dict) -> Dict:
+    """Canonical form of pattern parameters, equal patterns normalize to equal dicts
+
+    Channels of a pulse are sorted since their order does not change the encoded frame, hex channel masks are
+    decoded to the channel lists they encode to.
+    """
+    unknown = set(params) - set(ENCODERS)
+    if unknown:
+        raise ValueError("Unknown pattern parameters: {}, use {}".format(sorted(unknown), list(ENCODERS)))
+    normalized = {}
+    for name, value in params.items():
+        if name in ('repetition_rate', 'time_between'):
+            normalized[name] = int(value)
+        elif name in ('pulse_widths', 'pulse_amplitudes'):
+            normalized[name] = [int(v) for v in value]
+        elif name == 'output_channels':
+            normalized[name] = [_channels(channels) for channels in value]
+        else:
+            normalized[name] = [[_channels(cathodes), _channels(anodes)] for cathodes, anodes in value]
+    return normalized
+
+
+def pattern_key(normalized: Dict) -> str:
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def compile_pattern(params: Dict) -> CompiledPattern:
+    """Validate and encode a pattern, raises ValueError like the controller setters"""
+    normalized = normalize(params)
+    frames = [(name, value, ENCODERS[name](value)) for name, value in normalized.items()]
+
+    duration = None
+    feasible = None
+    widths = normalized.get('pulse_widths')
+    if widths is not None and 'time_between' in normalized:
+        duration = Controller.nplet_duration(widths, normalized['time_between'])
+        if 'repetition_rate' in normalized:
+            feasible = duration <= 1 / normalized['repetition_rate']
+    return CompiledPattern(pattern_key(normalized), frames, duration, feasible)
+
+
+class PatternCache:
+    """LRU cache of compiled patterns keyed by a hash of the normalized parameters
+
+    :param maxsize: patterns kept in memory
+    :param directory: optional directory for a persistent second tier, shared between sessions
+    """
+
+    def __init__(self, maxsize: int = 256, directory: Optional[str] = None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._patterns = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, params: Dict) -> CompiledPattern:
+        normalized = normalize(params)
+        key = pattern_key(normalized)
+        with self._lock:
+            pattern = self._patterns.get(key)
+            if pattern is not None:
+                self._patterns.move_to_end(key)
+                self.hits += 1
+                return pattern
+
+        pattern = self._load(key)
+        if pattern is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            pattern = compile_pattern(normalized)
+            self._store(pattern)
+
+        with self._lock:
+            self._patterns[key] = pattern
+            while len(self._patterns) > self.maxsize:
+                self._patterns.popitem(last=False)
+        return pattern
+
+    def apply(self, device: Controller, params: Dict) -> bool:
+        """Send a pattern to the device, compiling it only if it isn't cached"""
+        return all(device.send_encoded(self.get(params).frames))
+
+    def stats(self) -> Dict:
+        return {'size': len(self._patterns), 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _load(self, key: str) -> Optional[CompiledPattern]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        frames = [(name, value, bytes.fromhex(frame)) for name, value, frame in data['frames']]
+        return CompiledPattern(key, frames, data['nplet_duration'], data['feasible'])
+
+    def _store(self, pattern: CompiledPattern):
+        if not self.directory:
+            return
+        data = {
+            'frames': [(name, value, frame.hex()) for name, value, frame in pattern.frames],
+            'nplet_duration': pattern.nplet_duration,
+            'feasible': pattern.feasible,
+        }
+        # write to a temporary file first so a crash never leaves a partial entry behind
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self._path(pattern.key))
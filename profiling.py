@@ -0,0 +1,125 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+# Set BIMATRIX_PROFILE=<trace.json> to profile a whole session (e.g. the GUI) and export the trace at exit
+PROFILE_ENV = 'BIMATRIX_PROFILE'
+MAX_SPANS = 1000000
+
+_enabled = False
+# (name, category, start, end, thread id), times from time.perf_counter()
+_spans = deque(maxlen=MAX_SPANS)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'category', 'start')
+
+    def __init__(self, name: str, category: str):
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _spans.append((self.name, self.category, self.start, time.perf_counter(), threading.get_ident()))
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def clear():
+    _spans.clear()
+
+
+def span(name: str, category: str = 'controller'):
+    """Context manager timing a stage, a shared no-op object when profiling is disabled"""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, category)
+
+
+def record(name: str, start: float, end: float, category: str = 'controller'):
+    """Record a stage measured elsewhere, e.g. from a signal emit on one thread to the slot on another"""
+    if _enabled:
+        _spans.append((name, category, start, end, threading.get_ident()))
+
+
+def profiled(name: str, category: str = 'controller') -> Callable:
+    """Decorator version of span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report() -> Dict[str, Dict]:
+    """Count, total, mean and max duration in milliseconds per stage"""
+    stages = {}
+    for name, category, start, end, _ in list(_spans):
+        stage = stages.setdefault(name, {'category': category, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        duration = (end - start) * 1000
+        stage['count'] += 1
+        stage['total_ms'] += duration
+        stage['max_ms'] = max(stage['max_ms'], duration)
+    for stage in stages.values():
+        stage['mean_ms'] = stage['total_ms'] / stage['count']
+    return stages
+
+
+def format_report() -> str:
+    lines = ["{:<16} {:<12} {:>8} {:>12} {:>10} {:>10}".format("stage", "category", "count", "total ms",
+                                                                "mean ms", "max ms")]
+    stages = sorted(report().items(), key=lambda item: -item[1]['total_ms'])
+    for name, stage in stages:
+        lines.append("{:<16} {:<12} {:>8} {:>12.3f} {:>10.3f} {:>10.3f}".format(
+            name, stage['category'], stage['count'], stage['total_ms'], stage['mean_ms'], stage['max_ms']))
+    return "\n".join(lines)
+
+
+def export_chrome_trace(path: str):
+    """Write the spans in Chrome trace event format (chrome://tracing, Perfetto)"""
+    pid = os.getpid()
+    events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start * 10 ** 6, 'dur': (end - start) * 10 ** 6,
+               'pid': pid, 'tid': tid} for name, category, start, end, tid in list(_spans)]
+    with open(path, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+if os.environ.get(PROFILE_ENV):
+    enable()
+    atexit.register(export_chrome_trace, os.environ[PROFILE_ENV])
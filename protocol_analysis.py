@@ -0,0 +1,329 @@
+import json
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from commands import run_command
+from controller import Controller
+from pattern_cache import compile_pattern
+from ramp import RAMPS, Ramp
+from sweep import SETTERS, Sweep, load_sweep
+
+MAX_PULSES = 24
+NUM_CHANNELS = 24
+# Seconds one acknowledged command takes, same default as ordering.CommandCosts
+COMMAND_SECONDS = 0.005
+# mA per amplitude unit on each current range
+AMPLITUDE_UNITS = {'high': 0.1, 'low': 0.01}
+
+# One row per trigger. start and delay in seconds, nplets 0 runs until the next trigger, widths (μs) and
+# amplitudes (device units) padded to MAX_PULSES, listed is the number of widths given, channels the index of
+# the train's pulse -> channel map in the analyzer's channel maps and on whether the trigger toggled the
+# pulse generation on, a trigger toggling it off only ends an endless train
+Trains = namedtuple('Trains', ['start', 'delay', 'nplets', 'rate', 'time_between', 'unit', 'widths', 'amplitudes',
+                               'listed', 'channels', 'on'])
+
+# Channel charges are in μC and indexed by channel number, a pulse counts fully for every channel it goes through
+ProtocolAnalysis = namedtuple('ProtocolAnalysis', [
+    'trains', 'nplet_duration', 'infeasible', 'total_pulses', 'stimulation_seconds', 'session_seconds',
+    'channel_charge', 'max_pulse_charge', 'overlapping', 'endless', 'problems'])
+
+
+class DryRunController(Controller):
+    """Controller without a device that acknowledges every command, follows the state a protocol sets
+
+    :param on_trigger: called whenever the pulse generation is triggered
+    """
+
+    def __init__(self, on_trigger=None):
+        self.frames = 0
+        self.on_trigger = on_trigger
+        super().__init__(None)
+
+    def connect(self, on_connected=None) -> bool:
+        self.connected = True
+        self._link_up.set()
+        return True
+
+    def send_command(self, cmd: bytes) -> bool:
+        self.frames += 1
+        return True
+
+    def send_pipelined(self, frames: List[bytes]) -> List[bool]:
+        self.frames += len(frames)
+        return [True] * len(frames)
+
+    def read_battery(self) -> int:
+        self.frames += 1
+        return 0
+
+    def trigger_pulse_generator(self) -> bool:
+        res = super().trigger_pulse_generator()
+        if res and self.on_trigger is not None:
+            self.on_trigger()
+        return res
+
+
+def _mask_channels(mask: str) -> List[int]:
+    value = int(mask, 16)
+    return [c for c in range(1, NUM_CHANNELS + 1) if value >> (c - 1) & 1]
+
+
+def _channel_list(channels) -> List[int]:
+    return _mask_channels(channels) if isinstance(channels, str) else [int(c) for c in channels if c]
+
+
+def pulse_channels(mode: str, channel_pairs: List, output_channels: List) -> List[List[int]]:
+    """Channels each pulse of the n-plet goes through, cathodes and anodes together in bipolar mode"""
+    if mode == 'unipolar' or (mode != 'bipolar' and not channel_pairs):
+        return [_channel_list(channels) for channels in output_channels]
+    return [sorted(set(_channel_list(cathodes) + _channel_list(anodes))) for cathodes, anodes in channel_pairs]
+
+
+class ProtocolAnalyzer:
+    """Follows command files, sweeps and patterns without a device and analyzes the pulse trains they start
+
+    The state carries over from file to file like in a headless run. Every command is assumed to take
+    command_seconds, ramps take their duration and sweeps wait between steps like the SweepEngine.
+    """
+
+    def __init__(self, command_seconds: float = COMMAND_SECONDS):
+        self.command_seconds = command_seconds
+        self.device = DryRunController(on_trigger=self._triggered)
+        self.waited = 0.0
+        self.problems = []
+        self._maps = {}
+        self._chunks = []
+        self._rows = []
+
+    @property
+    def clock(self) -> float:
+        return self.device.frames * self.command_seconds + self.waited
+
+    def _channel_map(self, pulses: List[List[int]]) -> int:
+        key = json.dumps(pulses)
+        if key not in self._maps:
+            self._maps[key] = len(self._maps)
+        return self._maps[key]
+
+    def _current_channels(self) -> int:
+        return self._channel_map(pulse_channels(self.device.mode, self.device.channel_pairs,
+                                                self.device.output_channels))
+
+    def _triggered(self):
+        device = self.device
+        self._rows.append((self.clock, device.delay / 1000, device.num_nplets, device.repetition_rate,
+                           device.time_between, AMPLITUDE_UNITS[device.current_range], list(device.pulse_widths),
+                           list(device.pulse_amplitudes), self._current_channels(),
+                           device.pulse_generator_triggered))
+
+    def _flush_rows(self):
+        if not self._rows:
+            return
+        start, delay, nplets, rate, between, unit, widths, amplitudes, channels, on = zip(*self._rows)
+        padded_widths = np.zeros((len(widths), MAX_PULSES))
+        padded_amplitudes = np.zeros((len(widths), MAX_PULSES))
+        for i, (w, a) in enumerate(zip(widths, amplitudes)):
+            padded_widths[i, :len(w)] = w
+            padded_amplitudes[i, :len(a)] = a
+        self._chunks.append(Trains(np.array(start), np.array(delay), np.array(nplets), np.array(rate),
+                                   np.array(between), np.array(unit), padded_widths, padded_amplitudes,
+                                   np.array([len(w) for w in widths]), np.array(channels), np.array(on)))
+        self._rows = []
+
+    def add_command_file(self, path: str):
+        with open(path, "r") as f:
+            for number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split()
+                if parts[0] == 'ramp':
+                    self._ramp(path, number, parts[1:])
+                    continue
+                ok, out = run_command(self.device, line)
+                if not ok:
+                    self.problems.append("{}:{}: {}".format(path, number, out))
+
+    def _ramp(self, path: str, number: int, params: List[str]):
+        # the ramp ends at its target, the values on the way only take time
+        try:
+            if len(params) not in (4, 5):
+                raise ValueError("Ramp: incorrect number of parameters, expected 4 or 5")
+            ramp = Ramp(self.device, params[0], int(params[1]), int(params[2]), float(params[3]),
+                        params[4] if len(params) == 5 else 'linear')
+        except ValueError as e:
+            self.problems.append("{}:{}: {}".format(path, number, e))
+            return
+        self.waited += ramp.duration
+        RAMPS[ramp.parameter][0](self.device, ramp.target)
+
+    def add_pattern(self, params: Dict):
+        """A pattern as PatternCache takes it, applied to the current state and triggered once"""
+        self.device.send_encoded(compile_pattern(params).frames)
+        self.device.trigger_pulse_generator()
+
+    def add_sweep(self, sweep: Sweep):
+        """Steps of the sweep as trains
+
+        The step dicts are only read once to factorize each parameter, which values carry over, what gets sent
+        and the trains are computed on whole columns.
+        """
+        self._flush_rows()
+        steps = len(sweep)
+        if not steps:
+            return
+        device = self.device
+        index = np.arange(steps)
+        frames = np.zeros(steps, dtype=np.int64)
+        columns = {}
+        for name, (field, convert, _) in SETTERS.items():
+            values = [json.dumps(getattr(device, field))]
+            codes = {values[0]: 0}
+            column = np.full(steps, -1)
+            for i, step in enumerate(sweep.steps):
+                if name in step:
+                    key = json.dumps(convert(step[name]))
+                    if key not in codes:
+                        codes[key] = len(values)
+                        values.append(key)
+                    column[i] = codes[key]
+            present = column >= 0
+            # parameters missing from a step keep the value of the previous step, before the first one the device's
+            last = np.maximum.accumulate(np.where(present, index, -1))
+            filled = np.where(last >= 0, column[np.maximum(last, 0)], 0)
+            # every parameter of the first step, SweepEngine skips the ones the device already acknowledged
+            changed = present & np.concatenate(([True], filled[1:] != filled[:-1]))
+            frames += changed
+            columns[name] = (filled, [json.loads(value) for value in values])
+        if sweep.trigger:
+            frames += 1
+
+        waits = np.full(steps, sweep.between)
+        waits[-1] = 0
+        triggered = self.clock + np.cumsum(frames * self.command_seconds) + np.cumsum(waits) - waits
+        if sweep.trigger:
+            rate_codes, rates = columns['frequency']
+            width_codes, widths = columns['width']
+            amplitude_codes, amplitudes = columns['amplitude']
+            pair_codes, pairs = columns['channel_pairs']
+            mode = device.mode if device.mode != 'none' else 'bipolar'
+            channels = np.array([self._channel_map(pulse_channels(mode, value, device.output_channels))
+                                 for value in pairs])
+            width_table = np.zeros((len(widths), MAX_PULSES))
+            for i, value in enumerate(widths):
+                width_table[i, :len(value)] = value
+            amplitude_table = np.zeros((len(amplitudes), MAX_PULSES))
+            for i, value in enumerate(amplitudes):
+                amplitude_table[i, :len(value)] = value
+            self._chunks.append(Trains(
+                triggered, np.full(steps, device.delay / 1000), np.full(steps, device.num_nplets),
+                np.array(rates)[rate_codes], np.full(steps, device.time_between),
+                np.full(steps, AMPLITUDE_UNITS[device.current_range]), width_table[width_codes],
+                amplitude_table[amplitude_codes], np.array([len(value) for value in widths])[width_codes],
+                channels[pair_codes], (index % 2 == 0) != device.pulse_generator_triggered))
+
+        # the device keeps the values of the last step
+        for name, (field, _, _) in SETTERS.items():
+            filled, values = columns[name]
+            setattr(device, field, values[filled[-1]])
+        device.frames += int(frames.sum())
+        if sweep.trigger and steps % 2:
+            device.pulse_generator_triggered = not device.pulse_generator_triggered
+        self.waited += float(waits.sum())
+
+    def add_file(self, path: str):
+        """Command file, or a JSON sweep definition or pattern"""
+        if not path.endswith(".json"):
+            self.add_command_file(path)
+            return
+        with open(path, "r") as f:
+            definition = json.load(f)
+        if 'product' in definition or 'steps' in definition:
+            self.add_sweep(load_sweep(path))
+        else:
+            self.add_pattern(definition)
+
+    def trains(self) -> Optional[Trains]:
+        self._flush_rows()
+        if not self._chunks:
+            return None
+        return Trains(*(np.concatenate(column) for column in zip(*self._chunks)))
+
+    def analyze(self) -> ProtocolAnalysis:
+        trains = self.trains()
+        if trains is None:
+            return ProtocolAnalysis(0, np.zeros(0), [], 0, 0.0, self.clock, {}, {}, 0, 0, self.problems)
+        order = np.argsort(trains.start, kind='stable')
+        trains = Trains(*(column[order] for column in trains))
+        # a train of endless n-plets runs until the next trigger toggles it off, the last one forever
+        next_start = np.append(trains.start[1:], np.inf)
+        # triggers that toggle an endless train off start nothing, they only end the train before them
+        starts = (trains.nplets != 0) | trains.on
+        trains = Trains(*(column[starts] for column in trains))
+        next_start = next_start[starts]
+
+        # same formula as Controller.nplet_duration, over every train at once
+        nplet_duration = trains.widths.sum(axis=1) * 1e-6 + (trains.listed - 1) * trains.time_between * 1e-3
+        infeasible = np.nonzero(nplet_duration > 1 / trains.rate)[0].tolist()
+
+        endless = trains.nplets == 0
+        finite_end = trains.start + trains.delay + trains.nplets / trains.rate
+        ends = np.where(endless, next_start, finite_end)
+        count = np.where(endless, np.floor((ends - trains.start - trains.delay).clip(0) * trains.rate), trains.nplets)
+        pulses = count * (trains.widths > 0).sum(axis=1)
+        overlapping = int(np.count_nonzero(~endless[:-1] & (finite_end[:-1] > trains.start[1:])))
+
+        # charge of one pulse in μC: mA * μs / 1000
+        pulse_charge = trains.amplitudes * trains.unit[:, None] * trains.widths * 1e-3
+        train_charge = np.multiply(pulse_charge, count[:, None], out=np.zeros_like(pulse_charge),
+                                   where=pulse_charge > 0)
+        maps = np.zeros((len(self._maps), MAX_PULSES, NUM_CHANNELS), dtype=bool)
+        for key, i in self._maps.items():
+            for pulse, channels in enumerate(json.loads(key)[:MAX_PULSES]):
+                maps[i, pulse, [c - 1 for c in channels if 1 <= c <= NUM_CHANNELS]] = True
+        charge_by_map = np.zeros((len(self._maps), MAX_PULSES))
+        np.add.at(charge_by_map, trains.channels, train_charge)
+        peak_by_map = np.zeros((len(self._maps), MAX_PULSES))
+        np.maximum.at(peak_by_map, trains.channels, pulse_charge)
+        channel_charge = np.where(maps, charge_by_map[:, :, None], 0).sum(axis=(0, 1))
+        max_pulse_charge = np.where(maps, peak_by_map[:, :, None], 0).max(axis=(0, 1))
+        used = np.nonzero(maps.any(axis=(0, 1)))[0]
+
+        return ProtocolAnalysis(
+            trains=len(trains.start), nplet_duration=nplet_duration, infeasible=infeasible,
+            total_pulses=float(pulses.sum()), stimulation_seconds=float((ends - trains.start - trains.delay).sum()),
+            session_seconds=float(max(self.clock, ends.max())),
+            channel_charge={int(c) + 1: float(channel_charge[c]) for c in used},
+            max_pulse_charge={int(c) + 1: float(max_pulse_charge[c]) for c in used},
+            overlapping=overlapping, endless=int(np.count_nonzero(endless)), problems=self.problems)
+
+
+def analyze_files(paths: List[str], command_seconds: float = COMMAND_SECONDS) -> ProtocolAnalysis:
+    """Analyze command files, sweep definitions and patterns run one after another"""
+    analyzer = ProtocolAnalyzer(command_seconds)
+    for path in paths:
+        analyzer.add_file(path)
+    return analyzer.analyze()
+
+
+def format_analysis(analysis: ProtocolAnalysis) -> str:
+    lines = ["{} pulse trains, {:.0f} pulses, {:.1f} s of stimulation, session takes {:.1f} s".format(
+        analysis.trains, analysis.total_pulses, analysis.stimulation_seconds, analysis.session_seconds)]
+    if len(analysis.nplet_duration):
+        lines.append("n-plet duration {:.3f} - {:.3f} ms".format(analysis.nplet_duration.min() * 1000,
+                                                                analysis.nplet_duration.max() * 1000))
+    for channel, charge in analysis.channel_charge.items():
+        lines.append("channel {}: {:.1f} μC total, {:.3f} μC max per pulse".format(
+            channel, charge, analysis.max_pulse_charge[channel]))
+    if analysis.infeasible:
+        lines.append("{} trains have n-plets longer than the repetition period, first is train {}".format(
+            len(analysis.infeasible), analysis.infeasible[0]))
+    if analysis.overlapping:
+        lines.append("{} trains are still running when the next one is triggered".format(analysis.overlapping))
+    if analysis.endless:
+        lines.append("{} trains have endless n-plets (nplets 0) and run until the next trigger".format(
+            analysis.endless))
+    lines.extend(analysis.problems)
+    return "\n".join(lines)
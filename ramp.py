@@ -0,0 +1,113 @@
+import math
+import threading
+import time
+from collections import namedtuple
+from typing import Optional
+
+from controller import Controller
+
+# Rampable parameter -> (controller setter, minimum, maximum)
+RAMPS = {
+    'amplitude': (lambda device, value: device.set_amplitude([value]), 0, 1000),
+    'frequency': (lambda device, value: device.set_repetition_rate(value), 1, 400),
+    'voltage': (lambda device, value: device.set_voltage(value), 70, 150),
+}
+
+# sent: values sent, dropped: intermediate values skipped because the link was busy,
+# failed: values the device did not acknowledge, late: seconds the final value was sent after the deadline
+RampResult = namedtuple('RampResult', ['sent', 'dropped', 'failed', 'late', 'aborted'])
+
+
+class Ramp:
+    """Ramp a parameter from start to target in duration seconds
+
+    Values are sent as fast as the link acknowledges them, intermediate values the link can't keep up with are
+    dropped. The target value is always sent last.
+
+    :param curve: 'linear' or 'exponential' (constant ratio per time, start and target must be positive)
+    """
+
+    def __init__(self, device: Controller, parameter: str, start: int, target: int, duration: float,
+                 curve: str = 'linear'):
+        if parameter not in RAMPS:
+            raise ValueError("Can't ramp {}, use one of {}".format(parameter, list(RAMPS)))
+        _, minimum, maximum = RAMPS[parameter]
+        for value in (start, target):
+            if value < minimum or value > maximum:
+                raise ValueError("Ramp values for {} must be between {} and {}, was {}"
+                                 .format(parameter, minimum, maximum, value))
+        if curve not in ('linear', 'exponential'):
+            raise ValueError("Curve must be 'linear' or 'exponential', was {}".format(curve))
+        if curve == 'exponential' and (start <= 0 or target <= 0):
+            raise ValueError("Exponential ramp needs positive start and target values")
+        if duration < 0:
+            raise ValueError("Ramp duration must be positive, was {}".format(duration))
+
+        self.device = device
+        self.parameter = parameter
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.curve = curve
+        self._abort = threading.Event()
+
+    def abort(self):
+        self._abort.set()
+
+    def value_at(self, elapsed: float) -> int:
+        if self.duration == 0 or elapsed >= self.duration:
+            return self.target
+        fraction = max(elapsed, 0) / self.duration
+        if self.curve == 'linear':
+            value = self.start + (self.target - self.start) * fraction
+        else:
+            value = self.start * (self.target / self.start) ** fraction
+        return int(round(value))
+
+    def time_of(self, value: float) -> float:
+        """Elapsed time at which the curve reaches value"""
+        if self.start == self.target:
+            return self.duration
+        if self.curve == 'linear':
+            fraction = (value - self.start) / (self.target - self.start)
+        else:
+            fraction = math.log(value / self.start) / math.log(self.target / self.start)
+        return min(max(fraction, 0.0), 1.0) * self.duration
+
+    def run(self) -> RampResult:
+        send = RAMPS[self.parameter][0]
+        direction = 1 if self.target >= self.start else -1
+        sent = dropped = failed = 0
+        last = None
+        round_trip = 0.0
+        t0 = time.perf_counter()
+
+        while not self._abort.is_set():
+            elapsed = time.perf_counter() - t0
+            # start the final command early enough for it to be acknowledged by the deadline
+            if elapsed + round_trip >= self.duration:
+                break
+            value = self.value_at(elapsed)
+            if value != last:
+                if last is not None:
+                    dropped += max(abs(value - last) - 1, 0)
+                start = time.perf_counter()
+                if not send(self.device, value):
+                    failed += 1
+                took = time.perf_counter() - start
+                round_trip = took if not sent else 0.8 * round_trip + 0.2 * took
+                sent += 1
+                last = value
+            # sleep until the curve reaches the next value (rounding happens halfway)
+            next_change = t0 + self.time_of(value + direction * 0.5)
+            self._abort.wait(max(min(next_change, t0 + self.duration - round_trip) - time.perf_counter(), 0))
+
+        aborted = self._abort.is_set()
+        if not aborted and last != self.target:
+            if last is not None:
+                dropped += max(abs(self.target - last) - 1, 0)
+            if not send(self.device, self.target):
+                failed += 1
+            sent += 1
+        late = max(time.perf_counter() - (t0 + self.duration), 0.0)
+        return RampResult(sent, dropped, failed, late, aborted)
@@ -0,0 +1,59 @@
+import threading
+import time
+from typing import Callable, Set
+
+from controller import Controller
+
+
+class StateRefresher:
+    """Coalesces controller state changes and renders them at most max_fps times a second
+
+    The controller only marks fields dirty, render(fields) is called with every field changed since the
+    previous render either from flush() or from the background thread started with start().
+    """
+
+    def __init__(self, device: Controller, render: Callable[[Set[str]], None], max_fps: float = 20):
+        self.device = device
+        self.render = render
+        self.interval = 1 / max_fps
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._last_render = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+        device.add_state_listener(self._state_changed)
+
+    def _state_changed(self, name: str, value):
+        with self._lock:
+            self._dirty.add(name)
+
+    def mark_dirty(self, *names: str):
+        with self._lock:
+            self._dirty.update(names)
+
+    def flush(self, force: bool = False) -> bool:
+        """Render pending changes if the frame interval has passed, returns True if something was rendered"""
+        now = time.monotonic()
+        with self._lock:
+            if not self._dirty or (not force and now - self._last_render < self.interval):
+                return False
+            dirty = self._dirty
+            self._dirty = set()
+            self._last_render = now
+        self.render(dirty)
+        return True
+
+    def start(self):
+        """Flush periodically on a background thread, for UIs without their own timers"""
+        self._thread = threading.Thread(target=self._run, name="state-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.device.remove_state_listener(self._state_changed)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
@@ -0,0 +1,180 @@
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from typing import Iterable, List, Optional, Tuple
+
+import xlsxwriter
+
+RESULTS_DATABASE = "./results/results.db"
+
+# Hand map zones in the order of the result sheet columns, NO marks a stimulus that was not felt
+ZONES = ["K1", "K2", "KE", "KK", "KN", "KP", "KPE", "KS1", "KS2", "KSE", "KSK", "KSN", "KSP", "KSPE", "NO"]
+PARAMETER_COLUMNS = ["voltage", "nplets", "amplitude", "frequency", "width", "cathode", "anode"]
+
+Result = namedtuple('Result', ['id', 'session', 't', 'voltage', 'nplets', 'amplitude', 'current_range', 'frequency',
+                               'width', 'cathode', 'anode', 'zones'])
+
+# Amplitude in mA, NULL for stimuli stored without their current range
+AMPLITUDE_MA = "s.amplitude / CASE s.current_range WHEN 'high' THEN 10.0 WHEN 'low' THEN 100.0 END"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    electrode_id TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS stimuli (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions(id),
+    t REAL NOT NULL,
+    voltage INTEGER,
+    nplets INTEGER,
+    amplitude INTEGER,
+    current_range TEXT,
+    frequency INTEGER,
+    width INTEGER,
+    cathode INTEGER,
+    anode INTEGER
+);
+CREATE TABLE IF NOT EXISTS responses (
+    stimulus INTEGER NOT NULL REFERENCES stimuli(id),
+    zone TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stimuli_session ON stimuli(session);
+CREATE INDEX IF NOT EXISTS stimuli_pair ON stimuli(cathode, anode);
+CREATE INDEX IF NOT EXISTS stimuli_amplitude ON stimuli(amplitude);
+CREATE INDEX IF NOT EXISTS responses_zone ON responses(zone, stimulus);
+CREATE INDEX IF NOT EXISTS responses_stimulus ON responses(stimulus);
+"""
+
+
+class ResultsStore:
+    """Stimulation results of every session in one SQLite database
+
+    Each stimulus is stored with its parameters (amplitude in device units, w/100 mA on low range and w/10 mA on
+    high range, with the range), the electrode pair and the hand map zones the participant marked. Stimuli are
+    buffered and written in one transaction per batch, the database runs in WAL mode so queries don't block a
+    session that is writing.
+
+    :param batch_size: number of buffered stimuli that triggers a write, flush() writes the rest
+    """
+
+    def __init__(self, path: str = RESULTS_DATABASE, batch_size: int = 50):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # databases from before the current range was stored
+        if 'current_range' not in [row[1] for row in self._db.execute("PRAGMA table_info(stimuli)")]:
+            with self._db:
+                self._db.execute("ALTER TABLE stimuli ADD COLUMN current_range TEXT")
+
+    def start_session(self, electrode_id: str = "", started: Optional[float] = None) -> int:
+        with self._db:
+            cursor = self._db.execute("INSERT INTO sessions (started, electrode_id) VALUES (?, ?)",
+                                      (started or time.time(), electrode_id))
+        return cursor.lastrowid
+
+    def add(self, session: int, voltage: int, nplets: int, amplitude: int, frequency: int, width: int,
+            cathode: int, anode: int, zones: Iterable[str], t: Optional[float] = None,
+            current_range: Optional[str] = None):
+        """Buffer one stimulus and the zones marked for it, a zone marked more than once is stored once
+
+        :param current_range: 'low' or 'high', the range the amplitude was given in
+        """
+        zones = list(dict.fromkeys(zones))
+        unknown = set(zones) - set(ZONES)
+        if unknown:
+            raise ValueError("Unknown zones {}, use {}".format(sorted(unknown), ZONES))
+        if current_range not in (None, 'low', 'high'):
+            raise ValueError("Current range must be 'low' or 'high', was {}".format(current_range))
+        self._pending.append((session, t or time.time(), voltage, nplets, amplitude, current_range, frequency, width,
+                              cathode, anode, zones))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered stimuli in one transaction"""
+        if not self._pending:
+            return
+        with self._db:
+            for *stimulus, zones in self._pending:
+                cursor = self._db.execute(
+                    "INSERT INTO stimuli (session, t, voltage, nplets, amplitude, current_range, frequency, width, "
+                    "cathode, anode) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", stimulus)
+                self._db.executemany("INSERT INTO responses (stimulus, zone) VALUES (?, ?)",
+                                     [(cursor.lastrowid, zone) for zone in zones])
+        self._pending = []
+
+    def query(self, zone: Optional[str] = None, min_amplitude: Optional[int] = None,
+              max_amplitude: Optional[int] = None, cathode: Optional[int] = None, anode: Optional[int] = None,
+              session: Optional[int] = None, current_range: Optional[str] = None, min_ma: Optional[float] = None,
+              max_ma: Optional[float] = None) -> List[Result]:
+        """Stimuli matching every given condition, in the order they were given
+
+        e.g. store.query(zone="KP", max_ma=0.99) for all stimuli below 1 mA that were felt in KP. The amplitude
+        bounds are inclusive, min_amplitude and max_amplitude are in device units and only comparable within one
+        current range, the mA bounds leave out stimuli stored without their range.
+        """
+        self.flush()
+        conditions = []
+        params = []
+        if zone is not None:
+            conditions.append("s.id IN (SELECT stimulus FROM responses WHERE zone = ?)")
+            params.append(zone)
+        for column, operator, value in (("s.amplitude", ">=", min_amplitude), ("s.amplitude", "<=", max_amplitude),
+                                        ("s.cathode", "=", cathode), ("s.anode", "=", anode),
+                                        ("s.session", "=", session), ("s.current_range", "=", current_range),
+                                        (AMPLITUDE_MA, ">=", min_ma), (AMPLITUDE_MA, "<=", max_ma)):
+            if value is not None:
+                conditions.append("{} {} ?".format(column, operator))
+                params.append(value)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        rows = self._db.execute(
+            "SELECT s.id, s.session, s.t, s.voltage, s.nplets, s.amplitude, s.current_range, s.frequency, s.width, "
+            "s.cathode, s.anode, group_concat(r.zone) FROM stimuli s LEFT JOIN responses r ON r.stimulus = s.id "
+            "{} GROUP BY s.id ORDER BY s.id".format(where), params)
+        return [Result(*row[:-1], row[-1].split(",") if row[-1] else []) for row in rows]
+
+    def zone_masks(self) -> List[Tuple[int, int, int, int, int]]:
+        """(session, amplitude, cathode, anode, zones) of every stimulus, zones as a bitmask with bit i for ZONES[i]"""
+        self.flush()
+        bits = " ".join("WHEN '{}' THEN {}".format(zone, 1 << i) for i, zone in enumerate(ZONES))
+        return self._db.execute(
+            "SELECT s.session, s.amplitude, s.cathode, s.anode, COALESCE(SUM(DISTINCT CASE r.zone {} ELSE 0 END), 0) "
+            "FROM stimuli s LEFT JOIN responses r ON r.stimulus = s.id GROUP BY s.id ORDER BY s.id".format(bits)
+        ).fetchall()
+
+    def pairs(self, zone: str, max_ma: Optional[float] = None) -> List[Tuple[int, int]]:
+        """Distinct (cathode, anode) pairs that elicited a response in zone, at or below max_ma milliamperes"""
+        return sorted({(result.cathode, result.anode) for result in self.query(zone, max_ma=max_ma)})
+
+    def export_xlsx(self, path: str, **conditions) -> int:
+        """Write the stimuli matching the query conditions in the layout of the session result sheets
+
+        :return: number of rows written
+        """
+        results = self.query(**conditions)
+        workbook = xlsxwriter.Workbook(path)
+        worksheet = workbook.add_worksheet()
+        for col, label in enumerate(PARAMETER_COLUMNS + ZONES):
+            worksheet.write(0, col, label)
+        zone_columns = {zone: len(PARAMETER_COLUMNS) + i for i, zone in enumerate(ZONES)}
+        for row, result in enumerate(results, start=1):
+            for col, name in enumerate(PARAMETER_COLUMNS):
+                worksheet.write(row, col, getattr(result, name))
+            for zone in result.zones:
+                worksheet.write(row, zone_columns[zone], "X")
+        workbook.close()
+        return len(results)
+
+    def close(self):
+        self.flush()
+        self._db.close()
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Tuple, Union
+
+from commands import run_command
+from controller import Controller, STATE_FIELDS
+from sweep import SETTERS, apply_step, current_step
+
+# Frames are length-prefixed: uint32 payload length followed by the payload, all big-endian.
+# Request payload:  uint8 opcode, uint32 request id, body
+# Response payload: uint32 request id, uint8 status, uint32 handling time (μs), body
+LENGTH = struct.Struct('!I')
+REQUEST = struct.Struct('!BI')
+RESPONSE = struct.Struct('!IBI')
+MAX_PAYLOAD = 64 * 1024
+
+OP_COMMAND = 1  # body: text command, same syntax as the TUI prompt
+OP_PROFILE = 2  # body: JSON object of sweep parameters, only changed parameters are sent
+OP_TRIGGER = 3  # no body
+OP_STOP = 4  # no body, emergency stop, bypasses the request queue
+OP_STATE = 5  # no body, returns the device state as JSON
+
+STATUS_OK = 0
+STATUS_FAILED = 1  # the device did not acknowledge
+STATUS_BAD_REQUEST = 2
+
+Reply = namedtuple('Reply', ['status', 'latency_us', 'body'])
+
+
+def _read_exact(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def read_frame(sock: socket.socket) -> bytes:
+    (size,) = LENGTH.unpack(_read_exact(sock, LENGTH.size))
+    if size > MAX_PAYLOAD:
+        raise ValueError("Frame of {} bytes is too large".format(size))
+    return _read_exact(sock, size)
+
+
+def write_frame(sock: socket.socket, payload: bytes):
+    sock.sendall(LENGTH.pack(len(payload)) + payload)
+
+
+def parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """host:port for localhost TCP, anything else is a Unix domain socket path"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        if isinstance(self.request, socket.socket) and self.request.family != socket.AF_UNIX:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                payload = read_frame(self.request)
+            except (ConnectionError, OSError, ValueError):
+                break
+            start = time.perf_counter()
+            if len(payload) < REQUEST.size:
+                request_id, status, body = 0, STATUS_BAD_REQUEST, b'Request too short'
+            else:
+                opcode, request_id = REQUEST.unpack_from(payload)
+                status, body = self.server.execute(opcode, payload[REQUEST.size:])
+            latency_us = int((time.perf_counter() - start) * 10 ** 6)
+            self.server.record_latency(latency_us)
+            try:
+                write_frame(self.request, RESPONSE.pack(request_id, status, latency_us) + body)
+            except OSError:
+                break
+
+
+class ControllerServer:
+    """Exposes a controller to other local processes
+
+    Any number of clients can connect, device access is serialized so that a profile is always applied as a
+    whole. Emergency stops skip the line.
+    """
+
+    def __init__(self, device: Controller, address: str):
+        self.device = device
+        self.address = parse_address(address)
+        self._device_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.total_latency_us = 0
+        self.max_latency_us = 0
+
+        if isinstance(self.address, tuple):
+            server_class = socketserver.ThreadingTCPServer
+        else:
+            server_class = socketserver.ThreadingUnixStreamServer
+            # a socket file left behind by a server that did not shut down cleanly would fail the bind
+            if os.path.exists(self.address) and stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.unlink(self.address)
+        server_class.allow_reuse_address = True
+        server_class.daemon_threads = True
+        self._server = server_class(self.address, RequestHandler)
+        self._server.execute = self.execute
+        self._server.record_latency = self.record_latency
+
+    def record_latency(self, latency_us: int):
+        with self._stats_lock:
+            self.requests += 1
+            self.total_latency_us += latency_us
+            self.max_latency_us = max(self.max_latency_us, latency_us)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            mean = self.total_latency_us / self.requests if self.requests else 0
+            return {'requests': self.requests, 'mean_latency_us': mean, 'max_latency_us': self.max_latency_us}
+
+    def execute(self, opcode: int, body: bytes) -> Tuple[int, bytes]:
+        try:
+            if opcode == OP_STOP:
+                report = self.device.emergency_stop()
+                return self._status(report.acknowledged), json.dumps(report._asdict()).encode()
+            if opcode == OP_STATE:
+                state = {name: getattr(self.device, name) for name in STATE_FIELDS}
+                return STATUS_OK, json.dumps(state).encode()
+            with self._device_lock:
+                if opcode == OP_COMMAND:
+                    ok, out = run_command(self.device, body.decode('utf-8'))
+                    return self._status(ok), out.encode('utf-8')
+                if opcode == OP_PROFILE:
+                    profile = json.loads(body)
+                    if not isinstance(profile, dict):
+                        raise ValueError("Profile must be a JSON object of sweep parameters")
+                    unknown = set(profile) - set(SETTERS)
+                    if unknown:
+                        raise ValueError("Unknown profile parameters: {}, use {}".format(sorted(unknown),
+                                                                                         list(SETTERS)))
+                    _, failed = apply_step(self.device, profile, current_step(self.device))
+                    return self._status(not failed), json.dumps(failed).encode()
+                if opcode == OP_TRIGGER:
+                    return self._status(self.device.trigger_pulse_generator()), b''
+            return STATUS_BAD_REQUEST, "Unknown opcode {}".format(opcode).encode()
+        except (ValueError, TypeError, KeyError) as e:
+            # bad JSON, parameter values of the wrong type or out of range
+            return STATUS_BAD_REQUEST, str(e).encode('utf-8')
+
+    @staticmethod
+    def _status(ok: bool) -> int:
+        return STATUS_OK if ok else STATUS_FAILED
+
+    def serve_forever(self):
+        logging.info("Serving controller on {}".format(self.address))
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class RemoteController:
+    """Client for ControllerServer, one request at a time per client"""
+
+    def __init__(self, address: str):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self._sock = socket.create_connection(address)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(address)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._sock.close()
+
+    def request(self, opcode: int, body: bytes = b'') -> Reply:
+        with self._lock:
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+            write_frame(self._sock, REQUEST.pack(opcode, self._next_id) + body)
+            payload = read_frame(self._sock)
+        request_id, status, latency_us = RESPONSE.unpack_from(payload)
+        if request_id != self._next_id:
+            raise ConnectionError("Response to request {} while waiting for {}".format(request_id, self._next_id))
+        return Reply(status, latency_us, payload[RESPONSE.size:])
+
+    def command(self, text: str) -> Reply:
+        return self.request(OP_COMMAND, text.encode('utf-8'))
+
+    def apply_profile(self, profile: Dict) -> Reply:
+        return self.request(OP_PROFILE, json.dumps(profile).encode())
+
+    def trigger(self) -> Reply:
+        return self.request(OP_TRIGGER)
+
+    def stop(self) -> Reply:
+        return self.request(OP_STOP)
+
+    def state(self) -> Dict:
+        return json.loads(self.request(OP_STATE).body)
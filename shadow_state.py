@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from controller import STATE_FIELDS, Controller
+
+STATE_DIRECTORY = "./state"
+
+# Battery level is read from the device, not set by us
+PERSISTED_FIELDS = tuple(field for field in STATE_FIELDS if field != 'battery_state')
+
+
+def _channels_type(channels: List) -> str:
+    """value_type the channels were given in, hex strings or lists of channel numbers"""
+    first = channels[0] if channels else None
+    if isinstance(first, (list, tuple)):
+        first = first[0]
+    return 'hex' if isinstance(first, str) else 'list'
+
+
+def _channel_frame(device: Controller) -> Optional[tuple]:
+    if device.mode == 'bipolar' and device.channel_pairs and 'channel_pairs' in device.acknowledged:
+        return ('channel_pairs', device.channel_pairs,
+                Controller.encode_pulses_bipolar(device.channel_pairs, _channels_type(device.channel_pairs)))
+    if (device.mode == 'unipolar' and device.output_channels and not device.is_short_protocol
+            and 'output_channels' in device.acknowledged):
+        return ('output_channels', device.output_channels,
+                Controller.encode_pulses_unipolar(device.output_channels, _channels_type(device.output_channels)))
+    return None
+
+
+# Parameters that decide what the participant feels, re-asserted on resync in this order.
+# The DC/DC converter and the pulse generator are never switched by a resync.
+CRITICAL_FRAMES = (
+    ('current_range', Controller.encode_current_range),
+    ('voltage', Controller.encode_voltage),
+    ('mode', Controller.encode_mode),
+    ('num_nplets', Controller.encode_num_nplets),
+    ('delay', Controller.encode_delay),
+    ('time_between', Controller.encode_time_between),
+    ('repetition_rate', Controller.encode_repetition_rate),
+    ('pulse_widths', Controller.encode_pulse_widths),
+    ('pulse_amplitudes', Controller.encode_amplitudes),
+)
+
+
+def resync_frames(device: Controller) -> List[tuple]:
+    """(field, value, frame) re-asserting the controller's state-critical parameters, for send_encoded
+
+    Only parameters the device has acknowledged are included, the controller's defaults were never sent and
+    may not be what the device runs with (e.g. high current range, endless n-plets).
+    """
+    frames = []
+    for field, encode in CRITICAL_FRAMES:
+        if field not in device.acknowledged:
+            continue
+        value = getattr(device, field)
+        if field == 'mode' and value not in ('unipolar', 'bipolar'):
+            continue
+        frames.append((field, value, encode(value)))
+    if device.mode == 'unipolar' and not device.is_short_protocol and 'common_electrode' in device.acknowledged:
+        frames.append(('common_electrode', device.common_electrode,
+                       Controller.encode_common_electrode(device.common_electrode)))
+    channels = _channel_frame(device)
+    if channels is not None:
+        frames.append(channels)
+    return frames
+
+
+class ShadowState:
+    """Last acknowledged device state of one port, persisted to disk
+
+    Setters only assign state fields once the device has acknowledged them, so every state change is written to
+    a JSON file named after the port, on top of the state saved by earlier sessions. The file is replaced
+    atomically by a background thread, so a crash leaves either the previous or the new state behind and the
+    command path never waits for the disk.
+
+    :param directory: directory of the state files, one per port
+    """
+
+    def __init__(self, device: Controller, directory: str = STATE_DIRECTORY):
+        self.device = device
+        self.directory = directory
+        self.path = os.path.join(directory, "state-{}.json".format(re.sub(r'[^\w.-]', '_', str(device.port))))
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._previous = {field: value for field, value in (self.saved() or {}).items() if field in PERSISTED_FIELDS}
+        self._dirty = threading.Event()
+        self._stopped = False
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="shadow-state", daemon=True)
+        self._thread.start()
+        device.add_state_listener(self._changed)
+
+    def _changed(self, field: str, value):
+        if field in PERSISTED_FIELDS:
+            self._dirty.set()
+
+    def saved(self) -> Optional[Dict]:
+        """State stored for this port, None if there is none or it can't be read"""
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)['state']
+        except (OSError, ValueError, KeyError) as e:
+            logging.info("No saved state in {}: {}".format(self.path, e))
+            return None
+
+    def restore(self) -> bool:
+        """Set the controller's state from the saved state without sending anything to the device
+
+        :return: False if there was no saved state
+        """
+        state = self.saved()
+        if state is None:
+            return False
+        for field, value in state.items():
+            if field in PERSISTED_FIELDS:
+                setattr(self.device, field, value)
+        return True
+
+    def resync(self) -> List[str]:
+        """Send the controller's state-critical parameters to the device again, pipelined on the link
+
+        :return: names of the fields the device did not acknowledge
+        """
+        start = time.perf_counter()
+        frames = resync_frames(self.device)
+        results = self.device.send_encoded(frames)
+        failed = [field for (field, _, _), res in zip(frames, results) if not res]
+        logging.info("Resynced {} parameters in {:.1f} ms, failed: {}".format(
+            len(frames), (time.perf_counter() - start) * 1000, failed))
+        return failed
+
+    def flush(self):
+        """Write the acknowledged state now, fields this session hasn't acknowledged keep their saved value"""
+        state = dict(self._previous)
+        state.update({field: getattr(self.device, field) for field in PERSISTED_FIELDS
+                      if field in self.device.acknowledged})
+        data = {'port': self.device.port, 'saved': time.time(), 'state': state}
+        with self._write_lock:
+            # write to a temporary file first so a crash never leaves a partial state behind
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+            self.writes += 1
+
+    def close(self):
+        """Stop following the controller and write the last state"""
+        self.device.remove_state_listener(self._changed)
+        self._stopped = True
+        self._dirty.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                logging.error("Saving device state to {} failed: {}".format(self.path, e))
+            if self._stopped:
+                break
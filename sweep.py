@@ -0,0 +1,342 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Tuple
+
+from controller import Controller
+from profiling import span
+
+# Sweepable parameters in the order they are sent to the device within one step,
+# each with the controller state field it sets, conversion to the field value and the frame encoder.
+# Amplitude is in device units (w/100 mA on low range), width in μs, frequency in pps.
+SETTERS = {
+    'voltage': ('voltage', lambda value: value, Controller.encode_voltage),
+    'frequency': ('repetition_rate', lambda value: value, Controller.encode_repetition_rate),
+    'width': ('pulse_widths', lambda value: [value], Controller.encode_pulse_widths),
+    'amplitude': ('pulse_amplitudes', lambda value: [value], Controller.encode_amplitudes),
+    'channel_pairs': ('channel_pairs', lambda value: value, Controller.encode_pulses_bipolar),
+}
+
+SweepProgress = namedtuple('SweepProgress', ['index', 'total', 'step', 'changed', 'failed'])
+
+
+class Sweep:
+    """Ordered list of sweep steps, each step a dict of parameter name -> value"""
+
+    def __init__(self, steps: List[Dict], between: float = 0.0, trigger: bool = True,
+                 optimize_order: Optional[Dict] = None):
+        for step in steps:
+            unknown = set(step) - set(SETTERS)
+            if unknown:
+                raise ValueError("Unknown sweep parameters: {}, use {}".format(sorted(unknown), list(SETTERS)))
+        if between < 0:
+            raise ValueError("Time between steps must be positive, was {}".format(between))
+        self.steps = list(steps)
+        self.between = between
+        self.trigger = trigger
+        # Constraints for ordering.order_sweep ({'blocks': [...], 'fixed': [...]}), None to run in the given order
+        self.optimize_order = optimize_order
+
+    @classmethod
+    def product(cls, between: float = 0.0, trigger: bool = True, **dimensions) -> 'Sweep':
+        """Cartesian product of the given dimensions, the first dimension changes slowest
+
+        e.g. Sweep.product(amplitude=[100, 150], channel_pairs=[[([1], [2])], [([3], [4])]])
+        """
+        names = list(dimensions)
+        steps = [dict(zip(names, values)) for values in itertools.product(*dimensions.values())]
+        return cls(steps, between=between, trigger=trigger)
+
+    @classmethod
+    def from_list(cls, steps: List[Dict], between: float = 0.0, trigger: bool = True) -> 'Sweep':
+        """Explicit list of steps, parameters missing from a step keep their previous value"""
+        return cls(steps, between=between, trigger=trigger)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+
+def load_sweep(path: str) -> Sweep:
+    """Load a sweep definition from a JSON file
+
+    Either {"product": {"amplitude": [100, 150], ...}} or {"steps": [{"amplitude": 100}, ...]},
+    optionally with "between" (seconds) and "trigger". Channel pairs are given as [[[cathodes], [anodes]], ...].
+    "optimize_order": true lets the steps be reordered to send fewer commands, or
+    {"blocks": [lengths of consecutive blocks], "fixed": [indices of blocks kept in order]} to constrain it.
+    """
+    with open(path, "r") as f:
+        definition = json.load(f)
+    between = definition.get('between', 0.0)
+    trigger = definition.get('trigger', True)
+    if 'product' in definition:
+        sweep = Sweep.product(between=between, trigger=trigger, **definition['product'])
+    elif 'steps' in definition:
+        sweep = Sweep.from_list(definition['steps'], between=between, trigger=trigger)
+    else:
+        raise ValueError("Sweep definition {} must have either 'product' or 'steps'".format(path))
+    optimize_order = definition.get('optimize_order', False)
+    if optimize_order:
+        sweep.optimize_order = optimize_order if isinstance(optimize_order, dict) else {}
+    return sweep
+
+
+def changed_parameters(step: Dict, previous: Optional[Dict] = None) -> List[str]:
+    """Parameters of step that differ from the previous step, in sending order"""
+    previous = previous or {}
+    return [name for name in SETTERS if name in step and (name not in previous or previous[name] != step[name])]
+
+
+def current_step(device: Controller) -> Dict:
+    """Sweep parameters as the device acknowledged them, for sending only what differs from the device state
+
+    Parameters still at the controller's defaults are left out, the device may run with other values.
+    """
+    acknowledged = device.acknowledged
+    step = {}
+    if 'voltage' in acknowledged:
+        step['voltage'] = device.voltage
+    if 'repetition_rate' in acknowledged:
+        step['frequency'] = device.repetition_rate
+    if 'pulse_widths' in acknowledged and len(device.pulse_widths) == 1:
+        step['width'] = device.pulse_widths[0]
+    if 'pulse_amplitudes' in acknowledged and len(device.pulse_amplitudes) == 1:
+        step['amplitude'] = device.pulse_amplitudes[0]
+    if 'channel_pairs' in acknowledged and device.channel_pairs:
+        step['channel_pairs'] = device.channel_pairs
+    return step
+
+
+def apply_step(device: Controller, step: Dict, previous: Optional[Dict] = None) -> Tuple[List[str], List[str]]:
+    """Send only the parameters of step that changed since previous, pipelined on the link
+
+    :return: names of the changed parameters and names of the parameters the device did not acknowledge
+    """
+    changed = changed_parameters(step, previous)
+    frames = []
+    for name in changed:
+        field, convert, encode = SETTERS[name]
+        value = convert(step[name])
+        frames.append((field, value, encode(value)))
+    results = device.send_encoded(frames)
+    failed = [name for name, res in zip(changed, results) if not res]
+    return changed, failed
+
+
+class SweepEngine:
+    """Runs a sweep on the calling thread, meant to be run off the GUI thread
+
+    A step is only sent once every command of the previous step has been acknowledged by the device,
+    so commands never pile up ahead of the link.
+    """
+
+    def __init__(self, device: Controller, sweep: Sweep,
+                 on_progress: Optional[Callable[[SweepProgress], None]] = None):
+        self.device = device
+        self.sweep = sweep
+        self.on_progress = on_progress
+        self.commands_sent = 0
+        self.failures = []
+        self._resume = threading.Event()
+        self._resume.set()
+        self._abort = threading.Event()
+
+    @property
+    def aborted(self) -> bool:
+        return self._abort.is_set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resume.is_set()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def abort(self):
+        self._abort.set()
+        self._resume.set()
+
+    def _wait_if_paused(self):
+        while not self._resume.wait(0.1):
+            pass
+
+    def run(self) -> bool:
+        """Run every step of the sweep, returns True if all commands succeeded and the sweep was not aborted"""
+        # the first step only sends what differs from the device, which other tabs or the TUI may have changed
+        previous = current_step(self.device)
+        total = len(self.sweep)
+        for index, step in enumerate(self.sweep):
+            self._wait_if_paused()
+            if self._abort.is_set():
+                break
+
+            with span('sweep_step', category='sweep'):
+                changed, failed = apply_step(self.device, step, previous)
+                self.commands_sent += len(changed)
+                # a stop may have come in while the parameters were sent, never trigger after it
+                if self._abort.is_set():
+                    break
+                if self.sweep.trigger:
+                    self.commands_sent += 1
+                    if not self.device.trigger_pulse_generator():
+                        failed.append('trigger')
+
+            previous.update(step)
+            # Failed parameters are in unknown state on the device, so send them again on next step
+            for name in failed:
+                previous.pop(name, None)
+            if failed:
+                logging.warning("Sweep step {} failed for {}".format(index, failed))
+                self.failures.append((index, failed))
+
+            if self.on_progress is not None:
+                self.on_progress(SweepProgress(index, total, step, changed, failed))
+
+            if index < total - 1:
+                self._abort.wait(self.sweep.between)
+
+        return not self.failures and not self._abort.is_set()
+
+
+class SweepJob:
+    """Sweep submitted to a SweepRunner, state is one of the class constants"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    ABORTED = 'aborted'
+    REJECTED = 'rejected'
+
+    _ids = itertools.count(1)
+
+    def __init__(self, sweep: Sweep, on_progress: Optional[Callable[['SweepJob', SweepProgress], None]] = None,
+                 on_state: Optional[Callable[['SweepJob'], None]] = None):
+        self.id = next(self._ids)
+        self.sweep = sweep
+        self.state = None
+        self.engine = None
+        self.on_progress = on_progress
+        self.on_state = on_state
+
+    @property
+    def done(self) -> bool:
+        return self.state in (self.FINISHED, self.FAILED, self.ABORTED, self.REJECTED)
+
+    def _set_state(self, state: str):
+        self.state = state
+        if self.on_state is not None:
+            self.on_state(self)
+
+    def _progress(self, progress: SweepProgress):
+        if self.on_progress is not None:
+            self.on_progress(self, progress)
+
+    def pause(self):
+        if self.engine is not None:
+            self.engine.pause()
+
+    def resume(self):
+        if self.engine is not None:
+            self.engine.resume()
+
+    def abort(self):
+        if self.engine is not None:
+            self.engine.abort()
+
+
+class SweepRunner:
+    """Long-lived worker thread that runs submitted sweep jobs one at a time
+
+    :param queue_overlapping: queue jobs submitted while another job is running instead of rejecting them
+    :param max_queued: maximum number of jobs waiting behind the running one
+    """
+
+    def __init__(self, device: Controller, queue_overlapping: bool = False, max_queued: int = 8):
+        self.device = device
+        self.queue_overlapping = queue_overlapping
+        self.current = None
+        self._active = 0
+        self._jobs = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        # Set while no job is running
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = threading.Thread(target=self._run, name="sweep-runner", daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self) -> bool:
+        return self._active > 0
+
+    def submit(self, job: SweepJob) -> bool:
+        """Queue a job, returns False if it was rejected"""
+        with self._lock:
+            if self.busy and not self.queue_overlapping:
+                job._set_state(SweepJob.REJECTED)
+                return False
+            job.engine = SweepEngine(self.device, job.sweep, on_progress=job._progress)
+            try:
+                self._jobs.put_nowait(job)
+            except queue.Full:
+                job._set_state(SweepJob.REJECTED)
+                return False
+            self._active += 1
+            job._set_state(SweepJob.QUEUED)
+        return True
+
+    def abort_all(self):
+        """Abort the running job and every queued job"""
+        with self._lock:
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                job.abort()
+                job._set_state(SweepJob.ABORTED)
+                self._active -= 1
+                self._jobs.task_done()
+            if self.current is not None:
+                self.current.abort()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Wait until no job is running, returns False on timeout"""
+        return self._idle.wait(timeout)
+
+    def stop(self):
+        """Abort everything and stop the worker thread"""
+        self.abort_all()
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            with self._lock:
+                self.current = job
+                self._idle.clear()
+            job._set_state(SweepJob.RUNNING)
+            try:
+                ok = job.engine.run()
+            except Exception as e:
+                logging.error("Sweep job {} failed: {}".format(job.id, e))
+                ok = False
+            if job.engine.aborted:
+                job._set_state(SweepJob.ABORTED)
+            else:
+                job._set_state(SweepJob.FINISHED if ok else SweepJob.FAILED)
+            with self._lock:
+                self.current = None
+                self._active -= 1
+                self._idle.set()
+            self._jobs.task_done()
@@ -1,53 +1,240 @@
 from PyQt6.QtWidgets import QWidget, QFormLayout, QLineEdit, QPushButton, QLabel
-from PyQt6.QtCore import QThread, pyqtSignal, QObject
+from PyQt6.QtGui import QKeySequence
+from PyQt6.QtCore import pyqtSignal, QObject
+import threading
 import time
-import xlsxwriter
 from datetime import datetime
 
-class Worker(QObject):
-    finished = pyqtSignal()
-    progress = pyqtSignal(list)
+import profiling
 
-    def __init__(self, pairs, between):
+from results_store import ResultsStore
+from sweep import Sweep, SweepJob, SweepRunner
+from threshold import ThresholdSearch, felt_from_zones
+
+
+# Seconds the emergency stop keeps commands blocked waiting for the aborted sweep to finish its step
+STOP_SETTLE_TIMEOUT = 2.0
+
+
+class StimulationWorker(QObject):
+    progress = pyqtSignal(object, object, float)
+    state_changed = pyqtSignal(object)
+    # tab that asked for the stop and the StopReport
+    stopped = pyqtSignal(object, object)
+
+    def __init__(self, device, queue_overlapping=False):
         """
-        QWorker for sweeping without logging, GUI hangs if this is done w/o a thread
+        Long-lived sweep worker shared by all tabs, GUI hangs if sweeps are run w/o a thread
+        Jobs run one at a time on the SweepRunner thread, progress and job states are delivered as signals
         """
-        # TODO muuttujanimet
         super().__init__()
-        self.pairs = pairs
-        self.between = between
+        self.device = device
+        self.runner = SweepRunner(device, queue_overlapping=queue_overlapping)
+
+    def submit(self, sweep):
+        job = SweepJob(sweep, on_progress=self.emit_progress, on_state=self.state_changed.emit)
+        self.runner.submit(job)
+        return job
 
-    def run(self):
-        for pair in self.pairs:
-            self.progress.emit(pair)
-            time.sleep(self.between)
-        self.finished.emit()
+    def emit_progress(self, job, progress):
+        # emit time is sent along so the signal delivery delay can be profiled
+        self.progress.emit(job, progress, time.perf_counter())
 
-class WorkerInt(QObject):
-    finished = pyqtSignal()
-    progress = pyqtSignal(int)
+    def abort_all(self):
+        self.runner.abort_all()
 
-    def __init__(self, pairs, between):
+    def emergency_stop(self, requester=None):
         """
-        QWorker for sweeping without logging, GUI hangs if this is done w/o a thread
-        Some parameters are passed to controller as int instead of list,
-        need another Worker for this
+        Aborts all sweeps and stops the device on its own thread, commands stay blocked until the runner is idle
+        so nothing is sent after the stop, without blocking the GUI. stopped is emitted when the stop is done
         """
-        super().__init__()
-        self.pairs = pairs
-        self.between = between
+        self.runner.abort_all()
+
+        def run():
+            report = self.device.emergency_stop(settle=lambda: self.runner.wait_idle(STOP_SETTLE_TIMEOUT))
+            self.stopped.emit(requester, report)
+
+        threading.Thread(target=run, name="emergency-stop", daemon=True).start()
 
-    def run(self):
-        for pair in self.pairs:
-            self.progress.emit(pair)
-            time.sleep(self.between)
-        self.finished.emit()
 
-class ChannelSwipe(QWidget):
-    def __init__(self, channels, device, handmap):
+class SweepTab(QWidget):
+    # sweep parameter of the start/end/step fields and the factor from display units to device units
+    swept = None
+    scale = 1
+
+    def __init__(self, channels, device, handmap, worker):
+        """
+        Base for the sweep tabs, subclasses only decide what is swept and pass it to start_sweep
+        """
         super().__init__()
         self.device = device
+        self.channels = channels
+        self.handmap = handmap
+        self.worker = worker
+        self.worker.progress.connect(self.show_progress)
+        self.worker.state_changed.connect(self.job_state_changed)
+        self.worker.stopped.connect(self.show_stop)
         self.layout = QFormLayout()
+        self.job = None
+        # called with the outcome when a job submitted by submit_step is done
+        self.step_done = None
+        self.tofile = ""
+
+    def add_sweep_controls(self):
+        self.sweep = QPushButton("Sweep")
+        self.sweep.clicked.connect(self.trigger_sweep)
+        self.layout.addWidget(self.sweep)
+
+        self.pause_button = QPushButton("Pause sweep")
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.layout.addWidget(self.pause_button)
+
+        self.abort_button = QPushButton("Abort sweep")
+        self.abort_button.clicked.connect(self.abort_sweep)
+        self.layout.addWidget(self.abort_button)
+
+        self.stim_status = QLabel("")
+        self.layout.addWidget(self.stim_status)
+
+    def trigger_sweep(self):
+        """
+        Sweeps self.swept from the start field to the end field (exclusive) in steps of the step field, the
+        fields are in display units and multiplied by self.scale for the device
+        Sweep is done with intervals of self.between
+        """
+        if not self.between.text():
+            self.stim_status.setText("Please set time between stims")
+            return
+
+        start, end, step = (int(float(field.text()) * self.scale) for field in (self.start, self.end, self.step))
+        self.start_sweep(Sweep.product(between=self.get_between(), **{self.swept: list(range(start, end, step))}))
+
+    def start_sweep(self, sweep):
+        """
+        Hands the sweep to the shared stimulation worker, sweeps from other tabs are not interrupted
+        """
+        if not len(sweep):
+            self.stim_status.setText("Nothing to sweep")
+            return
+        job = self.worker.submit(sweep)
+        if job.state == SweepJob.REJECTED:
+            self.stim_status.setText("Another sweep is already running")
+            return
+        self.job = job
+        self.job_state_changed(job)
+
+    def submit_step(self, step, on_done):
+        """
+        Sends one step and triggers it on the shared stimulation worker, like a sweep it is diffed against the
+        device state. on_done(ok) is called on the GUI thread when it is done unless it was aborted, returns
+        False if it was rejected
+        """
+        job = self.worker.submit(Sweep.from_list([step]))
+        if job.state == SweepJob.REJECTED:
+            self.stim_status.setText("Another sweep is already running")
+            return False
+        self.job = job
+        self.step_done = on_done
+        return True
+
+    def show_progress(self, job, progress, emitted):
+        profiling.record('qt_signal', emitted, time.perf_counter(), category='gui')
+        if job is not self.job or self.step_done is not None:
+            return
+        with profiling.span('ui_update', category='gui'):
+            values = ", ".join("{}: {}".format(name, progress.step[name]) for name in progress.step)
+            if progress.failed:
+                self.stim_status.setText(f"Stimulation failed at {values} ({', '.join(progress.failed)})")
+            else:
+                self.stim_status.setText(f"Step {progress.index + 1}/{progress.total}, currently at {values}")
+
+    def job_state_changed(self, job):
+        if job is not self.job:
+            return
+        if self.step_done is not None:
+            if job.done:
+                on_done = self.step_done
+                self.job = None
+                self.step_done = None
+                if job.state != SweepJob.ABORTED:
+                    on_done(job.state == SweepJob.FINISHED)
+            return
+        if job.state == SweepJob.QUEUED:
+            self.stim_status.setText("Sweep queued")
+        elif job.state == SweepJob.ABORTED:
+            self.stim_status.setText("Sweep aborted")
+        elif job.state == SweepJob.FAILED:
+            self.stim_status.setText(f"Sweep complete, {len(job.engine.failures)} steps failed")
+        elif job.state == SweepJob.FINISHED:
+            self.stim_status.setText("Sweep complete!")
+        if job.done:
+            self.job = None
+            self.pause_button.setText("Pause sweep")
+
+    def toggle_pause(self):
+        if self.job is None:
+            return
+        if self.job.engine.paused:
+            self.job.resume()
+            self.pause_button.setText("Pause sweep")
+        else:
+            self.job.pause()
+            self.pause_button.setText("Resume sweep")
+
+    def abort_sweep(self):
+        if self.job is not None:
+            self.job.abort()
+
+    def stop_stimulation(self):
+        """
+        Emergency stop, goes to the device ahead of any queued sweep commands and aborts all sweeps
+        """
+        self.stim_status.setText("Stopping stimulation...")
+        self.worker.emergency_stop(self)
+
+    def show_stop(self, requester, report):
+        if requester is not self:
+            return
+        if report.acknowledged:
+            self.stim_status.setText(f"Stimulation stopped in {report.latency * 1000:.1f} ms, "
+                                     "apply settings to turn DC/DC converter back on")
+        else:
+            self.stim_status.setText("Stop was not acknowledged by the device!")
+
+    def enable_converter(self):
+        """
+        DC/DC converter is turned off by the emergency stop, turn it back on when settings are applied
+        """
+        if not self.device.pulse_generator_dc_converter_status:
+            self.device.set_pulse_generator(True)
+
+    def get_between(self):
+        return float(self.between.text()) if self.between.text() else 0.0
+
+    def get_single_pair(self):
+        """
+        First selected cathode and anode as channel pairs for the device, None if not selected
+        """
+        cathodes, anodes = self.channels.get_active_channels()
+        if not cathodes or not anodes:
+            return None
+        return [([cathodes[0]], [anodes[0]])]
+
+    def generate_combinations(self):
+        """
+        Generates electrode pairs for selected cathodes and anodes
+        """
+        pairs = []
+        cathodes, anodes = self.channels.get_active_channels()
+
+        for i in range(len(cathodes)):
+            for j in range(len(anodes)):
+                pairs.append([([cathodes[i]],[anodes[j]])])
+        return pairs
+
+class ChannelSwipe(SweepTab):
+    def __init__(self, channels, device, handmap, worker):
+        super().__init__(channels, device, handmap, worker)
         # settings
         self.voltage = QLineEdit("150")
         self.num_nplets = QLineEdit("10")
@@ -68,16 +255,11 @@ class ChannelSwipe(QWidget):
 
         self.settings_status = QLabel("")
         self.layout.addWidget(self.settings_status)
-        
-        self.sweep = QPushButton("Sweep")
-        self.sweep.clicked.connect(self.trigger_sweep)
-        self.layout.addWidget(self.sweep)
 
-        self.stim_status = QLabel("")
-        self.layout.addWidget(self.stim_status)
+        self.add_sweep_controls()
 
         self.stop_stim = QPushButton("Stop stimulation")
-        self.stop_stim.clicked.connect(lambda: abort_serial(self.device))
+        self.stop_stim.clicked.connect(self.stop_stimulation)
         self.layout.addWidget(self.stop_stim)
 
         self.excel_file_id = QLineEdit("")
@@ -85,10 +267,6 @@ class ChannelSwipe(QWidget):
 
         self.setLayout(self.layout)
 
-        self.channels = channels
-        self.tofile = ""
-
-        self.handmap = handmap
         self.handmap.scene.stims.connect(self.excel_stim)
         self.excel_stim_in_progress = False
 
@@ -97,59 +275,55 @@ class ChannelSwipe(QWidget):
         if self.excel_stim_in_progress:
             # get pair from selected anode/cathode pairs, check that it exists
             if self.current_pairs:
-                current_pair = self.current_pairs.pop()
+                current_pair = self.current_pairs[-1]
+
+                def done(ok):
+                    if not ok:
+                        self.stim_status.setText(f"Stimulation failed at {current_pair}")
+
+                # the answer is only taken once the next pair is on its way, try again when the worker is free
+                if not self.submit_step({'channel_pairs': current_pair}, done):
+                    return
+                self.current_pairs.pop()
                 self.stim_status.setText(f"Currently at {current_pair}")
-                res = True
-                res = self.device.set_pulses_bipolar(current)
-                res = self.device.trigger_pulse_generator()
-                if not res:
-                    self.stim_status.setText(f"Stimulation failed at {pair}")
-                self.excel_results.append([self.previous_excel_stim, stims])
+                self.excel_results.append([self.previous_excel_stim, stims, time.time()])
+                self.show_response(self.previous_excel_stim, stims)
                 self.previous_excel_stim = current_pair
             # write last result
             elif (not self.current_pairs) and self.previous_excel_stim:
-                self.excel_results.append([self.previous_excel_stim, stims])
+                self.excel_results.append([self.previous_excel_stim, stims, time.time()])
+                self.show_response(self.previous_excel_stim, stims)
                 self.previous_excel_stim = None
                 self.excel_stim_in_progress = False
                 self.save_results_file()
                 self.stim_status.setText(f"Stimulation complete!")
                 
-    def save_results_file(self):
-        """ REAL SPAGHETTI HOURS"""
+    def show_response(self, pair, stims):
+        """Adds the answer to the hand map heatmap and shows the zones reported so far for that pair"""
+        if pair is None:
+            return
+        key = (pair[0][0][0], pair[0][1][0])
+        self.handmap.heatmap.add_response(key, [zone for zone in stims if zone])
+        self.handmap.heatmap.show(key)
 
+    def save_results_file(self):
+        """
+        Stores the session in the results database and writes it to a timestamped result sheet
+        """
         fname = datetime.now().isoformat()[0:-7].replace(":","")
         fname += "_" + self.excel_file_id.text()
-        workbook = xlsxwriter.Workbook(f"./results/{fname}.xlsx")
-        worksheet = workbook.add_worksheet()
-        labels = ["voltage", "nplets", "amplitude", "frequency", "width", "cathode", "anode",
-                  "K1", "K2", "KE", "KK", "KN", "KP", "KPE", "KS1", "KS2", "KSE", "KSK",
-                  "KSN", "KSP", "KSPE", "NO"]
-        label_dict = {}
-        start = 7
-        for lbl in labels[7:]:
-            label_dict[lbl] = start
-            start += 1
-        col = 0
-        for label in labels:
-            worksheet.write(0, col, label)
-            col += 1
-        row = 1
-        for result in self.excel_results[1:]:
-            worksheet.write(row, 0, int(self.voltage.text()))
-            worksheet.write(row, 1, int(self.num_nplets.text()))
-            worksheet.write(row, 2, int(float(self.amplitudes.text()) * 100))
-            worksheet.write(row, 3, int(self.freq.text()))
-            worksheet.write(row, 4, int(self.widths.text()))
-            worksheet.write(row, 5, result[0][0][0][0])
-            worksheet.write(row, 6, result[0][0][1][0])
-            for stimms in result[1]:
-                if stimms:
-                    worksheet.write(row, label_dict[stimms], "X")
-            row += 1
-        workbook.close()
-            
+        store = ResultsStore()
+        session = store.start_session(self.excel_file_id.text())
+        for pair, zones, answered in self.excel_results[1:]:
+            store.add(session, int(self.voltage.text()), int(self.num_nplets.text()),
+                      int(float(self.amplitudes.text()) * 100), int(self.freq.text()), int(self.widths.text()),
+                      pair[0][0][0], pair[0][1][0], [zone for zone in zones if zone], t=answered,
+                      current_range=self.device.current_range)
+        store.export_xlsx(f"./results/{fname}.xlsx", session=session)
+        store.close()
 
     def apply_settings(self):
+        self.enable_converter()
         res = True
         res = self.device.set_voltage(int(self.voltage.text()))
         res = self.device.set_num_nplets(int(self.num_nplets.text()))
@@ -161,21 +335,10 @@ class ChannelSwipe(QWidget):
         else:
             self.settings_status.setText("Settings OK")
     
-    def single_stim(self, pair):
-        """
-        perform single stimulation when QWorker emits a signal
-        """
-        self.stim_status.setText(f"Currently at {pair}")
-        res = True
-        res = self.device.set_pulses_bipolar(pair)
-        res = self.device.trigger_pulse_generator()
-        if not res:
-            self.stim_status.setText(f"Stimulation failed at {pair}")
-
     def trigger_sweep(self):
         """
         Loops over all selected electrode pairs (both anode and cathode is tried for one pair)
-        If self.between is selected, just does the run in a thread so GUI doesn't hang
+        If self.between is selected, the shared stimulation worker steps through the pairs
         """
         pairs = self.generate_combinations()
         if not pairs:
@@ -183,15 +346,7 @@ class ChannelSwipe(QWidget):
             return
 
         if self.between.text():
-            self.thread = QThread()
-            self.worker = Worker(pairs, float(self.between.text()))
-            self.worker.moveToThread(self.thread)
-            self.thread.started.connect(self.worker.run)
-            self.worker.finished.connect(self.thread.quit)
-            self.worker.finished.connect(self.worker.deleteLater)
-            self.thread.finished.connect(self.thread.deleteLater)
-            self.worker.progress.connect(self.single_stim)
-            self.thread.start()
+            self.start_sweep(Sweep.product(between=self.get_between(), channel_pairs=pairs))
         # waits for signals from handmap to stimulate
         else:
             # Copy generated pairs to current pairs
@@ -202,24 +357,13 @@ class ChannelSwipe(QWidget):
             self.previous_excel_stim = None
             self.excel_results = []
             self.excel_stim_in_progress = True
-    
-    def generate_combinations(self):
-        """
-        Generates electrode pairs for selected cathodes and anodes
-        """
-        pairs = []
-        cathodes, anodes = self.channels.get_active_channels()
 
-        for i in range(len(cathodes)):
-            for j in range(len(anodes)):
-                pairs.append([([cathodes[i]],[anodes[j]])])
-        return pairs
+class AmplitudeSwipe(SweepTab):
+    swept = 'amplitude'
+    scale = 100
 
-class AmplitudeSwipe(QWidget):
-    def __init__(self, channels, device, handmap):
-        super().__init__()
-        self.device = device
-        self.layout = QFormLayout()
+    def __init__(self, channels, device, handmap, worker):
+        super().__init__(channels, device, handmap, worker)
         # settings
         self.voltage = QLineEdit("150")
         self.num_nplets = QLineEdit("10")
@@ -237,8 +381,6 @@ class AmplitudeSwipe(QWidget):
 
         self.settings_status = QLabel("")
         self.layout.addWidget(self.settings_status)
- 
-        self.channels = channels
 
         self.start = QLineEdit("1")
         self.end = QLineEdit("2")
@@ -246,81 +388,37 @@ class AmplitudeSwipe(QWidget):
         self.layout.addRow("Starting amp (mA)", self.start)
         self.layout.addRow("Ending amp (mA)", self.end)
         self.layout.addRow("Step (mA)", self.step)
-        self.sweep = QPushButton("Sweep")
-        self.sweep.clicked.connect(self.trigger_sweep)
-        self.layout.addWidget(self.sweep)
 
-        self.stim_status = QLabel("")
-        self.layout.addWidget(self.stim_status)
+        self.add_sweep_controls()
 
         self.setLayout(self.layout)
-        self.tofile = ""
 
     def apply_settings(self):
         """
         Set settings according to QLineEdits
         """
+        self.enable_converter()
         res = True
         res = self.device.set_voltage(int(self.voltage.text()))
         res = self.device.set_num_nplets(int(self.num_nplets.text()))
         res = self.device.set_repetition_rate(int(self.freq.text()))
         res = self.device.set_pulse_width([int(self.widths.text())])
         # first element of active channels cathode, second anode
-        cathodes, anodes = self.channels.get_active_channels()
-        try:
-            self.electrodes = [cathodes[0], anodes[0]]
-            electrodes = [([self.electrodes[0]], [self.electrodes[1]])]
-            res = self.device.set_pulses_bipolar(electrodes)
-            if not res:
-                self.settings_status.setText("Settings failed")
-            else:
-                self.settings_status.setText("Settings OK")
-        except:
+        electrodes = self.get_single_pair()
+        if electrodes is None:
             self.stim_status.setText("Please select a cathode and an anode")
-
-    def single_stim(self, amplitude):
-        """
-        perform single stimulation when QWorker emits a signal
-        """
-        self.stim_status.setText(f"Currently at {amplitude}")
-        res = True
-        res = self.device.set_amplitude([amplitude])
-        res = self.device.trigger_pulse_generator()
+            return
+        res = self.device.set_pulses_bipolar(electrodes)
         if not res:
-            self.stim_status.setText(f"Stimulation failed at {pair}")
-
-    def trigger_sweep(self):
-        """
-        Does amplitude swipe from starting amp to ending amp with step of self.step
-        Sweep is done with intervals of self.between
-        If self.between is none, function waits for a key press after each stimulation, and finally writes the results in a file
-        """
-
-        self.current_amp = int(float(self.start.text()) * 100)
-        ending_amp = int(float(self.end.text()) * 100)
-        step_amp = int(float(self.step.text()) * 100)
-        self.update()
+            self.settings_status.setText("Settings failed")
+        else:
+            self.settings_status.setText("Settings OK")
 
-        amplitudes = []
-        for amp in range(self.current_amp, ending_amp, step_amp):
-            amplitudes.append([amp])
+class FrequencySwipe(SweepTab):
+    swept = 'frequency'
 
-        if self.between.text():
-            self.thread = QThread()
-            self.worker = Worker(amplitudes, float(self.between.text()))
-            self.worker.moveToThread(self.thread)
-            self.thread.started.connect(self.worker.run)
-            self.worker.finished.connect(self.thread.quit)
-            self.worker.finished.connect(self.worker.deleteLater)
-            self.thread.finished.connect(self.thread.deleteLater)
-            self.worker.progress.connect(self.single_stim)
-            self.thread.start()
- 
-class FrequencySwipe(QWidget):
-    def __init__(self, channels, device, handmap):
-        super().__init__()
-        self.device = device
-        self.layout = QFormLayout()
+    def __init__(self, channels, device, handmap, worker):
+        super().__init__(channels, device, handmap, worker)
         # settings
         self.voltage = QLineEdit("150")
         self.num_nplets = QLineEdit("10")
@@ -346,75 +444,33 @@ class FrequencySwipe(QWidget):
         self.layout.addRow("Starting frequency (Hz)", self.start)
         self.layout.addRow("Ending frequency (Hz)", self.end)
         self.layout.addRow("Step (Hz)", self.step)
-        self.sweep = QPushButton("Sweep")
-        self.sweep.clicked.connect(self.trigger_sweep)
-        self.layout.addWidget(self.sweep)
-
-        self.stim_status = QLabel("")
-        self.layout.addWidget(self.stim_status)
 
+        self.add_sweep_controls()
 
         self.setLayout(self.layout)
 
-        self.channels = channels
-        self.tofile = ""
-
     def apply_settings(self):
+        self.enable_converter()
         res = True
         res = self.device.set_voltage(int(self.voltage.text()))
         res = self.device.set_num_nplets(int(self.num_nplets.text()))
         res = self.device.set_amplitude([int(float(self.amplitudes.text()) * 100)])
         res = self.device.set_pulse_width([int(self.widths.text())])
-        cathodes, anodes = self.channels.get_active_channels()
-        try:
-            self.electrodes = [cathodes[0], anodes[0]]
-            electrodes = [([self.electrodes[0]], [self.electrodes[1]])]
-            res = self.device.set_pulses_bipolar(electrodes)
-            if not res:
-                self.settings_status.setText("Settings failed")
-            else:
-                self.settings_status.setText("Settings OK")
-        except:
+        electrodes = self.get_single_pair()
+        if electrodes is None:
             self.stim_status.setText("Please select a cathode and an anode")
-
-    def single_stim(self, frequency):
-        """
-        perform single stimulation when QWorker emits a signal
-        """
-        print(frequency)
-        self.stim_status.setText(f"Currently at {frequency}")
-        res = True
-        res = self.device.set_repetition_rate(frequency)
-        res = self.device.trigger_pulse_generator()
+            return
+        res = self.device.set_pulses_bipolar(electrodes)
         if not res:
-            self.stim_status.setText(f"Stimulation failed at {pair}")
-
-
-    def trigger_sweep(self):
-        self.current_freq = int(self.start.text())
-        ending_freq = int(self.end.text())
-        step_freq = int(self.step.text())
+            self.settings_status.setText("Settings failed")
+        else:
+            self.settings_status.setText("Settings OK")
 
-        frequencies = []
-        for freq in range(self.current_freq, ending_freq, step_freq):
-            frequencies.append(freq)
+class VoltageSwipe(SweepTab):
+    swept = 'voltage'
 
-        if self.between.text():
-            self.thread = QThread()
-            self.worker = WorkerInt(frequencies, float(self.between.text()))
-            self.worker.moveToThread(self.thread)
-            self.thread.started.connect(self.worker.run)
-            self.worker.finished.connect(self.thread.quit)
-            self.worker.finished.connect(self.worker.deleteLater)
-            self.thread.finished.connect(self.thread.deleteLater)
-            self.worker.progress.connect(self.single_stim)
-            self.thread.start()
- 
-class VoltageSwipe(QWidget):
-    def __init__(self, channels, device, handmap):
-        super().__init__()
-        self.device = device
-        self.layout = QFormLayout()
+    def __init__(self, channels, device, handmap, worker):
+        super().__init__(channels, device, handmap, worker)
         # settings
         self.freq = QLineEdit("50")
         self.num_nplets = QLineEdit("10")
@@ -433,72 +489,176 @@ class VoltageSwipe(QWidget):
         self.settings_status = QLabel("")
         self.layout.addWidget(self.settings_status)
 
-        # freq sweep
+        # voltage sweep
         self.start = QLineEdit("70")
         self.end = QLineEdit("150")
         self.step = QLineEdit("10")
         self.layout.addRow("Starting voltage (V)", self.start)
         self.layout.addRow("Ending voltage (V)", self.end)
         self.layout.addRow("Step (V)", self.step)
-        self.sweep = QPushButton("Sweep")
-        self.sweep.clicked.connect(self.trigger_sweep)
-        self.layout.addWidget(self.sweep)
 
-        self.stim_status = QLabel("")
-        self.layout.addWidget(self.stim_status)
+        self.add_sweep_controls()
 
         self.setLayout(self.layout)
 
-        self.channels = channels
-        self.tofile = ""
-
     def apply_settings(self):
+        self.enable_converter()
         res = True
         res = self.device.set_repetition_rate(int(self.freq.text()))
         res = self.device.set_num_nplets(int(self.num_nplets.text()))
         res = self.device.set_amplitude([int(float(self.amplitudes.text()) * 100)])
         res = self.device.set_pulse_width([int(self.widths.text())])
-        cathodes, anodes = self.channels.get_active_channels()
-        try:
-            self.electrodes = [cathodes[0], anodes[0]]
-            electrodes = [([self.electrodes[0]], [self.electrodes[1]])]
-            res = self.device.set_pulses_bipolar(electrodes)
-            if not res:
-                self.settings_status.setText("Settings failed")
-            else:
-                self.settings_status.setText("Settings OK")
-        except:
+        electrodes = self.get_single_pair()
+        if electrodes is None:
             self.stim_status.setText("Please select a cathode and an anode")
+            return
+        res = self.device.set_pulses_bipolar(electrodes)
+        if not res:
+            self.settings_status.setText("Settings failed")
+        else:
+            self.settings_status.setText("Settings OK")
 
-    def single_stim(self, voltage):
-        """
-        perform single stimulation when QWorker emits a signal
-        """
-        self.stim_status.setText(f"Currently at {voltage}")
+class ThresholdTab(SweepTab):
+    def __init__(self, channels, device, handmap, worker):
+        super().__init__(channels, device, handmap, worker)
+        # settings
+        self.voltage = QLineEdit("150")
+        self.num_nplets = QLineEdit("10")
+        self.freq = QLineEdit("50")
+        self.widths = QLineEdit("1000")
+        self.layout.addRow("Voltage (V)", self.voltage)
+        self.layout.addRow("Pulse repetitions", self.num_nplets)
+        self.layout.addRow("Frequency (Hz)", self.freq)
+        self.layout.addRow("Pulse width (us)", self.widths)
+        self.apply = QPushButton("Apply settings")
+        self.apply.clicked.connect(self.apply_settings)
+        self.layout.addWidget(self.apply)
+
+        self.settings_status = QLabel("")
+        self.layout.addWidget(self.settings_status)
+
+        # search range and stopping criterion
+        self.start = QLineEdit("0.5")
+        self.end = QLineEdit("3")
+        self.resolution = QLineEdit("0.05")
+        self.max_stims = QLineEdit("30")
+        self.layout.addRow("Lowest amp (mA)", self.start)
+        self.layout.addRow("Highest amp (mA)", self.end)
+        self.layout.addRow("Threshold accuracy (mA)", self.resolution)
+        self.layout.addRow("Max stims per pair", self.max_stims)
+
+        self.find = QPushButton("Find thresholds")
+        self.find.clicked.connect(self.trigger_sweep)
+        self.layout.addWidget(self.find)
+
+        # responses come from these buttons (Y/N keys) or from drawing on the hand map, NO zone for not felt
+        self.felt = QPushButton("Felt (Y)")
+        self.felt.setShortcut(QKeySequence("Y"))
+        self.felt.clicked.connect(lambda: self.respond(True))
+        self.layout.addWidget(self.felt)
+        self.not_felt = QPushButton("Not felt (N)")
+        self.not_felt.setShortcut(QKeySequence("N"))
+        self.not_felt.clicked.connect(lambda: self.respond(False))
+        self.layout.addWidget(self.not_felt)
+
+        self.abort_button = QPushButton("Abort search")
+        self.abort_button.clicked.connect(self.abort_sweep)
+        self.layout.addWidget(self.abort_button)
+
+        self.stop_stim = QPushButton("Stop stimulation")
+        self.stop_stim.clicked.connect(self.stop_stimulation)
+        self.layout.addWidget(self.stop_stim)
+
+        self.stim_status = QLabel("")
+        self.layout.addWidget(self.stim_status)
+        self.results_label = QLabel("")
+        self.layout.addWidget(self.results_label)
+
+        self.setLayout(self.layout)
+
+        self.handmap.scene.stims.connect(self.handmap_response)
+        self.search = None
+        self.delivered = False
+        self.pairs = []
+        self.thresholds = []
+
+    def apply_settings(self):
+        self.enable_converter()
         res = True
-        res = self.device.set_voltage(voltage)
-        res = self.device.trigger_pulse_generator()
+        res = self.device.set_voltage(int(self.voltage.text()))
+        res = self.device.set_num_nplets(int(self.num_nplets.text()))
+        res = self.device.set_repetition_rate(int(self.freq.text()))
+        res = self.device.set_pulse_width([int(self.widths.text())])
         if not res:
-            self.stim_status.setText(f"Stimulation failed at {pair}")
-
+            self.settings_status.setText("Settings failed")
+        else:
+            self.settings_status.setText("Settings OK")
 
     def trigger_sweep(self):
-        starting_volt = int(self.start.text())
-        ending_volt = int(self.end.text())
-        step_volt = int(self.step.text())
+        """
+        Searches the threshold of every selected electrode pair in turn, each stimulus waits for a response
+        """
+        pairs = self.generate_combinations()
+        if not pairs:
+            self.stim_status.setText("Please select at least one electrode pair")
+            return
+        self.pairs = pairs
+        self.thresholds = []
+        self.results_label.setText("")
+        self.next_pair()
+
+    def next_pair(self):
+        if not self.pairs:
+            self.search = None
+            self.stim_status.setText("Threshold search complete!")
+            return
+        self.pair = self.pairs.pop(0)
+        self.search = ThresholdSearch(int(float(self.start.text()) * 100), int(float(self.end.text()) * 100),
+                                      sd_target=float(self.resolution.text()) * 100,
+                                      max_trials=int(self.max_stims.text()))
+        self.stimulate()
+
+    def stimulate(self):
+        self.amplitude = self.search.next_amplitude()
+        self.delivered = False
+        if self.submit_step({'channel_pairs': self.pair, 'amplitude': self.amplitude}, self.stimulated):
+            self.stim_status.setText(f"{self.pair}: stimulating at {self.amplitude / 100} mA")
+
+    def stimulated(self, ok):
+        if self.search is None:
+            return
+        self.delivered = True
+        if not ok:
+            self.stim_status.setText(f"Stimulation failed at {self.pair}, {self.amplitude / 100} mA")
+        else:
+            self.stim_status.setText(f"{self.pair}: stim {len(self.search.trials) + 1} at "
+                                     f"{self.amplitude / 100} mA, felt?")
 
-        voltages = []
-        for volt in range(starting_volt, ending_volt, step_volt):
-            voltages.append(volt)
+    def handmap_response(self, zones):
+        felt = felt_from_zones(zones)
+        if felt is not None:
+            self.respond(felt)
 
-        if self.between.text():
-            self.thread = QThread()
-            self.worker = WorkerInt(voltages, float(self.between.text()))
-            self.worker.moveToThread(self.thread)
-            self.thread.started.connect(self.worker.run)
-            self.worker.finished.connect(self.thread.quit)
-            self.worker.finished.connect(self.worker.deleteLater)
-            self.thread.finished.connect(self.thread.deleteLater)
-            self.worker.progress.connect(self.single_stim)
-            self.thread.start()
- 
+    def respond(self, felt):
+        # answers only count once the stimulus has been given
+        if self.search is None or not self.delivered:
+            return
+        self.search.respond(self.amplitude, felt)
+        if not self.search.done:
+            self.stimulate()
+            return
+        self.thresholds.append((self.pair, self.search.threshold / 100, self.search.sd / 100,
+                                len(self.search.trials)))
+        self.results_label.setText("\n".join(f"{pair[0][0][0]}-{pair[0][1][0]}: {threshold:.2f} ± {sd:.2f} mA "
+                                             f"({stims} stims)" for pair, threshold, sd, stims in self.thresholds))
+        self.next_pair()
+
+    def abort_sweep(self):
+        self.search = None
+        self.pairs = []
+        super().abort_sweep()
+        self.stim_status.setText("Threshold search aborted")
+
+    def stop_stimulation(self):
+        self.abort_sweep()
+        super().stop_stimulation()
@@ -0,0 +1,85 @@
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class ThresholdSearch:
+    """Bayesian adaptive search (QUEST-style) for the perception threshold of one electrode pair
+
+    The posterior over candidate thresholds low..high is updated after every response, the next amplitude is
+    the posterior mean, and the search stops when the posterior standard deviation drops to sd_target or after
+    max_trials stimuli. Amplitudes are in device units (w/100 mA on low range).
+
+    :param step: resolution of the candidate thresholds and of the stimulated amplitudes
+    :param spread: amplitude above the threshold at which the detection probability reaches 73% (logistic scale)
+    :param guess: probability of reporting a stimulus that was not felt
+    :param lapse: probability of missing a stimulus well above the threshold
+    """
+
+    def __init__(self, low: int, high: int, step: int = 1, spread: float = 10.0, guess: float = 0.02,
+                 lapse: float = 0.02, sd_target: float = 5.0, max_trials: int = 30, min_trials: int = 3):
+        if low >= high:
+            raise ValueError("Threshold search range must be low < high, was {}-{}".format(low, high))
+        if step <= 0 or spread <= 0:
+            raise ValueError("Step and spread must be positive, were {} and {}".format(step, spread))
+        self.low = low
+        self.high = high
+        self.step = step
+        self.spread = spread
+        self.guess = guess
+        self.lapse = lapse
+        self.sd_target = sd_target
+        self.max_trials = max_trials
+        self.min_trials = min_trials
+        self.trials = []  # type: List[Tuple[int, bool]]
+        self.candidates = np.arange(low, high + step, step, dtype=float)
+        self._log_posterior = np.zeros(len(self.candidates))
+
+    def detection_probability(self, amplitude: float) -> np.ndarray:
+        """Probability of a 'felt' response to amplitude for every candidate threshold"""
+        felt = 1.0 / (1.0 + np.exp(-(amplitude - self.candidates) / self.spread))
+        return self.guess + (1.0 - self.guess - self.lapse) * felt
+
+    def _posterior(self) -> np.ndarray:
+        posterior = np.exp(self._log_posterior - self._log_posterior.max())
+        return posterior / posterior.sum()
+
+    @property
+    def threshold(self) -> float:
+        """Current threshold estimate, the posterior mean"""
+        return float(np.dot(self._posterior(), self.candidates))
+
+    @property
+    def sd(self) -> float:
+        """Posterior standard deviation of the threshold"""
+        posterior = self._posterior()
+        mean = np.dot(posterior, self.candidates)
+        return math.sqrt(float(np.dot(posterior, (self.candidates - mean) ** 2)))
+
+    @property
+    def done(self) -> bool:
+        if len(self.trials) >= self.max_trials:
+            return True
+        return len(self.trials) >= self.min_trials and self.sd <= self.sd_target
+
+    def next_amplitude(self) -> int:
+        """Amplitude of the next stimulus, the threshold estimate rounded to the search resolution"""
+        amplitude = self.low + round((self.threshold - self.low) / self.step) * self.step
+        return int(min(max(amplitude, self.low), self.high))
+
+    def respond(self, amplitude: int, felt: bool):
+        """Record whether the stimulus at amplitude was felt"""
+        probability = self.detection_probability(amplitude)
+        self._log_posterior += np.log(probability if felt else 1.0 - probability)
+        self.trials.append((amplitude, felt))
+
+
+def felt_from_zones(zones: List[str]) -> Optional[bool]:
+    """Response from the zones drawn on the hand map, 'NO' marks a stimulus that was not felt
+
+    :return: None if nothing was drawn
+    """
+    if not zones:
+        return None
+    return "NO" not in zones
@@ -0,0 +1,127 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Optional
+
+from controller import Controller
+from sweep import apply_step
+
+TRIGGER_FRAME = Controller._to_bytes(">T<")
+
+# Latencies in seconds from the event to the end of the write and to the device acknowledgement
+TriggerRecord = namedtuple('TriggerRecord', ['event_time', 'write_latency', 'ack_latency', 'acknowledged'])
+
+
+class ArmedTrigger:
+    """Closed-loop trigger with the stimulus uploaded ahead of the event
+
+    arm() sends the stimulus configuration while nothing is happening, fire() then only writes the
+    pre-encoded trigger frame. Every fire is recorded in self.records.
+    """
+
+    def __init__(self, device: Controller):
+        self.device = device
+        self.armed = False
+        self.records = []
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def arm(self, profile: Optional[Dict] = None) -> bool:
+        """Upload the next stimulus (sweep parameters, see sweep.SETTERS)
+
+        Every parameter of the profile is sent, arming happens ahead of the event so the few extra frames cost
+        nothing and the stimulus never depends on state the device may not have.
+        """
+        with self._lock:
+            failed = []
+            if profile:
+                _, failed = apply_step(self.device, profile)
+            self.armed = not failed
+            if failed:
+                logging.warning("Arming failed for {}".format(failed))
+            return self.armed
+
+    def fire(self, event_time: Optional[float] = None) -> Optional[TriggerRecord]:
+        """Trigger the armed stimulus, event_time is time.perf_counter() at the event, defaults to now
+
+        :return: the trigger record or None if nothing was armed
+        """
+        if event_time is None:
+            event_time = time.perf_counter()
+        with self._lock:
+            if not self.armed:
+                logging.warning("Trigger event ignored, nothing armed")
+                return None
+            ok, written, answered = self.device.send_timed(TRIGGER_FRAME)
+            if ok:
+                self.device.pulse_generator_triggered = not self.device.pulse_generator_triggered
+            record = TriggerRecord(event_time, written - event_time, answered - event_time, ok)
+            self.records.append(record)
+        return record
+
+    def listen_socket(self, address: str):
+        """Fire on every datagram received on a Unix datagram socket path or localhost UDP host:port"""
+        host, sep, port = address.rpartition(':')
+        if sep and port.isdigit():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((host or 'localhost', int(port)))
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(address)
+
+        def close():
+            # shutdown wakes up the blocked recv
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            if sock.family == socket.AF_UNIX and os.path.exists(address):
+                os.unlink(address)
+
+        self._listen(lambda: sock.recv(64), close)
+
+    def listen_pipe(self, path: str):
+        """Fire on every byte written to a named pipe (or any readable file)"""
+        fd = os.open(path, os.O_RDWR if os.path.exists(path) else os.O_RDONLY)
+        self._listen(lambda: os.read(fd, 1), lambda: os.close(fd))
+
+    def _listen(self, read, close):
+        def run():
+            while True:
+                try:
+                    data = read()
+                except OSError:
+                    break
+                event_time = time.perf_counter()
+                if not data:
+                    break
+                self.fire(event_time)
+
+        thread = threading.Thread(target=run, name="trigger-listener", daemon=True)
+        self._listeners.append((thread, close))
+        thread.start()
+
+    def stop_listening(self):
+        for thread, close in self._listeners:
+            close()
+        self._listeners = []
+
+    def latency_summary(self) -> Dict:
+        """Mean and max event-to-write and event-to-ACK latency in seconds over acknowledged triggers"""
+        acknowledged = [r for r in self.records if r.acknowledged]
+        if not acknowledged:
+            return {'triggers': len(self.records), 'acknowledged': 0}
+        writes = [r.write_latency for r in acknowledged]
+        acks = [r.ack_latency for r in acknowledged]
+        return {
+            'triggers': len(self.records),
+            'acknowledged': len(acknowledged),
+            'mean_write_latency': sum(writes) / len(writes),
+            'max_write_latency': max(writes),
+            'mean_ack_latency': sum(acks) / len(acks),
+            'max_ack_latency': max(acks),
+        }